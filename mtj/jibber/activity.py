@@ -0,0 +1,377 @@
+import logging
+import sqlite3
+import sys
+import threading
+from array import array
+from heapq import nsmallest
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+try:
+    _intern = sys.intern
+except AttributeError:  # pragma: no cover
+    _intern = intern
+
+try:
+    array('q')
+    _stamp_type = 'q'
+except ValueError:  # pragma: no cover
+    _stamp_type = 'l'
+
+logger = logging.getLogger('mtj.jibber.activity')
+
+
+def intern_str(value):
+    """
+    Intern the value if it is a string such that all the copies of it
+    stored will be shared.
+    """
+
+    if type(value) is str:
+        return _intern(value)
+    return value
+
+
+class ActivityStore(Mapping):
+    """
+    A compact mapping of `(room, name)` to `(other, timestamp)`, for
+    recording the last activity of the users within the rooms.
+
+    The strings are interned and the entries are stored in slots, with
+    the timestamps held in an array, instead of a tuple per key and
+    value.  The number of entries can be capped, with the oldest ones
+    evicted when it is exceeded, and the entries may be given a time to
+    live relative to the latest activity recorded.  Access is guarded
+    by a lock as the store is shared with the worker threads.
+
+    max_entries
+        the maximum number of entries; 0 for no limit.
+    ttl
+        the number of seconds since an entry was recorded for it to be
+        considered expired; 0 for no limit.
+
+    >>> store = ActivityStore(max_entries=2)
+    >>> store[('room', 'alice')] = ('alice@example.com', 100)
+    >>> store[('room', 'bob')] = ('bob@example.com', 110)
+    >>> store[('room', 'alice')] = ('alice@example.com', 120)
+    >>> store[('room', 'carol')] = ('carol@example.com', 130)
+    >>> sorted(store)
+    [('room', 'alice'), ('room', 'carol')]
+    >>> store[('room', 'alice')]
+    ('alice@example.com', 120)
+    >>> store == {('room', 'alice'): ('alice@example.com', 120),
+    ...     ('room', 'carol'): ('carol@example.com', 130)}
+    True
+    """
+
+    # the fraction of the entries evicted in one go once the cap is
+    # exceeded, so the search for the oldest entries is amortized.
+    evict_fraction = 16
+
+    def __init__(self, max_entries=0, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # room: {name: slot}
+        self.rooms = {}
+        # the slots, with None for both room and name for free slots.
+        self.slot_rooms = []
+        self.slot_names = []
+        self.others = []
+        self.stamps = array(_stamp_type)
+        self.free = []
+        self.count = 0
+        self.latest = 0
+        self.swept = 0
+        self.lock = threading.RLock()
+
+    def _sweep(self):
+        # remove the entries expired but not yet swept, such that they
+        # will not be counted or iterated over.
+        if self.ttl and self.swept < self.latest:
+            self.expire()
+
+    def __len__(self):
+        with self.lock:
+            self._sweep()
+            return self.count
+
+    def __iter__(self):
+        with self.lock:
+            self._sweep()
+            keys = [(room, name) for room, names in self.rooms.items()
+                for name in names]
+        return iter(keys)
+
+    def items(self):
+        """
+        Return a list of the entries, taken as one under the lock such
+        that the entries removed by other threads in the meantime will
+        not be looked up.
+        """
+
+        with self.lock:
+            self._sweep()
+            others = self.others
+            stamps = self.stamps
+            return [((room, name), (others[slot], stamps[slot]))
+                for room, names in self.rooms.items()
+                for name, slot in names.items()]
+
+    def _slot(self, key):
+        room, name = key
+        names = self.rooms.get(room)
+        if names is None:
+            return None
+        return names.get(name)
+
+    def _expired(self, slot):
+        return self.ttl and self.stamps[slot] <= self.latest - self.ttl
+
+    def __getitem__(self, key):
+        with self.lock:
+            slot = self._slot(key)
+            if slot is None or self._expired(slot):
+                raise KeyError(key)
+            return (self.others[slot], self.stamps[slot])
+
+    def get(self, key, default=None):
+        with self.lock:
+            names = self.rooms.get(key[0])
+            if names is None:
+                return default
+            slot = names.get(key[1])
+            if slot is None or self._expired(slot):
+                return default
+            return (self.others[slot], self.stamps[slot])
+
+    def __contains__(self, key):
+        with self.lock:
+            slot = self._slot(key)
+            return slot is not None and not self._expired(slot)
+
+    def __setitem__(self, key, value):
+        room, name = key
+        other, timestamp = value
+        other = intern_str(other)
+
+        with self.lock:
+            self._set(room, name, other, timestamp)
+
+    def _set(self, room, name, other, timestamp):
+        names = self.rooms.get(room)
+        if names is None:
+            room = intern_str(room)
+            names = self.rooms[room] = {}
+
+        slot = names.get(name)
+        if slot is None:
+            name = intern_str(name)
+            if self.free:
+                slot = self.free.pop()
+                self.slot_rooms[slot] = room
+                self.slot_names[slot] = name
+                self.others[slot] = other
+                self.stamps[slot] = timestamp
+            else:
+                slot = len(self.stamps)
+                self.slot_rooms.append(room)
+                self.slot_names.append(name)
+                self.others.append(other)
+                self.stamps.append(timestamp)
+            names[name] = slot
+            self.count += 1
+        else:
+            self.others[slot] = other
+            self.stamps[slot] = timestamp
+
+        if timestamp > self.latest:
+            self.latest = timestamp
+
+        if self.ttl and self.latest - self.swept >= self.ttl:
+            self.expire()
+        if self.max_entries and self.count > self.max_entries:
+            self.evict(max(self.count - self.max_entries,
+                self.max_entries // self.evict_fraction))
+
+    def __delitem__(self, key):
+        with self.lock:
+            slot = self._slot(key)
+            if slot is None:
+                raise KeyError(key)
+            self._remove(slot)
+
+    def _remove(self, slot):
+        room = self.slot_rooms[slot]
+        names = self.rooms[room]
+        del names[self.slot_names[slot]]
+        if not names:
+            del self.rooms[room]
+        self.slot_rooms[slot] = None
+        self.slot_names[slot] = None
+        self.others[slot] = None
+        self.free.append(slot)
+        self.count -= 1
+
+    def _live(self):
+        slot_rooms = self.slot_rooms
+        return (slot for slot in range(len(slot_rooms))
+            if slot_rooms[slot] is not None)
+
+    def evict(self, number):
+        """
+        Evict the number of the oldest entries.
+        """
+
+        with self.lock:
+            for slot in nsmallest(number, self._live(),
+                    key=self.stamps.__getitem__):
+                self._remove(slot)
+
+    def expire(self, now=None):
+        """
+        Remove the entries that have expired relative to now, which is
+        the latest activity recorded by default.
+        """
+
+        with self.lock:
+            if now is None:
+                now = self.latest
+            self.swept = now
+            if not self.ttl:
+                return
+            cutoff = now - self.ttl
+            stamps = self.stamps
+            for slot in [slot for slot in self._live()
+                    if stamps[slot] <= cutoff]:
+                self._remove(slot)
+
+
+class SqliteActivityBackend(object):
+    """
+    Persist the activity recorded into a sqlite database, with the
+    writes batched in memory and written behind once the batch reaches
+    `batch_size` entries, every `flush_interval` seconds (if started)
+    and when closed.  Once started, the full batches are also written
+    by the thread of the timer rather than the one recording them.
+
+    >>> backend = SqliteActivityBackend(':memory:', batch_size=2)
+    >>> backend.record('nick', 'room', 'alice', 'alice@example.com', 100)
+    >>> len(backend.pending)
+    1
+    >>> backend.fetch('nick', 'room', 'alice')
+    ('alice@example.com', 100)
+    >>> backend.record('jid', 'room', 'alice@example.com', 'alice', 100)
+    >>> len(backend.pending)
+    0
+    >>> backend.fetch('jid', 'room', 'alice@example.com')
+    ('alice', 100)
+    >>> backend.close()
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=30):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.stopped = threading.Event()
+        # set to have the thread flush before the interval is up.
+        self.wake = threading.Event()
+        self.thread = None
+        self.closed = False
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS activity ('
+            'kind TEXT, room TEXT, name TEXT, other TEXT, '
+            'timestamp INTEGER, PRIMARY KEY (kind, room, name))'
+        )
+        self.conn.commit()
+
+    def start(self):
+        if self.thread is not None or not self.flush_interval:
+            return
+        self.thread = threading.Thread(target=self.work,
+            name='jibber-activity')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            if self.stopped.is_set():
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush the activity')
+
+    def record(self, kind, room, name, other, timestamp):
+        if self.closed:
+            # rather than have the activity silently lost.
+            raise ValueError('activity backend is closed')
+        with self.lock:
+            self.pending[(kind, room, name)] = (other, timestamp)
+            full = len(self.pending) >= self.batch_size
+        if not full:
+            return
+        if self.thread is not None:
+            self.wake.set()
+        else:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all the pending activity into the database.
+        """
+
+        # the batches must be written in the order they were taken.
+        with self.db_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                pending, self.pending = self.pending, {}
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO activity VALUES (?, ?, ?, ?, ?)',
+                [key + value for key, value in pending.items()])
+            self.conn.commit()
+
+    def fetch(self, kind, room, name):
+        """
+        Return the `(other, timestamp)` recorded for the name within
+        the room, or None.
+        """
+
+        with self.lock:
+            value = self.pending.get((kind, room, name))
+        if value is not None:
+            return value
+
+        with self.db_lock:
+            row = self.conn.execute(
+                'SELECT other, timestamp FROM activity '
+                'WHERE kind = ? AND room = ? AND name = ?',
+                (kind, room, name)).fetchone()
+        if row is None:
+            return None
+        return (intern_str(row[0]), row[1])
+
+    def close(self):
+        """
+        Stop the timer and flush the pending activity.
+        """
+
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        with self.db_lock:
+            self.conn.close()
+            self.closed = True
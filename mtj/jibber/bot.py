@@ -2,6 +2,8 @@ import re
 import random
 from time import time
 
+from mtj.jibber.activity import ActivityStore
+from mtj.jibber.activity import SqliteActivityBackend
 from mtj.jibber.core import Command
 from mtj.jibber import stanza
 
@@ -184,11 +186,13 @@ class MucAdmin(Command):
             success_msg='%(mucnick)s: Okay, I have kicked %(victim)s for you.',
             forbidden_reason='Only moderators may kick',
             allowed_roles=('moderator',),
+            chunk_size=20,
         ):
         self.success_reason = success_reason
         self.success_msg = success_msg
         self.forbidden_reason = forbidden_reason
         self.allowed_roles = allowed_roles
+        self.chunk_size = chunk_size
 
     def admin_kick_nickname(self, msg, match, bot, **kw):
         """
@@ -199,24 +203,20 @@ class MucAdmin(Command):
         room = msg['from'].bare
         req_nick = msg['from'].resource
 
-        self_role = bot.muc.rooms.get(room, {}).get(bot.nickname,
-            {}).get('role')
-        if self_role != 'moderator':
+        occupants = bot.room_occupants(room)
+        if occupants.role_of(bot.nickname) != 'moderator':
             return
 
-        roster = bot.muc.rooms.get(room, {})
-        roster_item = roster.get(req_nick)
-
-        if not roster_item:
+        if req_nick not in occupants:
             # warning?
             return
 
-        if roster_item['role'] not in self.allowed_roles:
+        if occupants.role_of(req_nick) not in self.allowed_roles:
             self._muckick(bot, room, req_nick, self.forbidden_reason)
             return
 
         victim = match.groupdict().get('victim')
-        if not victim or not roster.get(victim):
+        if not victim or victim not in bot.room_occupants(room):
             return
 
         self._muckick(bot, room, victim, self.success_reason)
@@ -226,8 +226,18 @@ class MucAdmin(Command):
         }
 
     def _muckick(self, bot, room, nickname, reason):
-        raw = stanza.admin_query(room, nick=nickname, reason=reason)
-        bot.client.send(raw)
+        self.kick(bot, room, [nickname], reason)
+
+    def kick(self, bot, room, nicks=(), reason=None, jids=()):
+        """
+        Kick all the nicks and full jids from the room, with up to
+        `chunk_size` of them in each admin query sent.  Returns the
+        futures for the responses if the bot tracks them.
+        """
+
+        return [bot.send_stanza(raw, priority=True, action='kick')
+            for raw in stanza.admin_queries(room, nicks, jids,
+                reason=reason, chunk_size=self.chunk_size)]
 
 
 class RussianRoulette(Command):
@@ -255,7 +265,7 @@ class RussianRoulette(Command):
         nick = msg['mucnick']
 
         raw = stanza.admin_query(room, nick=nick, reason=self.death_msg)
-        bot.client.send(raw)
+        bot.send_stanza(raw, priority=True, action='kick')
 
 
 class Affilate(Command):
@@ -267,19 +277,39 @@ class Affilate(Command):
             self,
             promote_to='moderator',
             demote_to='participant',
+            chunk_size=20,
         ):
         self.promote_to = promote_to
         self.demote_to = demote_to
+        self.chunk_size = chunk_size
 
     @classmethod
     def affiliate(cls, bot, room, nick, role):
-        bot.client.send(stanza.admin_query(room, nick, role=role))
+        return bot.send_stanza(stanza.admin_query(room, nick, role=role),
+            priority=True, action='affiliate')
+
+    def affiliate_all(self, bot, room, nicks, role):
+        """
+        Change the role of all the nicks, with up to `chunk_size` of
+        them in each admin query sent.  Returns the futures for the
+        responses if the bot tracks them.
+        """
+
+        return [bot.send_stanza(raw, priority=True, action='affiliate')
+            for raw in stanza.admin_queries(room, nicks, role=role,
+                chunk_size=self.chunk_size)]
 
     def promote(self, bot, room, nick):
-        self.affiliate(bot, room, nick, self.promote_to)
+        return self.affiliate(bot, room, nick, self.promote_to)
 
     def demote(self, bot, room, nick):
-        self.affiliate(bot, room, nick, self.demote_to)
+        return self.affiliate(bot, room, nick, self.demote_to)
+
+    def promote_all(self, bot, room, nicks):
+        return self.affiliate_all(bot, room, nicks, self.promote_to)
+
+    def demote_all(self, bot, room, nicks):
+        return self.affiliate_all(bot, room, nicks, self.demote_to)
 
 
 class RandomPromotion(Affilate):
@@ -318,10 +348,7 @@ class RandomPromotion(Affilate):
         if self.last_mod:
             self.demote(bot, self.room, self.last_mod)
 
-        participants = [
-            nick for nick, details in bot.muc.rooms.get(self.room, {}).items()
-            if details.get('role') == 'participant'
-        ]
+        participants = bot.room_occupants(self.room).with_role('participant')
 
         if not participants:
             # no one to play with
@@ -334,13 +361,31 @@ class RandomPromotion(Affilate):
 
 class LastActivity(Command):
     """
-    This is a base implementation, a more detailed one that includes
-    persistency will be included in mtj.jibberext.
-
     Can effectively provide the the last seen command typically found in
     IRC chatrooms when associated with the right triggers.
+
+    max_entries
+        the maximum number of entries kept for each of the jids and the
+        nicks, with the oldest evicted first; 0 for no limit.
+    ttl
+        the number of seconds an entry is kept since its activity; 0
+        for no limit.
+    persist
+        the keyword arguments for the `backend_factory` to persist the
+        activity with, if any.  The default is to use the sqlite backend
+        (see `mtj.jibber.activity.SqliteActivityBackend`), like so:
+
+            "persist": {
+                "path": "/var/lib/jibber/activity.db",
+                "batch_size": 500,
+                "flush_interval": 30
+            }
+
+        The activity not found in memory will be looked up from there.
     """
 
+    backend_factory = SqliteActivityBackend
+
     def __init__(self,
             nick_last_seen='%(mucnick)s: %(nick)s was last seen %(time)s.',
             nick_is_here='%(mucnick)s: %(nick)s is seen here right now.',
@@ -351,6 +396,9 @@ class LastActivity(Command):
             jid_never_seen='%(mucnick)s: %(jid)s has never been seen '
                 'here before.',
             ago='%s seconds ago',
+            max_entries=0,
+            ttl=0,
+            persist=None,
         ):
 
         self.nick_last_seen = nick_last_seen
@@ -361,14 +409,37 @@ class LastActivity(Command):
         self.jid_never_seen = jid_never_seen
         self.ago = ago
 
-        self.jids = {}
-        self.nicks = {}
+        self.jids = ActivityStore(max_entries, ttl)
+        self.nicks = ActivityStore(max_entries, ttl)
+
+        self.backend = None
+        if persist:
+            self.backend = self.backend_factory(**persist)
+            self.backend.start()
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
 
     def add_jid(self, room_jid, jid, nick, timestamp):
         self.jids[(room_jid, jid)] = (nick, timestamp)
+        if self.backend is not None:
+            self.backend.record('jid', room_jid, jid, nick, timestamp)
 
     def add_nick(self, room_jid, jid, nick, timestamp):
         self.nicks[(room_jid, nick)] = (jid, timestamp)
+        if self.backend is not None:
+            self.backend.record('nick', room_jid, nick, jid, timestamp)
+
+    def _lookup(self, store, kind, room_jid, name):
+        info = store.get((room_jid, name))
+        if info is None and self.backend is not None:
+            info = self.backend.fetch(kind, room_jid, name)
+            if info is not None:
+                # warm up the cache.
+                store[(room_jid, name)] = info
+        return info
 
     def add_all(self, room_jid, jid, nick, timestamp):
         self.add_jid(room_jid, jid, nick, timestamp)
@@ -393,8 +464,12 @@ class LastActivity(Command):
 
         room = msg['from'].bare
         nick = msg['from'].resource
-        jid = bot.muc.rooms[room][nick]['jid'].bare
+        jid = bot.room_occupants(room).jid_of(nick)
         timestamp = int(time())
+        if jid is None:
+            # the jid is not known to the bot.
+            self.add_nick(room, jid, nick, timestamp)
+            return
         self.add_all(room, jid, nick, timestamp)
 
     def format_ago(self, timestamp):
@@ -415,11 +490,11 @@ class LastActivity(Command):
         nick = match.group('nick')
         # check if the nickname is in the same room as the user making
         # the request
-        if bot.muc.rooms.get(room_jid, {}).get(nick):
+        if nick in bot.room_occupants(room_jid):
             return self.nick_is_here % {'nick': nick,
                 'mucnick': mucnick}
         # grab an info otherwise
-        info = self.nicks.get((room_jid, nick))
+        info = self._lookup(self.nicks, 'nick', room_jid, nick)
         if not info:
             return self.nick_never_seen % {'nick': nick,
                 'mucnick': mucnick}
@@ -441,11 +516,11 @@ class LastActivity(Command):
         jid = match.group('jid')
         # check if the jid is in the same room as the user making
         # the request
-        if jid in (v['jid'].bare for v in bot.muc.rooms[room_jid].values()):
+        if bot.room_occupants(room_jid).has_jid(jid):
             return self.jid_is_here % {'jid': jid,
                 'mucnick': mucnick}
         # grab an info otherwise
-        info = self.jids.get((room_jid, jid))
+        info = self._lookup(self.jids, 'jid', room_jid, jid)
         if not info:
             return self.jid_never_seen % {'jid': jid,
                 'mucnick': mucnick}
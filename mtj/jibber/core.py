@@ -55,7 +55,10 @@ class BotCore(object):
         self.s_config = c
 
     def load_client_config(self, c_config):
-        return self.config.update(json.loads(c_config))
+        config = json.loads(c_config)
+        if not isinstance(config, dict):
+            raise ValueError('client config must be a json object')
+        return self.config.update(config)
 
     def load_server_config_from_path(self, s_config_path):
         self._raw_s_config = ConfigFile(s_config_path, self.load_server_config)
@@ -66,9 +69,20 @@ class BotCore(object):
         return self._raw_config.load()
 
     def reload_client_config(self):
+        # the current config is kept if the new one cannot be read.
+        if not self._raw_config:
+            return
+        previous = dict(self.config)
         self.config.clear()
-        if self._raw_config:
-            return self._raw_config.load()
+        try:
+            result = self._raw_config.load()
+        except Exception:
+            self.config.clear()
+            self.config.update(previous)
+            raise
+        if result is None:
+            self.config.update(previous)
+        return result
 
     @property
     def address(self):
@@ -160,6 +174,12 @@ class Handler(object):
     def __init__(self, *a, **kw):
         pass
 
+    def close(self):
+        """
+        Called when the handler is no longer used by the bot, such as
+        when the bot disconnects or sets up its packages again.
+        """
+
 
 class Command(Handler):
     """
@@ -13,8 +13,11 @@ import tempfile
 import time
 
 from mtj.jibber.jabber import MucChatBot
+from mtj.jibber.utils import ConfigWatcher
 from mtj.jibber.utils import read_config
 
+logger = logging.getLogger('mtj.jibber.ctrl')
+
 
 class JibberCmd(cmd.Cmd):
 
@@ -25,22 +28,84 @@ class JibberCmd(cmd.Cmd):
         self.bot = bot
         self.loop = True
         self.timeout = 1
+        # seconds for the client config to settle before reloading.
+        self.reload_debounce = 1
+
+    def reload_config(self):
+        """
+        Reload the client config and the packages that have changed.
+        """
+
+        start = time.time()
+        try:
+            if self._reload_client_config() is None:
+                logger.warning('client config not found; not reloaded')
+                return
+        except Exception:
+            logger.exception('failed to reload the client config')
+            return
+        logger.info('reloaded client config in %.2f ms',
+            (time.time() - start) * 1000)
+
+    def _reload_client_config(self):
+        # the previous client config is put back should the packages
+        # fail to be set up from the new one, so the bot is left as it
+        # was.
+        config = getattr(self.bot, 'config', None)
+        previous = dict(config) if isinstance(config, dict) else None
+        result = self.bot.reload_client_config()
+        if result is None:
+            return None
+        try:
+            self.bot.reload_packages()
+        except Exception:
+            if previous is not None:
+                config.clear()
+                config.update(previous)
+            raise
+        return result
+
+    def watch_config(self):
+        """
+        Return a watcher for the client config file that reloads it,
+        also requested through SIGHUP if available, along with the
+        previous handler for that signal.
+        """
+
+        raw_config = getattr(self.bot, '_raw_config', None)
+        watcher = ConfigWatcher(getattr(raw_config, 'path', None),
+            self.reload_config, self.reload_debounce)
+
+        previous = None
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                previous = signal.signal(signal.SIGHUP,
+                    lambda signum, frame: watcher.request())
+            except ValueError:
+                # not in the main thread.
+                pass
+        return watcher, previous
 
     def do_fg(self, arg):
         """
-        run this in the foreground.
+        run this in the foreground, reloading the client config when it
+        is changed or on SIGHUP.
         """
 
+        watcher, previous = self.watch_config()
         self.bot.connect()
         while self.loop:
             try:
                 time.sleep(self.timeout)
+                watcher.check()
                 self.loop = self.bot.is_alive()
             except KeyboardInterrupt:
                 self.loop = False
             except:
                 print('bot is dying in a fire, attempting to abort...')
                 self.loop = False
+        if previous is not None:
+            signal.signal(signal.SIGHUP, previous)
         self.bot.disconnect()
 
     def do_debug(self, arg):
@@ -62,8 +127,9 @@ class JibberCmd(cmd.Cmd):
             print("Test client ready; call client('Hello bot') to interact.")
 
         def bot_reinit():
-            c = self.bot.reload_client_config()
-            self.bot.setup_packages()
+            if self._reload_client_config() is None:
+                print("Client configuration not found; not reinitialized.")
+                return
             print("Successfully reinitialized bot configuration and modules.")
 
         console = code.InteractiveConsole(locals={
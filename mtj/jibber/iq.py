@@ -0,0 +1,233 @@
+import itertools
+import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from time import time
+
+from sleekxmpp.exceptions import IqError
+from sleekxmpp.exceptions import IqTimeout
+
+try:
+    from concurrent.futures import Future
+except ImportError:  # pragma: no cover
+    # python 2 without the futures backport.
+    Future = None
+
+logger = logging.getLogger('mtj.jibber.iq')
+
+
+def _resolve(future, result=None, exception=None):
+    # the future may have been cancelled by whoever it was returned to,
+    # and it can no longer be once it is marked as running.
+    if not future.set_running_or_notify_cancel():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class Histogram(object):
+    """
+    A histogram of latencies (in seconds), counted into fixed buckets
+    by their upper bounds with the last bucket for everything above.
+
+    >>> hist = Histogram(bounds=(0.1, 1))
+    >>> for value in (0.05, 0.5, 0.7, 3):
+    ...     hist.add(value)
+    >>> hist.counts
+    [1, 2, 1]
+    >>> sorted(hist.stats().items())
+    [('buckets', [(0.1, 1), (1, 2), (None, 1)]), ('count', 4), \
+('max', 3), ('mean', 1.0625)]
+    """
+
+    bounds = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, bounds=None):
+        if bounds is not None:
+            self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'buckets': list(zip(self.bounds + (None,), self.counts)),
+        }
+
+
+class IqTracker(object):
+    """
+    Track the responses to the iq stanzas sent, such as the admin
+    queries, resolving the futures returned for them and recording the
+    round trip latency and the results for each kind of action.
+
+    timeout
+        the number of seconds until a response is no longer expected,
+        failing the future with `sleekxmpp.exceptions.IqTimeout`.
+    max_pending
+        the maximum number of stanzas tracked; the oldest will stop
+        being tracked (with their future cancelled) to make room.
+    interval
+        the number of seconds between the checks for the timeouts.
+    """
+
+    def __init__(self, timeout=30, max_pending=1000, interval=5):
+        if Future is None:  # pragma: no cover
+            raise RuntimeError(
+                'tracking iq requires concurrent.futures (the futures '
+                'package on python 2)')
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.interval = interval
+        # id: (future, action, stanza, sent), ordered by the time sent.
+        self.pending = OrderedDict()
+        self.histograms = {}
+        self.results = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _record(self, action, result):
+        counts = self.results.get(action)
+        if counts is None:
+            counts = self.results[action] = dict.fromkeys(
+                ('result', 'error', 'timeout', 'dropped'), 0)
+        counts[result] += 1
+
+    def track(self, stanza, action, now=None):
+        """
+        Track the iq stanza for the action, assigning an id to it if it
+        does not already have one.  Returns the future that will have
+        the response as the result.
+        """
+
+        if now is None:
+            now = time()
+        # iq stanzas created without a stream (like the ones from the
+        # mtj.jibber.stanza module) all have '0' as their id.
+        if stanza['id'] in ('', '0'):
+            stanza['id'] = 'jibber-%d' % next(self._ids)
+
+        future = Future()
+        dropped = []
+        with self.lock:
+            expired = self._expire(now)
+            while self.pending and len(self.pending) >= self.max_pending:
+                dropped.append(self.pending.popitem(last=False)[1])
+            self.pending[stanza['id']] = (future, action, stanza, now)
+            for entry in dropped:
+                self._record(entry[1], 'dropped')
+
+        self._fail(expired)
+        for entry in dropped:
+            entry[0].cancel()
+        return future
+
+    def mark_sent(self, iq_id, now=None):
+        """
+        Mark the tracked stanza as being actually sent, such as after it
+        was held up by the outbound queue.
+        """
+
+        if now is None:
+            now = time()
+        with self.lock:
+            entry = self.pending.pop(iq_id, None)
+            if entry is not None:
+                self.pending[iq_id] = entry[:3] + (now,)
+
+    def receive(self, stanza, now=None):
+        """
+        Handle a result or error iq stanza received.
+        """
+
+        if now is None:
+            now = time()
+        with self.lock:
+            entry = self.pending.pop(stanza['id'], None)
+            if entry is None:
+                return
+            future, action, sent_stanza, sent = entry
+            result = 'error' if stanza['type'] == 'error' else 'result'
+            histogram = self.histograms.get(action)
+            if histogram is None:
+                histogram = self.histograms[action] = Histogram()
+            histogram.add(now - sent)
+            self._record(action, result)
+
+        if result == 'error':
+            logger.warning('%s failed: %s', action,
+                stanza['error']['condition'])
+            _resolve(future, exception=IqError(stanza))
+        else:
+            _resolve(future, stanza)
+
+    def _expire(self, now):
+        expired = []
+        pending = self.pending
+        while pending:
+            iq_id = next(iter(pending))
+            entry = pending[iq_id]
+            if entry[3] + self.timeout > now:
+                break
+            del pending[iq_id]
+            self._record(entry[1], 'timeout')
+            expired.append(entry)
+        return expired
+
+    def _fail(self, expired):
+        for future, action, stanza, sent in expired:
+            logger.warning('%s timed out: %s', action, stanza['id'])
+            _resolve(future, exception=IqTimeout(stanza))
+
+    def expire(self, now=None):
+        """
+        Fail the futures for the stanzas with no response received
+        within the timeout.
+        """
+
+        if now is None:
+            now = time()
+        with self.lock:
+            expired = self._expire(now)
+        self._fail(expired)
+
+    def cancel_all(self):
+        """
+        Stop tracking everything, cancelling all pending futures.
+        """
+
+        with self.lock:
+            entries = list(self.pending.values())
+            self.pending.clear()
+        for entry in entries:
+            entry[0].cancel()
+
+    def stats(self):
+        """
+        Return the counts of the results and the latency statistics of
+        the responses for each of the actions.
+        """
+
+        result = {}
+        with self.lock:
+            for action, counts in self.results.items():
+                histogram = self.histograms.get(action)
+                result[action] = dict(counts,
+                    latency=histogram and histogram.stats())
+        return result
@@ -1,20 +1,35 @@
-import importlib
-from imp import reload
+import copy
 import logging
 import re
 import json
 import random
 import sys
-from collections import deque
 from functools import partial
+from time import time
+from xml.sax.saxutils import escape
 
 from sleekxmpp import ClientXMPP
 from sleekxmpp.xmlstream import ET
+from sleekxmpp.xmlstream.handler import Callback
+from sleekxmpp.xmlstream.matcher import StanzaPath
 
 from mtj.jibber.core import BotCore
 from mtj.jibber.core import MucBotCore
 from mtj.jibber.core import Handler
-
+from mtj.jibber.iq import IqTracker
+from mtj.jibber.loader import LazyPackage
+from mtj.jibber.loader import ModuleLoader
+from mtj.jibber.occupants import RoomOccupants
+from mtj.jibber.reply import Reply
+from mtj.jibber.trigger import TriggerTable
+from mtj.jibber.trigger import fold
+from mtj.jibber.worker import InboundQueue
+from mtj.jibber.worker import OutboundQueue
+from mtj.jibber.worker import WorkerPool
+
+from mtj.jibber.utils import LRUCache
+from mtj.jibber.utils import RecentSet
+from mtj.jibber.utils import is_html
 from mtj.jibber.utils import strip_tags
 
 logger = logging.getLogger('mtj.jibber.jabber')
@@ -23,6 +38,87 @@ if sys.version_info > (3, 0):  # pragma: no cover
     unicode = str
 
 
+def package_key(package, kwargs=None, alias=None, lazy=False):
+    """
+    Return the key identifying the instance created for the package
+    entry, which is the alias, the package and its kwargs.
+
+    >>> package_key('mod.Cls', {'b': 1, 'a': [2]}, lazy=True)
+    ('mod.Cls', 'mod.Cls', '{"a": [2], "b": 1}', True)
+    """
+
+    if alias is None:
+        alias = package
+    return (alias, package, json.dumps(kwargs or {}, sort_keys=True,
+        default=repr), bool(lazy))
+
+
+def package_class(obj):
+    if isinstance(obj, LazyPackage):
+        return obj.cls
+    return type(obj)
+
+
+class Dispatch(object):
+    """
+    A snapshot of the state used to dispatch the messages and events to
+    the packages.  A new one is built in full whenever the packages or
+    the triggers are set up and published by the bot with a single
+    reference swap, so the handlers read one consistent snapshot for
+    each message, even while the packages are being set up again.
+
+    The snapshot is never modified once published; the objects mapping
+    is built anew for every setup of the packages.
+    """
+
+    __slots__ = ('objects', 'listeners', 'raw_handlers', 'nickname',
+        'private_command_triggers', 'command_triggers',
+        'commentator_triggers')
+
+    def __init__(self, objects, listeners, raw_handlers, nickname,
+            private_command_triggers, command_triggers,
+            commentator_triggers):
+        self.objects = objects
+        self.listeners = listeners
+        self.raw_handlers = raw_handlers
+        self.nickname = nickname
+        self.private_command_triggers = private_command_triggers
+        self.command_triggers = command_triggers
+        self.commentator_triggers = commentator_triggers
+
+
+class GroupchatMessage(object):
+    """
+    A lightweight view of a groupchat message stanza, such that the
+    fields needed by the dispatch are only extracted from the stanza
+    once for all the handlers, along with the dispatch snapshot used
+    for it.
+    """
+
+    __slots__ = ('msg', 'mucnick', 'body', 'dispatch', '_mucroom',
+        '_folded')
+
+    def __init__(self, msg, dispatch=None):
+        self.msg = msg
+        self.dispatch = dispatch
+        self.mucnick = msg['mucnick']
+        self.body = msg['body']
+        self._mucroom = None
+        self._folded = None
+
+    @property
+    def mucroom(self):
+        if self._mucroom is None:
+            self._mucroom = self.msg['mucroom']
+        return self._mucroom
+
+    @property
+    def folded(self):
+        if self._folded is None:
+            self._folded = fold(self.body)
+        return self._folded
+
+
 class MucChatBot(MucBotCore):
     """
     Bot that will parse the same config for a list of regex commands and
@@ -30,6 +126,13 @@ class MucChatBot(MucBotCore):
     """
 
     _muc_setup = False
+    workers = None
+    inbound = None
+    outbound = None
+    coalesce_size = 0
+    html_cache = None
+    iq_tracker = None
+    dispatch = None
 
     def setup_client(self):
         """
@@ -43,12 +146,9 @@ class MucChatBot(MucBotCore):
         client = self.client
 
         self.groupchat_message_handlers = [
-            # bot might make fun of commands independently before doing
-            # them...  actually, might depend on how the xmpp library
-            # order this internally.
-            self.run_commentator,
-            self.run_command,
-            self.run_listener,
+            # the commentators, commands and listeners are all run by
+            # this in that order.
+            self.run_groupchat_message,
         ]
 
         self.message_handlers = [
@@ -61,6 +161,10 @@ class MucChatBot(MucBotCore):
         self.setup_events(client, [('message', f) for f in
             self.message_handlers])
 
+        self.setup_events(client, [
+            ('groupchat_presence', self.update_occupants),
+        ])
+
         if not self.nickname:
             # nickname can be undefined if normal client init workflow
             # is avoided, but we still need this available as a string.
@@ -81,6 +185,71 @@ class MucChatBot(MucBotCore):
             result = self._raw_handlers = {}
         return result
 
+    @property
+    def occupants(self):
+        # the occupant indexes for the rooms, kept up to date through
+        # the presence stanzas after being built from the roster.
+        result = getattr(self, '_occupants', None)
+        if result is None:
+            result = self._occupants = {}
+        return result
+
+    @property
+    def package_keys(self):
+        # the keys of the package entries (see `package_key`) by alias.
+        result = getattr(self, '_package_keys', None)
+        if result is None:
+            result = self._package_keys = {}
+        return result
+
+    @property
+    def previous_objects(self):
+        # the instances that may be reused by `reload_packages` by key.
+        result = getattr(self, '_previous_objects', None)
+        if result is None:
+            result = self._previous_objects = {}
+        return result
+
+    @property
+    def loader(self):
+        result = getattr(self, '_loader', None)
+        if result is None:
+            result = self._loader = ModuleLoader()
+        return result
+
+    def room_occupants(self, room):
+        """
+        Return the index of the occupants of the room (see
+        `mtj.jibber.occupants.RoomOccupants`).
+        """
+
+        index = self.occupants.get(room)
+        if index is None:
+            index = self.occupants[room] = RoomOccupants.from_roster(
+                self.muc.rooms.get(room, {}))
+        return index
+
+    def update_occupants(self, pr):
+        """
+        Update the occupant index of the room from the presence.
+        """
+
+        room = pr['from'].bare
+        nick = pr['from'].resource
+        if room not in self.occupants:
+            # will be built from the roster on demand.
+            return
+
+        if pr['type'] != 'unavailable':
+            muc = pr['muc']
+            self.occupants[room].add(nick, muc['jid'], muc['role'],
+                muc['affiliation'])
+        elif nick == self.nickname:
+            # no longer in the room.
+            del self.occupants[room]
+        else:
+            self.occupants[room].remove(nick)
+
     def clear_timers(self):
         """
         Removes _all_ timers from the scheduler.
@@ -105,7 +274,11 @@ class MucChatBot(MucBotCore):
 
         self.commands_max_match = self.config.get('commands_max_match', 1)
         self.commentary_qsize = self.config.get('commentary_qsize', 2)
+        self.commentary_window = self.config.get('commentary_window', 0)
+        self.coalesce_size = self.config.get('coalesce_size', 0)
+        self.setup_html_cache()
 
+        objects = getattr(self, 'objects', {})
         self.objects = {}
         self.clear_timers()
         self.private_commands = []
@@ -121,27 +294,423 @@ class MucChatBot(MucBotCore):
         if not self.commentary_qsize > 0:
             raise ValueError('commentary_qsize must be greater than 0')
 
-        # XXX assuming CPython implementation where this is thread-safe.
-        # As sleekxmpp is multithreaded, this may be a problem in other
-        # implementations of Python.
-        self.commentary = deque([], self.commentary_qsize)
+        self.commentary = RecentSet(self.commentary_qsize,
+            self.commentary_window)
+
+        self.setup_workers()
+        self.setup_inbound()
+        self.setup_outbound()
+        self.setup_iq_tracker()
 
+        self.package_keys.clear()
+        self.previous_objects.clear()
+        self.setup_package_entries()
+        self.setup_triggers()
+
+        for timer in self.timers.keys():
+            self.register_timer(timer)
+
+        # only closed once the new packages are in use.
+        self.close_packages(objects)
+
+    def setup_package_entries(self):
         packages = self.config.get('packages')
 
+        self.loader.begin()
         for package in packages:
             self.setup_package(**package)
+        self.loader.log_times()
 
-        for timer in self.timers.keys():
-            self.register_timer(timer)
+    def reload_packages(self):
+        """
+        Set up the packages again from the current client config, but
+        only create new instances for the package entries that have been
+        added or changed (by alias, package and kwargs) or whose module
+        has been reloaded, so the instances of the unchanged entries and
+        their timers are kept along with their state.  The instances no
+        longer used are closed.
+
+        Unlike `setup_packages`, the other settings (such as the workers
+        and the commentary) are left as they are, except for
+        `commands_max_match` and `coalesce_size`.
+
+        The reload is all or nothing: should any of the package entries
+        fail to be set up, the exception is raised with the packages,
+        their timers and the dispatch left as they were.
+        """
+
+        start = time()
+        commands_max_match = self.config.get('commands_max_match', 1)
+        coalesce_size = self.config.get('coalesce_size', 0)
+
+        objects = self.objects
+        timers = self.timers
+        new_timers = {}
+        package_keys = dict(self.package_keys)
+        triggers = (self.private_commands, self.commands, self.commentators)
+        listeners = self.listeners
+        raw_handlers = dict(self.raw_handlers)
+
+        # the setup methods add to these, so new ones are put in place
+        # for the duration of the setup and only kept if it succeeds.
+        # The timers that fire in the meantime are rescheduled from the
+        # current table, so the new one is set up on the side.
+        self.previous_objects.update((package_keys.get(alias), obj)
+            for alias, obj in objects.items())
+        self.package_keys.clear()
+        self.objects = {}
+        self._setup_timers = new_timers
+        self.private_commands = []
+        self.commands = []
+        self.listeners = []
+        self.commentators = []
+
+        for k in raw_handlers:
+            self.raw_handlers[k] = []
+
+        try:
+            self.setup_package_entries()
+        except Exception:
+            existing = set(id(obj) for obj in objects.values())
+            created = dict((alias, obj) for alias, obj in self.objects.items()
+                if id(obj) not in existing)
+            (self.private_commands, self.commands,
+                self.commentators) = triggers
+            self.objects = objects
+            self.listeners = listeners
+            # the new events have their handlers registered with the
+            # client already, so they are kept.
+            for k in self.raw_handlers:
+                self.raw_handlers[k] = raw_handlers.get(k, [])
+            self.package_keys.clear()
+            self.package_keys.update(package_keys)
+            self.previous_objects.clear()
+            self.close_packages(created)
+            raise
+        finally:
+            self._setup_timers = None
+
+        self.timers = new_timers
+        self.commands_max_match = commands_max_match
+        self.coalesce_size = coalesce_size
+        self.publish_dispatch(rebuild_triggers=triggers != (
+            self.private_commands, self.commands, self.commentators))
+
+        kept = set(alias for alias, obj in self.objects.items()
+            if objects.get(alias) is obj)
+        for timer in timers:
+            if timer not in self.timers:
+                try:
+                    self.client.scheduler.remove(str(timer))
+                except ValueError:
+                    pass
+        for timer, value in self.timers.items():
+            if timers.get(timer) != value or timer[0] not in kept:
+                self.register_timer(timer)
+
+        removed = list(self.previous_objects.items())
+        self.previous_objects.clear()
+        for key, obj in removed:
+            try:
+                obj.close()
+            except Exception:
+                logger.exception('Failed to close package `%s`',
+                    key and key[0])
+
+        logger.info('reloaded packages in %.2f ms, %d of %d instances kept',
+            (time() - start) * 1000, len(kept), len(self.objects))
+
+    def close_packages(self, objects=None):
+        """
+        Close all the package instances (or the ones in objects), such
+        that they may release their resources.
+        """
+
+        if objects is None:
+            objects = getattr(self, 'objects', {})
+        for alias, obj in objects.items():
+            try:
+                obj.close()
+            except Exception:
+                logger.exception('Failed to close package `%s`', alias)
+
+    def setup_html_cache(self):
+        """
+        Set up the cache of the html rendered by `send_message`, holding
+        up to `html_cache_size` (default 128) entries as specified in
+        the client config.  A size of 0 disables the cache.
+        """
+
+        size = self.config.get('html_cache_size', 128)
+        self.html_cache = LRUCache(size) if size else None
+
+    def setup_workers(self):
+        """
+        Package methods are called directly as events are received by
+        default.  Alternatively, they may be run by a bounded pool of
+        worker threads (see `mtj.jibber.worker.WorkerPool`) configured
+        by the `workers` section of the client config, like so:
+
+            "workers": {
+                "size": 4,
+                "queue_size": 100,
+                "timeout": 30,
+                "lane_depth": 16,
+                "package_limits": {
+                    "fortune": 1
+                }
+            }
+
+        The package methods triggered by messages from the same room
+        (or sender for private messages) will have their replies sent
+        in the order the messages were received.
+
+        Note that the calls queued for the pool will count as a match
+        for `commands_max_match` as the actual result is not known.
+        """
+
+        self.stop_workers()
+
+        config = self.config.get('workers')
+        if not config:
+            return
+
+        self.workers = WorkerPool(**config)
+        self.workers.start()
+
+    def stop_workers(self, timeout=None):
+        """
+        Stop the workers, waiting up to the timeout (if any) for the
+        calls already queued to be done.
+        """
+
+        if self.workers is not None:
+            self.workers.stop()
+            if timeout is not None and not self.workers.join(timeout):
+                logger.warning('workers not done in %s seconds', timeout)
+            self.workers = None
+
+    def setup_inbound(self):
+        """
+        Groupchat messages are dispatched as they are received by
+        default.  Alternatively, they may be queued up to be dispatched
+        by a separate thread, such that messages can be shed when the
+        bot is flooded, configured by the `inbound` section of the
+        client config, like so:
+
+            "inbound": {
+                "size": 1000,
+                "room_size": 200,
+                "policy": "drop_listeners"
+            }
+
+        See `mtj.jibber.worker.InboundQueue` for the policies.
+        """
+
+        self.stop_inbound()
+
+        config = self.config.get('inbound')
+        if not config:
+            return
+
+        self.inbound = InboundQueue(self.dispatch_groupchat_message,
+            **config)
+        self.inbound.start()
+
+    def stop_inbound(self, timeout=None):
+        """
+        Stop the inbound queue, waiting up to the timeout (if any) for
+        the messages already queued to be dispatched.
+        """
+
+        if self.inbound is not None:
+            self.inbound.stop()
+            if timeout is not None and not self.inbound.join(timeout):
+                logger.warning('inbound queue not drained in %s seconds; '
+                    '%d messages left', timeout, len(self.inbound))
+            self.inbound = None
+
+    def setup_outbound(self):
+        """
+        Messages are sent as soon as they are generated by default.
+        Alternatively, they may be queued up to be sent by a separate
+        thread at a limited rate per destination and overall, using
+        token buckets configured by the `outbound` section of the
+        client config, like so:
+
+            "outbound": {
+                "rate": 1,
+                "burst": 5,
+                "global_rate": 10,
+                "global_burst": 20
+            }
+
+        Stanzas sent as priority (such as the admin queries) will be
+        sent ahead of everything else.
+        """
+
+        self.stop_outbound()
+
+        config = self.config.get('outbound')
+        if not config:
+            return
+
+        self.outbound = OutboundQueue(**config)
+        self.outbound.start()
+
+    def stop_outbound(self, timeout=None):
+        """
+        Stop the outbound queue, waiting up to the timeout (if any) for
+        the messages already queued to be sent.
+        """
+
+        if self.outbound is not None:
+            self.outbound.stop()
+            if timeout is not None and not self.outbound.join(timeout):
+                logger.warning('outbound queue not drained in %s seconds; '
+                    '%d messages dropped', timeout, len(self.outbound))
+            self.outbound = None
+
+    _iq_tracker_name = 'jibber iq tracker'
+    _iq_tracker_types = ('result', 'error')
+
+    def setup_iq_tracker(self):
+        """
+        Responses to the iq stanzas sent (such as the admin queries) are
+        not tracked by default.  Tracking (see `mtj.jibber.iq.IqTracker`)
+        can be configured by the `iq_tracker` section of the client
+        config, like so:
+
+            "iq_tracker": {
+                "timeout": 30,
+                "max_pending": 1000,
+                "interval": 5
+            }
+
+        When set up, `send_stanza` will return a future for the response
+        to the iq stanzas sent for an action.
+        """
+
+        self.stop_iq_tracker()
+
+        config = self.config.get('iq_tracker')
+        if not config:
+            return
+
+        self.iq_tracker = tracker = IqTracker(**config)
+        for iq_type in self._iq_tracker_types:
+            # the client only removes the first handler with a name.
+            self.client.register_handler(Callback(
+                '%s %s' % (self._iq_tracker_name, iq_type),
+                StanzaPath('iq@type=%s' % iq_type), tracker.receive))
+        self.client.schedule(self._iq_tracker_name, tracker.interval,
+            tracker.expire, repeat=True)
+
+    def stop_iq_tracker(self):
+        if self.iq_tracker is not None:
+            for iq_type in self._iq_tracker_types:
+                self.client.remove_handler(
+                    '%s %s' % (self._iq_tracker_name, iq_type))
+            try:
+                self.client.scheduler.remove(self._iq_tracker_name)
+            except ValueError:
+                pass
+            self.iq_tracker.cancel_all()
+            self.iq_tracker = None
+
+    def disconnect(self):
+        """
+        Stop the queues and the workers, and close the packages before
+        disconnecting the client.  The messages and calls already queued
+        up are done first, waiting up to `shutdown_timeout` (default 5)
+        seconds for each of the queues as specified in the client config.
+        """
+
+        timeout = self.config.get('shutdown_timeout', 5)
+        self.stop_inbound(timeout)
+        self.stop_workers(timeout)
+        self.stop_outbound(timeout)
+        self.stop_iq_tracker()
+        self.close_packages()
+        super(MucChatBot, self).disconnect()
+
+    def setup_triggers(self):
+        """
+        Build the compiled trigger tables for the private commands, and
+        the commands and the commentators using the current nickname,
+        and publish them along with the rest of the dispatch state.
+        """
+
+        self.publish_dispatch()
+
+    def publish_dispatch(self, rebuild_triggers=True):
+        """
+        Publish a new `Dispatch` snapshot of the objects, listeners, raw
+        handlers and trigger tables, with the trigger tables of the
+        current snapshot reused unless rebuild_triggers is set or the
+        nickname has changed.
+        """
+
+        current = self.dispatch
+        if (rebuild_triggers or current is None or
+                current.nickname != self.nickname):
+            triggers = (
+                TriggerTable(self.private_commands),
+                TriggerTable(self.commands, self.nickname),
+                TriggerTable(self.commentators, self.nickname),
+            )
+        else:
+            triggers = (
+                current.private_command_triggers,
+                current.command_triggers,
+                current.commentator_triggers,
+            )
+
+        self.dispatch = Dispatch(
+            self.objects,
+            tuple(self.listeners),
+            dict((event, tuple(handlers))
+                for event, handlers in self.raw_handlers.items()),
+            self.nickname,
+            *triggers
+        )
+
+    @property
+    def private_command_triggers(self):
+        return self.dispatch.private_command_triggers
+
+    @property
+    def command_triggers(self):
+        return self.dispatch.command_triggers
+
+    @property
+    def commentator_triggers(self):
+        return self.dispatch.commentator_triggers
+
+    def check_triggers(self):
+        """
+        Rebuild the trigger tables if the nickname has changed since
+        they were last built.
+        """
+
+        dispatch = self.dispatch
+        if dispatch is None or dispatch.nickname != self.nickname:
+            self.setup_triggers()
+
+    def setup_package(self, package, kwargs=None, alias=None, lazy=False,
+            **configs):
+        """
+        Set up the package, which is instantiated with the kwargs.  If
+        lazy is set, the instance will only be created when it is first
+        needed by one of its handlers.
+        """
 
-    def setup_package(self, package, kwargs=None, alias=None, **configs):
         if kwargs is None:
             kwargs = {}
 
         ns, clsname = package.rsplit('.', 1)
-        mod = importlib.import_module(ns)
-        # force module reloading.
-        mod = reload(mod)
+        # only reloaded if the module has changed.
+        mod = self.loader.load(ns)
         cls = getattr(mod, clsname)
 
         if not issubclass(cls, Handler):
@@ -150,13 +719,36 @@ class MucChatBot(MucBotCore):
                 package)
             return
 
-        obj = cls(**kwargs)
         if alias is None:
             alias = package
-        self.objects[alias] = obj
+        key = package_key(package, kwargs, alias, lazy)
+        previous = self.previous_objects.get(key)
+        if previous is not None and package_class(previous) is cls:
+            # unchanged since the packages were last set up.
+            del self.previous_objects[key]
+            self.objects[alias] = previous
+        elif lazy:
+            self.objects[alias] = LazyPackage(cls, kwargs, alias)
+        else:
+            self.objects[alias] = cls(**kwargs)
+        self.package_keys[alias] = key
 
         self.setup_package_instance(alias, **configs)
 
+    def package_object(self, alias, dispatch=None):
+        """
+        Return the instance of the package with the alias from the
+        dispatch snapshot (the current one by default), creating it if
+        the package is lazy and this is the first time it is needed.
+        """
+
+        if dispatch is None:
+            dispatch = self.dispatch
+        obj = dispatch.objects[alias]
+        if isinstance(obj, LazyPackage):
+            return obj.resolve()
+        return obj
+
     def setup_package_instance(self, package, **configs):
         # XXX the parameter `package` was really mapped to a package, but
         # is now a name.
@@ -253,17 +845,21 @@ class MucChatBot(MucBotCore):
             self.setup_schedule(package, **timer)
 
     def setup_schedule(self, package, schedule, **msg_kwargs):
+        # the table being set up by `reload_packages`, if any.
+        timers = getattr(self, '_setup_timers', None)
+        if timers is None:
+            timers = self.timers
         for schedule in schedule:
             seconds = schedule['seconds']
             method = schedule['method']
             if isinstance(seconds, int):
-                self.timers[(package, method)] = (seconds, msg_kwargs)
+                timers[(package, method)] = (seconds, msg_kwargs)
                 continue
 
             try:
                 x, y = seconds
                 if isinstance(x, int) and isinstance(y, int):
-                    self.timers[(package, method)] = ((x, y), msg_kwargs)
+                    timers[(package, method)] = ((x, y), msg_kwargs)
                     continue
             except (ValueError, TypeError):
                 pass
@@ -303,85 +899,130 @@ class MucChatBot(MucBotCore):
     def run_private_command(self, msg):
         if msg.get('type') != 'chat':
             return
-        for rawregex, package, method in self.private_commands:
-            logger.debug('received:%s', msg)
-            regex = re.compile(rawregex, re.IGNORECASE)
-            match = regex.search(msg['body'])
-            if not match:
-                continue
+
+        dispatch = self.dispatch
+        body = msg['body']
+        triggers = dispatch.private_command_triggers
+        candidates = triggers.candidates(body)
+        if not candidates:
+            # nothing this sender said could possibly match.
+            return
+
+        logger.debug('received:%s', msg)
+        for match, package, method in triggers.search(body, candidates):
             self.send_package_method(package, method, msg=msg, match=match,
-                mto=msg.get('from'))
+                mto=msg.get('from'), dispatch=dispatch)
+
+    def run_groupchat_message(self, msg):
+        """
+        Run the commentators, commands and listeners against the
+        groupchat message, in that order.  The bot might make fun of
+        commands independently before doing them.
+
+        If the inbound queue is set up, the message is queued up for
+        the dispatch instead.
+        """
+
+        self.check_triggers()
+        view = GroupchatMessage(msg)
+
+        inbound = self.inbound
+        if inbound is None:
+            return self.dispatch_groupchat_message(view)
+
+        droppable = False
+        if inbound.policy == 'drop_listeners':
+            dispatch = self.dispatch
+            droppable = not (
+                dispatch.command_triggers.candidates(
+                    view.body, view.folded) or
+                dispatch.commentator_triggers.candidates(
+                    view.body, view.folded)
+            )
+        inbound.put(view.mucroom, view, droppable)
+
+    def dispatch_groupchat_message(self, view):
+        """
+        Run the phases against the view of the groupchat message, all
+        using the dispatch snapshot current at the start.
+        """
+
+        view.dispatch = self.dispatch
+        for phase in self._groupchat_phases:
+            try:
+                phase(self, view)
+            except Exception:
+                logger.exception('Error running %s', phase.__name__)
 
     def run_command(self, msg):
-        if msg['mucnick'] == self.nickname:
+        self.check_triggers()
+        self._run_command(GroupchatMessage(msg, self.dispatch))
+
+    def _run_command(self, view):
+        if view.mucnick == self.nickname:
             return
 
         matched = 0
-        for command, package, method in self.commands:
+        for match, package, method in view.dispatch.command_triggers.search(
+                view.body, folded=view.folded):
             if matched >= self.commands_max_match:
                 break
 
-            # nickname may have changed?
-            rawregex = command % {
-                'nickname': self.nickname,
-            }
-            regex = re.compile(rawregex, re.IGNORECASE)
-
-            match = regex.search(msg['body'])
-            if not match:
-                continue
-
-            if self.send_package_method(package, method, msg=msg, match=match,
-                    mto=msg['mucroom'], mtype='groupchat'):
+            if self.send_package_method(package, method, msg=view.msg,
+                    match=match, mto=view.mucroom, mtype='groupchat',
+                    dispatch=view.dispatch):
                 # Okay we have a match.
                 matched += 1
 
     def run_listener(self, msg):
-        if msg['mucnick'] == self.nickname:
+        self._run_listener(GroupchatMessage(msg, self.dispatch))
+
+    def _run_listener(self, view):
+        if view.mucnick == self.nickname:
             # never listen to self.
             return
 
-        for package, method in self.listeners:
-            f = getattr(self.objects[package], method)
+        msg = view.msg
+        dispatch = view.dispatch
+        for package, method in dispatch.listeners:
             try:
+                f = getattr(self.package_object(package, dispatch), method)
                 f(msg=msg, bot=self)
             except:
                 logger.exception('Error calling listener')
 
     def run_commentator(self, msg):
+        self.check_triggers()
+        self._run_commentator(GroupchatMessage(msg, self.dispatch))
+
+    def _run_commentator(self, view):
         # verify that this message is not generated by recent commentary
         # made by this bot, even though (meta)*commentator may be a
         # hilarious concept to some.
 
         # Only comment once, so do so carefully.
 
-        if msg['mucnick'] == self.nickname and msg['body'] in self.commentary:
+        if view.mucnick == self.nickname and view.body in self.commentary:
             return
 
-        for command, package, method in self.commentators:
-            # nickname may have changed?
-            rawregex = command % {
-                'nickname': self.nickname,
-            }
-            regex = re.compile(rawregex, re.IGNORECASE)
+        dispatch = view.dispatch
+        for match, package, method in dispatch.commentator_triggers.search(
+                view.body, folded=view.folded):
+            sent_msg = self._send_package_method(
+                self.process_commentary, package, method, msg=view.msg,
+                match=match, mto=view.mucroom, mtype='groupchat',
+                dispatch=dispatch)
 
-            match = regex.search(msg['body'])
-            if not match:
-                continue
-
-            sent_msg = self.send_package_method(
-                package, method, msg=msg, match=match,
-                mto=msg['mucroom'], mtype='groupchat')
-
-            # XXX will NOT work if a list.  Need to extract the
-            # actual body of the messages.
             if sent_msg:
-                # remember what we said
-                if type(sent_msg) in (str, unicode):
-                    self.commentary.append(sent_msg)
                 # and we are done; maximum one commentary for now.
                 break
 
+    _groupchat_phases = (
+        _run_commentator,
+        _run_command,
+        _run_listener,
+    )
+
     def run_timer(self, method, args, kwargs):
         result = method(*args, **kwargs)
         return result
@@ -389,12 +1030,17 @@ class MucChatBot(MucBotCore):
     def run_raw_handler(self, event, msg):
         # XXX log multiple calls with same msg?
         # XXX warn for missing event key in raw_handlers?
-        for package, method_names in self.raw_handlers.get(event, {}):
+        dispatch = self.dispatch
+        for package, method_names in dispatch.raw_handlers.get(event, ()):
+            try:
+                obj = self.package_object(package, dispatch)
+            except:
+                logger.exception('Failed to set up package %s', package)
+                continue
             for method_name in method_names:
-                f = getattr(self.objects[package], method_name, None)
+                f = getattr(obj, method_name, None)
                 if not f:
-                    logger.error('%s.%s does not exist.',
-                        self.objects[package], method_name)
+                    logger.error('%s.%s does not exist.', obj, method_name)
                     continue
                 try:
                     f(msg=msg, bot=self)
@@ -405,15 +1051,37 @@ class MucChatBot(MucBotCore):
     def _send_package_method(self, message_processor, package, method,
             **kwargs):
 
+        dispatch = kwargs.pop('dispatch', None)
         try:
-            f = getattr(self.objects[package], method)
-            msg = kwargs.pop('msg', {})
-            match = kwargs.pop('match', None)
-            raw_reply = f(msg=msg, match=match, bot=self)
+            f = getattr(self.package_object(package, dispatch), method)
         except:
             logger.exception('Failed to send_package_method')
             return
 
+        msg = kwargs.pop('msg', {})
+        match = kwargs.pop('match', None)
+        call = partial(f, msg=msg, match=match, bot=self)
+        callback = partial(self._process_package_method, message_processor,
+            package, method, kwargs)
+
+        if self.workers is not None:
+            # replies to the same destination are processed in order;
+            # this is the room for groupchat messages and the sender
+            # for private messages.
+            lane = kwargs.get('mto')
+            lane = getattr(lane, 'bare', lane)
+            return self.workers.submit(package, call, callback, lane=lane)
+
+        try:
+            raw_reply = call()
+        except:
+            logger.exception('Failed to send_package_method')
+            return
+
+        return callback(raw_reply)
+
+    def _process_package_method(self, message_processor, package, method,
+            kwargs, raw_reply):
         message_processor(raw_reply, **kwargs)
 
         # reset the timer if it's in timer; this is useful if there
@@ -428,10 +1096,74 @@ class MucChatBot(MucBotCore):
         return self._send_package_method(self.process_send_requests,
             package, method, **kwargs)
 
+    def process_commentary(self, raw_reply, **kwargs):
+        """
+        Remember the commentary before sending it, so the bot will not
+        comment on its own commentary.  The bodies remembered are those
+        of the messages as they will be sent, after coalescing.
+        """
+
+        raw_reply = self.prepare_replies(raw_reply, kwargs)
+        for body in self.reply_bodies(raw_reply):
+            self.commentary.add(body)
+        self.send_replies(raw_reply, kwargs)
+
+    def reply_bodies(self, raw_reply):
+        """
+        Return the plain text bodies of the messages that will be sent
+        for the result returned by a package method, which is how the
+        bot will hear them back.
+        """
+
+        def body_of(raw):
+            if is_html(raw):
+                text = self.render_html(raw)[1]
+                if text is not None:
+                    return text
+            return raw
+
+        parts = raw_reply if isinstance(raw_reply, list) else [raw_reply]
+        bodies = []
+        for part in parts:
+            if isinstance(part, dict):
+                body = part.get('mbody')
+                if type(body) not in (str, unicode):
+                    body = part.get('raw')
+                    if type(body) in (str, unicode):
+                        body = body_of(body)
+            elif isinstance(part, Reply):
+                body = part.plain
+            elif type(part) in (str, unicode):
+                body = body_of(part)
+            else:
+                continue
+            if body and type(body) in (str, unicode):
+                bodies.append(body)
+        return bodies
+
     def process_send_requests(self, raw_reply, **kwargs):
         """
         Process the result returned by the package methods.  This will
-        in turn call send_message as appropriate for replies.
+        in turn call send_message as appropriate for replies, or
+        send_reply for `mtj.jibber.reply.Reply` instances.
+        """
+
+        self.send_replies(self.prepare_replies(raw_reply, kwargs), kwargs)
+
+    def prepare_replies(self, raw_reply, kwargs):
+        """
+        Return the result returned by a package method with the lists
+        of replies coalesced, if enabled.
+        """
+
+        if isinstance(raw_reply, list) and self.coalesce_size:
+            return self.coalesce_replies(raw_reply, kwargs)
+        return raw_reply
+
+    def send_replies(self, raw_reply, kwargs):
+        """
+        Send the result returned by a package method, as prepared by
+        `prepare_replies`.
         """
 
         def send_raw(raw_reply):
@@ -445,6 +1177,8 @@ class MucChatBot(MucBotCore):
                 self.send_message(raw=raw_reply, **kwargs)
             elif isinstance(raw_reply, dict):
                 send_raw(raw_reply)
+            elif isinstance(raw_reply, Reply):
+                self.send_reply(raw_reply, **kwargs)
 
         if isinstance(raw_reply, list):
             for r in raw_reply:
@@ -452,6 +1186,113 @@ class MucChatBot(MucBotCore):
         else:
             send_check(raw_reply)
 
+    def coalesce_replies(self, replies, kwargs):
+        """
+        Merge the consecutive parts of a list of replies that will be
+        sent to the same destination with the same arguments into one,
+        up to `coalesce_size` characters.  Plain text will be joined by
+        newlines; if there are html among the parts, they will be joined
+        by `<br/>` inside a body element with the plain text provided as
+        the mbody.  Parts that explicitly specify the mbody or mhtml are
+        left as they are.
+        """
+
+        result = []
+        group = []
+        group_args = {}
+
+        def flush():
+            if len(group) == 1:
+                result.append(dict(group_args, raw=group[0]))
+            elif group:
+                raw = '\n'.join(group)
+                reply = dict(group_args, raw=raw)
+                if any(is_html(part) for part in group):
+                    reply['raw'] = '<body>%s</body>' % '<br/>'.join(
+                        part if is_html(part) else escape(part)
+                        for part in group)
+                    reply['mbody'] = '\n'.join(
+                        self.html_text(part) if is_html(part) else part
+                        for part in group)
+                result.append(reply)
+            del group[:]
+
+        size = 0
+        for reply in replies:
+            if type(reply) in (str, unicode):
+                args = {}
+                raw = reply
+            elif isinstance(reply, dict) and (
+                    type(reply.get('raw')) in (str, unicode)) and not (
+                    'mbody' in reply or 'mhtml' in reply):
+                args = dict(reply)
+                raw = args.pop('raw')
+            else:
+                flush()
+                result.append(reply)
+                continue
+
+            merged = dict(kwargs)
+            merged.update(args)
+            if group and (merged != group_args or
+                    size + len(raw) + 1 > self.coalesce_size):
+                flush()
+            if not group:
+                group_args = merged
+                size = 0
+            group.append(raw)
+            size += len(raw) + 1
+
+        flush()
+        return result
+
+    def html_text(self, html):
+        """
+        Return the html with its tags stripped, with the result kept in
+        the html cache alongside the ones from `render_html`.
+        """
+
+        cache = self.html_cache
+        if cache is None:
+            return strip_tags(html)
+
+        key = ('text', html)
+        text = cache.get(key)
+        if text is None:
+            text = strip_tags(html)
+            cache.put(key, text)
+        return text
+
+    def render_html(self, html):
+        """
+        Return the element parsed from the html along with the html
+        with its tags stripped, or `(None, None)` if it cannot be
+        parsed.  The results for strings are kept in the html cache so
+        repeated html will not be parsed again; the cached element is
+        copied before it is returned so it will not be modified by the
+        sending of the message.
+        """
+
+        cache = self.html_cache
+        if cache is None or type(html) not in (str, unicode):
+            try:
+                return ET.XML(html), strip_tags(html)
+            except ET.ParseError:
+                return None, None
+
+        result = cache.get(html)
+        if result is None:
+            try:
+                result = (ET.XML(html), strip_tags(html))
+            except ET.ParseError:
+                result = (None, None)
+            cache.put(html, result)
+
+        element, text = result
+        if element is not None:
+            element = copy.deepcopy(element)
+        return element, text
+
     def send_message(self, mto, raw=None, **kwargs):
         """
         Shorthanded send_message method that will auto-detect input and
@@ -499,22 +1340,14 @@ class MucChatBot(MucBotCore):
 
         if mhtml is None and type(raw) in (str, unicode):
             # figure out if we can coerce the raw string into html
-            # just check first-n characters.
-            ss = raw[:10].lower()
-            checks = ('<p>', '<html>', '<body>',)
-
-            if any((ss.startswith(check) for check in checks)):
+            if is_html(raw):
                 # raw is an html candidate.
                 mhtml = raw
 
         # now attempt html conversion.
         if not mhtml is None:
-            try:
-                mhtml = ET.XML(mhtml)
-                if _mbody is None:
-                    # mbody not explicitly defined
-                    mbody = strip_tags(raw)
-            except ET.ParseError:
+            html, text = self.render_html(mhtml)
+            if html is None:
                 logger.warning(
                     'An attempt to send the following as html has failed.'
                     '----------\n%s'
@@ -523,7 +1356,28 @@ class MucChatBot(MucBotCore):
                 )
                 # no more html
                 mhtml = None
+            else:
+                if _mbody is None:
+                    # mbody not explicitly defined
+                    mbody = text if raw == mhtml else strip_tags(raw)
+                mhtml = html
+
+        send = partial(self._client_send_message, mto, mbody, mhtml, kwargs)
+        if self.outbound is not None:
+            self.outbound.put(getattr(mto, 'bare', mto), send)
+            return
+        send()
+
+    def send_reply(self, reply, **kwargs):
+        """
+        Send the reply (a `mtj.jibber.reply.Reply`) as a message stanza
+        with its html element and plain text as they are, such that no
+        parsing will be needed.
+        """
 
+        self.send_stanza(reply.message(**kwargs))
+
+    def _client_send_message(self, mto, mbody, mhtml, kwargs):
         try:
             # TODO verify that values to be sent doesn't have control
             # characters which cause disconnection?  At least no more
@@ -537,3 +1391,33 @@ class MucChatBot(MucBotCore):
                 'mhtml': mhtml,
                 'kwargs': kwargs,
             })
+
+    def send_stanza(self, stanza, priority=False, action=None):
+        """
+        Send a raw stanza, such as the admin queries generated by the
+        `mtj.jibber.stanza` module.  If the outbound queue is set up,
+        the stanza will be queued up, ahead of the other messages if
+        priority is specified.
+
+        If the iq tracker is set up and an action is specified for an
+        iq stanza, a future for the response will be returned.
+        """
+
+        future = None
+        send = partial(self.client.send, stanza)
+        tracker = self.iq_tracker
+        if tracker is not None and action is not None:
+            future = tracker.track(stanza, action)
+            send = partial(self._send_tracked, tracker, stanza)
+
+        if self.outbound is not None:
+            to = stanza['to']
+            self.outbound.put(getattr(to, 'bare', to), send,
+                priority=priority)
+        else:
+            send()
+        return future
+
+    def _send_tracked(self, tracker, stanza):
+        tracker.mark_sent(stanza['id'])
+        self.client.send(stanza)
@@ -0,0 +1,165 @@
+import hashlib
+import importlib
+import logging
+import os
+import threading
+from time import time
+
+try:
+    from importlib import reload
+except ImportError:  # pragma: no cover
+    from imp import reload
+
+logger = logging.getLogger('mtj.jibber.loader')
+
+
+def source_path(module):
+    """
+    Return the path to the source file of the module, or None if it
+    does not have one (such as builtin modules).
+    """
+
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+def _signature(path):
+    # the modification time and the digest of the source file, or None
+    # if it cannot be read.
+    if path is None:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as fd:
+            digest = hashlib.sha1(fd.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+    return (mtime, digest)
+
+
+class ModuleLoader(object):
+    """
+    Import the modules for the packages, each at most once for every
+    setup pass, and only reload them when their source file has changed
+    since they were last loaded.  The modification time of the file is
+    checked first, with the digest of its contents confirming whether
+    the file has actually changed.
+
+    >>> loader = ModuleLoader()
+    >>> loader.begin()
+    >>> loader.load('mtj.jibber.utils').__name__
+    'mtj.jibber.utils'
+    >>> loader.load('mtj.jibber.utils') is loader.load('mtj.jibber.utils')
+    True
+    >>> sorted(loader.times)
+    ['mtj.jibber.utils']
+    """
+
+    def __init__(self):
+        # name: (mtime, digest) of the source when last loaded.
+        self.signatures = {}
+        # name: (seconds, reloaded) for the current setup pass.
+        self.times = {}
+
+    def begin(self):
+        """
+        Begin a setup pass, such that the modules will be checked for
+        changes again.
+        """
+
+        self.times = {}
+
+    def load(self, name):
+        """
+        Return the module with the name, reloading it if its source has
+        changed since it was last loaded.
+        """
+
+        if name in self.times:
+            return importlib.import_module(name)
+
+        start = time()
+        module = importlib.import_module(name)
+        path = source_path(module)
+        reloaded = False
+
+        if name not in self.signatures:
+            self.signatures[name] = _signature(path)
+        elif path is not None:
+            known = self.signatures[name]
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+            if known is None or mtime != known[0]:
+                signature = _signature(path)
+                if known is None or signature is None or (
+                        signature[1] != known[1]):
+                    module = reload(module)
+                    reloaded = True
+                self.signatures[name] = signature
+
+        self.times[name] = (time() - start, reloaded)
+        return module
+
+    def log_times(self):
+        """
+        Log the time taken to load each of the modules in this pass.
+        """
+
+        for name, (seconds, reloaded) in sorted(self.times.items()):
+            logger.info('%s module `%s` in %.2f ms',
+                'reloaded' if reloaded else 'loaded', name, seconds * 1000)
+
+
+class LazyPackage(object):
+    """
+    A placeholder for a package that is only instantiated when it is
+    first needed, for the packages with the `lazy` flag set in the
+    client config.
+
+    >>> from mtj.jibber.core import Handler
+    >>> package = LazyPackage(Handler, {}, 'handler')
+    >>> print(package.obj)
+    None
+    >>> package.resolve() is package.resolve()
+    True
+    """
+
+    def __init__(self, cls, kwargs, alias):
+        self.cls = cls
+        self.kwargs = kwargs
+        self.alias = alias
+        self.obj = None
+        self.lock = threading.Lock()
+        self.created = time()
+
+    def resolve(self):
+        """
+        Return the instance of the package, creating it if this is the
+        first time it is needed.  Should the creation fail, it will be
+        attempted again on the next call.
+        """
+
+        obj = self.obj
+        if obj is not None:
+            return obj
+
+        with self.lock:
+            if self.obj is None:
+                start = time()
+                self.obj = self.cls(**self.kwargs)
+                logger.info('instantiated lazy package `%s` in %.2f ms, '
+                    '%.2f s after it was set up', self.alias,
+                    (time() - start) * 1000, start - self.created)
+            return self.obj
+
+    def close(self):
+        with self.lock:
+            obj = self.obj
+        if obj is not None:
+            obj.close()
@@ -0,0 +1,201 @@
+import logging
+
+logger = logging.getLogger('mtj.jibber.occupants')
+
+
+def _bare(jid):
+    # the bare jid as a string, or None for rooms that do not reveal the
+    # jids of the occupants.
+    return getattr(jid, 'bare', jid) or None
+
+
+class IndexedSet(object):
+    """
+    A set that also keeps its members in a list, such that a random
+    member can be picked in constant time with `random.choice`.  The
+    members are removed by swapping the last one into their place, so
+    the order is not preserved.
+
+    >>> members = IndexedSet(['a', 'b', 'c'])
+    >>> members.remove('a')
+    >>> sorted(members), len(members), 'a' in members
+    (['b', 'c'], 2, False)
+    >>> members[0]
+    'c'
+    """
+
+    def __init__(self, members=()):
+        self.members = []
+        self.positions = {}
+        for member in members:
+            self.add(member)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        return member in self.positions
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __getitem__(self, position):
+        return self.members[position]
+
+    def add(self, member):
+        if member in self.positions:
+            return
+        self.positions[member] = len(self.members)
+        self.members.append(member)
+
+    def remove(self, member):
+        position = self.positions.pop(member)
+        last = self.members.pop()
+        if position < len(self.members):
+            self.members[position] = last
+            self.positions[last] = position
+
+    def discard(self, member):
+        if member in self.positions:
+            self.remove(member)
+
+
+class RoomOccupants(object):
+    """
+    An index of the occupants of a room, mapping the nicks to their
+    bare jids and the bare jids to the set of nicks they are using,
+    along with the sets of nicks for each role and affiliation.
+
+    >>> room = RoomOccupants()
+    >>> room.add('Rob', 'rob@example.com', 'moderator', 'owner')
+    >>> room.add('The Robot', 'rob@example.com', 'participant')
+    >>> room.add('Anon', None, 'visitor')
+    >>> sorted(room.nicks_of('rob@example.com'))
+    ['Rob', 'The Robot']
+    >>> room.jid_of('Rob'), room.role_of('Rob'), room.affiliation_of('Rob')
+    ('rob@example.com', 'moderator', 'owner')
+    >>> list(room.with_role('participant'))
+    ['The Robot']
+    >>> room.add('The Robot', 'rob@example.com', 'moderator')
+    >>> sorted(room.with_role('moderator')), len(room.with_role('participant'))
+    (['Rob', 'The Robot'], 0)
+    >>> room.remove('Rob')
+    >>> sorted(room.nicks_of('rob@example.com'))
+    ['The Robot']
+    >>> room.remove('The Robot')
+    >>> room.has_jid('rob@example.com')
+    False
+    >>> 'Anon' in room, len(room)
+    (True, 1)
+    """
+
+    def __init__(self):
+        self.nicks = {}
+        self.jids = {}
+        # nick: role, and role: IndexedSet of nicks; likewise for the
+        # affiliations.
+        self.roles = {}
+        self.role_nicks = {}
+        self.affiliations = {}
+        self.affiliation_nicks = {}
+
+    @classmethod
+    def from_roster(cls, roster):
+        """
+        Build the index from the roster of the room as tracked by the
+        muc plugin, which maps the nicks to the details of the occupant.
+        """
+
+        index = cls()
+        for nick, details in roster.items():
+            index.add(nick, details.get('jid'), details.get('role'),
+                details.get('affiliation'))
+        return index
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def __contains__(self, nick):
+        return nick in self.nicks
+
+    def _set(self, values, sets, nick, value):
+        value = value or None
+        current = values.get(nick)
+        if nick in values and current == value:
+            return
+        if current is not None:
+            members = sets[current]
+            members.remove(nick)
+            if not members:
+                del sets[current]
+        values[nick] = value
+        if value is not None:
+            members = sets.get(value)
+            if members is None:
+                members = sets[value] = IndexedSet()
+            members.add(nick)
+
+    def _unset(self, values, sets, nick):
+        self._set(values, sets, nick, None)
+        del values[nick]
+
+    def add(self, nick, jid, role=None, affiliation=None):
+        """
+        Add the occupant with the nick, replacing the one already using
+        it, if any.  The role and the affiliation are updated if the
+        occupant is already present.
+        """
+
+        jid = _bare(jid)
+        if self.nicks.get(nick, jid) != jid:
+            self.remove(nick)
+        if nick not in self.nicks:
+            self.nicks[nick] = jid
+            if jid is not None:
+                self.jids.setdefault(jid, set()).add(nick)
+        self._set(self.roles, self.role_nicks, nick, role)
+        self._set(self.affiliations, self.affiliation_nicks, nick,
+            affiliation)
+
+    def remove(self, nick):
+        """
+        Remove the occupant with the nick, if present.
+        """
+
+        if nick not in self.nicks:
+            return
+        self._unset(self.roles, self.role_nicks, nick)
+        self._unset(self.affiliations, self.affiliation_nicks, nick)
+        jid = self.nicks.pop(nick)
+        nicks = self.jids.get(jid)
+        if nicks is None:
+            return
+        nicks.discard(nick)
+        if not nicks:
+            del self.jids[jid]
+
+    def jid_of(self, nick):
+        return self.nicks.get(nick)
+
+    def nicks_of(self, jid):
+        return self.jids.get(jid, set())
+
+    def has_jid(self, jid):
+        return jid in self.jids
+
+    def role_of(self, nick):
+        return self.roles.get(nick)
+
+    def affiliation_of(self, nick):
+        return self.affiliations.get(nick)
+
+    def with_role(self, role):
+        """
+        Return the nicks with the role as an `IndexedSet`, which may be
+        passed to `random.choice` directly.
+        """
+
+        return self.role_nicks.get(role) or IndexedSet()
+
+    def with_affiliation(self, affiliation):
+        return self.affiliation_nicks.get(affiliation) or IndexedSet()
@@ -0,0 +1,163 @@
+from sleekxmpp.stanza import Message
+from sleekxmpp.xmlstream import ET
+
+XHTML_IM_NS = 'http://jabber.org/protocol/xhtml-im'
+XHTML_NS = 'http://www.w3.org/1999/xhtml'
+
+# the keyword arguments of `client.send_message` mapped to the
+# interfaces of the message stanza.
+_message_keys = {
+    'mto': 'to',
+    'mfrom': 'from',
+    'mtype': 'type',
+    'msubject': 'subject',
+    'mnick': 'nick',
+}
+
+
+def _xhtml(tag, attrib={}):
+    return ET.Element('{%s}%s' % (XHTML_NS, tag), attrib)
+
+
+class Reply(object):
+    """
+    A reply holding both the html element and the plain text rendering
+    of the message, which package methods may return instead of a html
+    string so the bot will not have to parse the html and strip the
+    tags off it to send the message.
+
+    It may be built up using the builder methods, which all return the
+    reply for chaining.
+
+    >>> reply = Reply('Tester: ').strong('So very strong').text('.')
+    >>> reply.plain
+    'Tester: So very strong.'
+    >>> reply.html[0].tag
+    '{http://www.w3.org/1999/xhtml}strong'
+
+    Replies without any markup will be sent as plain text only.
+
+    >>> print(Reply('just text').html)
+    None
+
+    Alternatively, an existing element for the body may be provided,
+    along with its plain text rendering.  If that is omitted, the text
+    content of the element will be used.
+
+    >>> body = _xhtml('body')
+    >>> body.text = 'some html'
+    >>> Reply(html=body).plain
+    'some html'
+
+    Keyword arguments to `send_message` can be provided, which will
+    override the ones provided by the bot like the dict replies.
+
+    >>> Reply('hi', mto='someone@example.com').kwargs
+    {'mto': 'someone@example.com'}
+    """
+
+    def __init__(self, text=None, html=None, plain=None, **kwargs):
+        self.kwargs = kwargs
+        self._plain = []
+        self.markup = html is not None
+
+        if html is None:
+            html = _xhtml('body')
+        elif plain is None:
+            plain = u''.join(html.itertext())
+
+        self.body = html
+        if plain is not None:
+            self._plain.append(plain)
+        if text:
+            self.text(text)
+
+    @property
+    def plain(self):
+        return u''.join(self._plain)
+
+    @property
+    def html(self):
+        if not self.markup:
+            return None
+        return self.body
+
+    def _append_text(self, text):
+        children = list(self.body)
+        if children:
+            last = children[-1]
+            last.tail = (last.tail or '') + text
+        else:
+            self.body.text = (self.body.text or '') + text
+
+    def text(self, text):
+        """
+        Append plain text.
+        """
+
+        self._append_text(text)
+        self._plain.append(text)
+        return self
+
+    def element(self, tag, text=None, attrib={}, plain=None):
+        """
+        Append an element with the tag and its text, with the plain
+        text rendering of the element defaulting to the text.
+        """
+
+        el = _xhtml(tag, attrib)
+        el.text = text
+        self.body.append(el)
+        self.markup = True
+        if plain is None:
+            plain = text
+        if plain:
+            self._plain.append(plain)
+        return self
+
+    def strong(self, text):
+        return self.element('strong', text)
+
+    def em(self, text):
+        return self.element('em', text)
+
+    def code(self, text):
+        return self.element('code', text)
+
+    def link(self, href, text=None):
+        if text is None:
+            text = href
+            plain = href
+        else:
+            plain = '%s <%s>' % (text, href)
+        return self.element('a', text, {'href': href}, plain)
+
+    def br(self):
+        return self.element('br', plain='\n')
+
+    def message(self, **kwargs):
+        """
+        Return the message stanza for this reply, with the keyword
+        arguments for `send_message` (such as `mto`) applied.  The html
+        element is appended as is, so it will only be serialized once
+        the stanza is sent.
+
+        >>> msg = Reply('hi', mtype='chat').message(mto='a@example.com')
+        >>> msg['to'], msg['type'], msg['body']
+        (a@example.com, 'chat', 'hi')
+        """
+
+        kwargs = dict(kwargs)
+        kwargs.update(self.kwargs)
+        msg = Message()
+        for key, value in kwargs.items():
+            if key in _message_keys and value is not None:
+                msg[_message_keys[key]] = value
+        msg['body'] = self.plain
+
+        html = self.html
+        if html is not None:
+            wrapper = ET.Element('{%s}html' % XHTML_IM_NS)
+            wrapper.append(html)
+            msg.append(wrapper)
+        return msg
@@ -2,27 +2,25 @@
 from sleekxmpp.xmlstream import ET
 from sleekxmpp.stanza import Iq
 
-def admin_query(room, nick=None, jid=None, role='none', reason=None):
-    """
-    Generate an admin query stanza that will change the role of the
-    nick or the full jid within a muc.
+MUC_ADMIN_NS = 'http://jabber.org/protocol/muc#admin'
 
-    Default role is 'none', which kicks the nick/jid from the muc.
+roles = ('moderator', 'none', 'participant', 'visitor')
 
-    If only sleekxmpp provide a better support for this in their
-    xep_0045 plugin...
+
+def admin_item(nick=None, jid=None, role='none', reason=None):
+    """
+    Generate the item element of an admin query that will change the
+    role of the nick or the full jid.
     """
 
-    roles = ('moderator', 'none', 'participant', 'visitor')
     if role not in roles:
         raise TypeError('role must be one of %s' % str(roles))
 
-    query = ET.Element('{http://jabber.org/protocol/muc#admin}query')
     if nick is not None:
-        item = ET.Element('{http://jabber.org/protocol/muc#admin}item',
+        item = ET.Element('{%s}item' % MUC_ADMIN_NS,
             {'role': role, 'nick': nick})
     elif jid is not None:
-        item = ET.Element('{http://jabber.org/protocol/muc#admin}item',
+        item = ET.Element('{%s}item' % MUC_ADMIN_NS,
             {'role': role, 'jid': jid})
     else:
         raise ValueError('either nick or jid must be provided')
@@ -32,7 +30,18 @@ def admin_query(room, nick=None, jid=None, role='none', reason=None):
         el.text = reason
         item.append(el)
 
-    query.append(item)
+    return item
+
+
+def admin_items_query(room, items):
+    """
+    Generate an admin query stanza that will change the roles of all
+    the items (see `admin_item`) within a muc in one go.
+    """
+
+    query = ET.Element('{%s}query' % MUC_ADMIN_NS)
+    for item in items:
+        query.append(item)
 
     iq = Iq()
     iq.append(query)
@@ -40,3 +49,37 @@ def admin_query(room, nick=None, jid=None, role='none', reason=None):
     iq['type'] = 'set'
 
     return iq
+
+
+def admin_query(room, nick=None, jid=None, role='none', reason=None):
+    """
+    Generate an admin query stanza that will change the role of the
+    nick or the full jid within a muc.
+
+    Default role is 'none', which kicks the nick/jid from the muc.
+
+    If only sleekxmpp provide a better support for this in their
+    xep_0045 plugin...
+    """
+
+    return admin_items_query(room, [admin_item(nick, jid, role, reason)])
+
+
+def admin_queries(room, nicks=(), jids=(), role='none', reason=None,
+        chunk_size=20):
+    """
+    Return a list of admin query stanzas that will change the role of
+    all the nicks and full jids within a muc, with up to `chunk_size`
+    items packed into each of them.
+    """
+
+    if not chunk_size > 0:
+        raise ValueError('chunk_size must be greater than 0')
+
+    items = [admin_item(nick=nick, role=role, reason=reason)
+        for nick in nicks]
+    items.extend(admin_item(jid=jid, role=role, reason=reason)
+        for jid in jids)
+
+    return [admin_items_query(room, items[i:i + chunk_size])
+        for i in range(0, len(items), chunk_size)]
@@ -0,0 +1,246 @@
+"""
+Rough benchmarks for the message dispatch of the bot, using the test
+client.  Run with::
+
+    python -m mtj.jibber.testing.benchmark
+"""
+
+from __future__ import print_function
+
+import random
+import re
+import timeit
+
+from mtj.jibber.activity import ActivityStore
+from mtj.jibber.jabber import MucChatBot
+from mtj.jibber.occupants import RoomOccupants
+from mtj.jibber.testing.client import TestClient
+from mtj.jibber.utils import strip_tags
+
+test_package = 'mtj.jibber.testing.command.GreeterCommand'
+
+bodies = [
+    'just some regular chatter in the room',
+    'testbot: hi',
+    'nothing to see here, move along',
+    '!cmd500 with some arguments',
+]
+
+
+def mk_bot(n_commands, n_commentators=0, listeners=()):
+    commands = [['^!cmd%d (.*)$' % i, 'say_hi'] for i in range(n_commands)]
+    commands.append(['^%(nickname)s: hi', 'say_hi'])
+    commentators = [['comment%d' % i, 'say_hi']
+        for i in range(n_commentators)]
+    bot = MucChatBot()
+    bot.client = TestClient()
+    bot.config = {
+        'nickname': 'testbot',
+        'packages': [
+            {
+                'package': test_package,
+                'commands': commands,
+                'commentators': commentators,
+                'listeners': list(listeners),
+            },
+        ],
+    }
+    bot.setup_client()
+    return bot
+
+
+def bench_commands(sizes=(10, 100, 1000), number=1000):
+    """
+    Return a list of `(size, seconds per message)` for the groupchat
+    message dispatch through the test client for each of the sizes of
+    command lists.
+    """
+
+    results = []
+    for size in sizes:
+        bot = mk_bot(size)
+        client = bot.client
+
+        def run():
+            for body in bodies:
+                client(body)
+            client._clear()
+
+        total = timeit.timeit(run, number=number)
+        results.append((size, total / (number * len(bodies))))
+    return results
+
+
+def bench_pipeline(number=1000):
+    """
+    Return the seconds per message for running the commentators,
+    commands and listeners as separate handlers, and for running them
+    through the single groupchat message pipeline.
+    """
+
+    bot = mk_bot(100, 100, ['listener'])
+    separate = [bot.run_commentator, bot.run_command, bot.run_listener]
+    pipeline = [bot.run_groupchat_message]
+    results = []
+    for handlers in (separate, pipeline):
+        bot.client.groupchat_message_handlers = handlers
+        client = bot.client
+
+        def run():
+            for body in bodies:
+                client(body)
+            client._clear()
+            bot.objects[test_package].listened = []
+
+        total = timeit.timeit(run, number=number)
+        results.append(total / (number * len(bodies)))
+    return results
+
+
+html_sample = (
+    '<p>Tester: <strong>So very strong</strong> &amp; <em>bold</em>'
+    '<br/>with a <a href="http://example.com/">link</a>.</p>\n'
+)
+
+
+def legacy_strip_tags(html):
+    # the original implementation of `utils.strip_tags`.
+    return re.compile('<[^>]*>').sub('', html)
+
+
+def bench_strip_tags(sizes=(1024, 65536), number=100):
+    """
+    Return a list of `(size, legacy seconds, seconds)` for converting
+    html of the sizes (in characters) into plain text using the original
+    regex substitution and the current `strip_tags`.
+    """
+
+    results = []
+    for size in sizes:
+        html = (html_sample * (size // len(html_sample) + 1))[:size]
+        legacy = timeit.timeit(lambda: legacy_strip_tags(html),
+            number=number)
+        current = timeit.timeit(lambda: strip_tags(html), number=number)
+        results.append((size, legacy / number, current / number))
+    return results
+
+
+def _record_activity(jids, nicks, users, rooms=10):
+    # this mimics `LastActivity.message_recorder` with the strings built
+    # for every message as they would be when taken from the stanzas,
+    # with every user active twice.
+    for timestamp in (1400000000, 1400000100):
+        for i in range(users):
+            room = 'room%d@chat.example.com' % (i % rooms)
+            jid = 'user%d@example.com' % i
+            nick = 'User %d' % i
+            jids[(room, jid)] = (nick, timestamp)
+            nicks[(room, nick)] = (jid, timestamp)
+
+
+def bench_activity(sizes=(10000, 100000, 1000000), number=10000):
+    """
+    Return a list of `(size, dict bytes, store bytes, dict seconds,
+    store seconds)` for the memory used per tracked user and the time
+    per lookup of the last activity, with plain dicts and with the
+    `ActivityStore` for the jids and nicks.
+    """
+
+    import tracemalloc
+
+    results = []
+    for size in sizes:
+        keys = [('room%d@chat.example.com' % (i % 10), 'User %d' % i)
+            for i in random.sample(range(size), min(size, number))]
+        row = [size]
+        times = []
+        for factory in (dict, ActivityStore):
+            tracemalloc.start()
+            jids, nicks = factory(), factory()
+            _record_activity(jids, nicks, size)
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            row.append(used / float(size))
+            get = nicks.get
+            times.append(timeit.timeit(
+                lambda: [get(key) for key in keys], number=1) / len(keys))
+            del jids, nicks
+        results.append(tuple(row + times))
+    return results
+
+
+def mk_roster(size):
+    # a room with a moderator for every 20 occupants and a visitor for
+    # every 10, with the rest being participants.
+    roster = {}
+    for i in range(size):
+        role = ('moderator' if i % 20 == 0 else
+            'visitor' if i % 10 == 5 else 'participant')
+        roster['User %d' % i] = {
+            'jid': 'user%d@example.com/home' % i,
+            'role': role,
+            'affiliation': 'member' if role == 'moderator' else 'none',
+        }
+    return roster
+
+
+def legacy_random_participant(roster):
+    # the original selection done by `RandomPromotion.play`.
+    participants = [
+        nick for nick, details in roster.items()
+        if details.get('role') == 'participant'
+    ]
+    return random.choice(participants)
+
+
+def bench_occupants(sizes=(10, 100, 1000, 10000), number=1000):
+    """
+    Return a list of `(size, legacy choice seconds, choice seconds,
+    legacy role seconds, role seconds)` for picking a random participant
+    and for looking up the role of an occupant, by scanning the roster
+    of the room and through the `RoomOccupants` index.
+    """
+
+    results = []
+    for size in sizes:
+        room = 'room@chat.example.com'
+        rooms = {room: mk_roster(size)}
+        occupants = RoomOccupants.from_roster(rooms[room])
+        nick = 'User %d' % (size - 1)
+
+        legacy_choice = timeit.timeit(
+            lambda: legacy_random_participant(rooms.get(room, {})),
+            number=number)
+        choice = timeit.timeit(
+            lambda: random.choice(occupants.with_role('participant')),
+            number=number)
+        legacy_role = timeit.timeit(
+            lambda: rooms.get(room, {}).get(nick, {}).get('role'),
+            number=number)
+        role = timeit.timeit(lambda: occupants.role_of(nick), number=number)
+        results.append((size, legacy_choice / number, choice / number,
+            legacy_role / number, role / number))
+    return results
+
+
+def main():
+    for size, per_msg in bench_commands():
+        print('%5d commands: %8.2f us/message' % (size, per_msg * 1e6))
+    separate, pipeline = bench_pipeline()
+    print('separate handlers: %8.2f us/message' % (separate * 1e6))
+    print('single pipeline:   %8.2f us/message' % (pipeline * 1e6))
+    for size, legacy, current in bench_strip_tags():
+        print('strip_tags %5d chars: %8.2f us (was %8.2f us)' % (
+            size, current * 1e6, legacy * 1e6))
+    for size, d_mem, s_mem, d_time, s_time in bench_activity():
+        print('activity %7d users: %6.1f bytes/user, %5.2f us/lookup '
+            '(dict: %6.1f bytes/user, %5.2f us/lookup)' % (
+                size, s_mem, s_time * 1e6, d_mem, d_time * 1e6))
+    for size, l_choice, choice, l_role, role in bench_occupants():
+        print('occupants %5d: %8.2f us/choice (was %8.2f us), '
+            '%5.2f us/role (was %5.2f us)' % (size, choice * 1e6,
+                l_choice * 1e6, role * 1e6, l_role * 1e6))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -22,6 +22,7 @@ class TestClient(object):
     def __init__(self, *a, **kw):
         self.plugins = []
         self.events = []
+        self.handlers = []
 
         self.groupchat_message_handlers = []
         self.sent = []
@@ -61,6 +62,18 @@ class TestClient(object):
     def register_plugin(self, plugin):
         self.plugins.append(plugin)
 
+    def register_handler(self, handler):
+        self.handlers.append(handler)
+
+    def remove_handler(self, name):
+        # like the client, only the first handler with the name is
+        # removed.
+        for i, handler in enumerate(self.handlers):
+            if handler.name == name:
+                del self.handlers[i]
+                return True
+        return False
+
     def add_event_handler(self, *a):
         self.events.append(a)
         if a[0] == 'groupchat_message':
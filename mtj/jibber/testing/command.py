@@ -1,4 +1,5 @@
 from mtj.jibber.core import Command
+from mtj.jibber.reply import Reply
 
 
 class Greeter(object):
@@ -57,6 +58,12 @@ class GreeterCommand(Command, Greeter):
             },
         ]
 
+    def rich_reply(self, msg, match=None, bot=None):
+        return [
+            Reply('Hello ').strong(msg.get('mucnick', 'someone')),
+            Reply('plain', mto='beacon@example.com'),
+        ]
+
     def to_trap(self, msg, match=None, bot=None):
         return [
             {
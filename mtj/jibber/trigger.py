@@ -0,0 +1,342 @@
+import logging
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # pragma: no cover
+    import sre_parse
+
+logger = logging.getLogger('mtj.jibber.trigger')
+
+# The non-ascii characters that the re module will match against ascii
+# characters when ignoring case, mapped to their lowercase equivalent.
+_fold_table = {
+    0x0130: u'i',  # LATIN CAPITAL LETTER I WITH DOT ABOVE
+    0x0131: u'i',  # LATIN SMALL LETTER DOTLESS I
+    0x017f: u's',  # LATIN SMALL LETTER LONG S
+    0x212a: u'k',  # KELVIN SIGN
+}
+
+
+def fold(text):
+    """
+    Fold the text into the form that the extracted literals are
+    compared with.
+
+    >>> print(fold(u'Hello \u212aitty'))
+    hello kitty
+    """
+
+    return text.translate(_fold_table).lower()
+
+
+def _literal_tokens(items):
+    # generate the ascii literal characters any match of the parsed
+    # items must contain in sequence, with None marking the breaks
+    # between the runs of characters.
+    for op, av in items:
+        if op is sre_parse.LITERAL and av < 128:
+            yield chr(av)
+        elif op is sre_parse.SUBPATTERN:
+            # the content of a group is required in sequence, so the
+            # run continues through it.
+            for token in _literal_tokens(av[-1]):
+                yield token
+        else:
+            yield None
+            if (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and
+                    av[0] > 0):
+                # at least one instance of the content is required.
+                for token in _literal_tokens(av[2]):
+                    yield token
+                yield None
+
+
+def required_literal(pattern, flags=0):
+    """
+    Extract the longest run of literal characters that must be present
+    in any string the pattern can be found in, folded into lowercase.
+    Returns None if no such literal can be determined.
+
+    >>> required_literal('^%s: hi')
+    '%s: hi'
+    >>> required_literal('^!seen (?P<nick>.*)$')
+    '!seen '
+    >>> required_literal('How likely will it (?P<thing>[\\w\\s]*)')
+    'how likely will it '
+    >>> print(required_literal('hello|goodbye'))
+    None
+    >>> required_literal('a+bc')
+    'bc'
+    """
+
+    runs = [[]]
+    for token in _literal_tokens(sre_parse.parse(pattern, flags)):
+        if token is None:
+            runs.append([])
+        else:
+            runs[-1].append(token)
+
+    literal = u''.join(max(runs, key=len))
+    if not literal:
+        return None
+    return fold(literal)
+
+
+def _is_space(op, av):
+    if op is sre_parse.LITERAL:
+        return av < 128 and chr(av).isspace()
+    if op is sre_parse.IN:
+        return av == [(sre_parse.CATEGORY, sre_parse.CATEGORY_SPACE)]
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+        return av[0] > 0 and len(av[2]) == 1 and _is_space(*av[2][0])
+    return False
+
+
+def leading_token(pattern, flags=0):
+    """
+    Extract the literal token that must be the first whitespace
+    delimited token of any string the pattern can match, folded into
+    lowercase.  Only patterns anchored to the beginning of the string
+    with a literal followed by whitespace or the end of the string will
+    have one.
+
+    >>> leading_token('^!seen (?P<nick>.*)$')
+    '!seen'
+    >>> leading_token('^Bot: hi')
+    'bot:'
+    >>> leading_token('^!ping$')
+    '!ping'
+    >>> print(leading_token('^!seen'))
+    None
+    >>> print(leading_token('!seen (.*)'))
+    None
+    >>> print(leading_token('(?m)^!seen (.*)'))
+    None
+    """
+
+    # the inline flags are only found on the parsed pattern on some of
+    # the versions of python, so they are taken from the compiled one.
+    if re.compile(pattern, flags).flags & re.MULTILINE:
+        return None
+    items = sre_parse.parse(pattern, flags)
+
+    anchors = (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING)
+    if not len(items) or items[0][0] is not sre_parse.AT or (
+            items[0][1] not in anchors):
+        return None
+
+    ends = (sre_parse.AT_END, sre_parse.AT_END_STRING)
+    chars = []
+    for op, av in items[1:]:
+        if _is_space(op, av) or (op is sre_parse.AT and av in ends):
+            break
+        if op is sre_parse.LITERAL and av < 128:
+            chars.append(chr(av))
+            continue
+        return None
+    else:
+        # the token is not terminated so it may be a prefix of a token.
+        return None
+
+    if not chars:
+        return None
+    return fold(u''.join(chars))
+
+
+class LiteralScanner(object):
+    """
+    An Aho-Corasick automaton that finds all the literals that occur in
+    a piece of text in a single pass over it.
+
+    >>> scanner = LiteralScanner(['he', 'she', 'his', 'hers'])
+    >>> sorted(scanner.scan('ushers'))
+    [0, 1, 3]
+    >>> scanner.scan('nothing')
+    set()
+    """
+
+    def __init__(self, literals):
+        self.goto = [{}]
+        self.outputs = [()]
+
+        for idx, literal in enumerate(literals):
+            state = 0
+            for char in literal:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append(())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.outputs[state] += (idx,)
+
+        # breadth first construction of the failure links, merging the
+        # outputs along the way so the scan will not need to follow the
+        # failure links for them.
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                if fail == next_state:
+                    fail = 0
+                self.fail[next_state] = fail
+                self.outputs[next_state] += self.outputs[fail]
+
+    def scan(self, text):
+        """
+        Return the set of indexes of the literals found in the text.
+        """
+
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return found
+
+
+def compile_trigger(trigger, nickname=None, flags=re.IGNORECASE):
+    """
+    Compile a trigger from the client configuration into a regex.  If
+    a nickname is provided, it will be substituted into the trigger
+    via the `%(nickname)s` placeholder before compilation.
+
+    >>> compile_trigger('^%(nickname)s: hi', 'bot').pattern
+    '^bot: hi'
+    >>> compile_trigger('^%(nickname)s: hi').pattern
+    '^%(nickname)s: hi'
+    """
+
+    if nickname is not None:
+        trigger = trigger % {
+            'nickname': nickname,
+        }
+    return re.compile(trigger, flags)
+
+
+class TriggerTable(object):
+    """
+    A table of compiled triggers, built once from the list of raw
+    `(trigger, package, method)` entries so that the regexes are not
+    recompiled for every message.  Entries are kept in the order they
+    were provided.
+
+    To avoid running every regex against every message, the triggers
+    anchored to a leading literal token (such as `^!seen (.*)`) are
+    indexed by that token, so only the ones with the token matching the
+    first token of the message will be tried.  For the rest, the
+    literal required by each trigger is extracted and all of them are
+    scanned for in a single pass; only the triggers with their literal
+    present (or the ones without any) will have their regex run.
+
+    >>> table = TriggerTable([
+    ...     ['^%(nickname)s: hi', 'pkg', 'say_hi'],
+    ...     ['(', 'pkg', 'broken'],
+    ...     ['hi', 'pkg', 'hi'],
+    ...     ['hi|hello', 'pkg', 'greet'],
+    ... ], nickname='bot')
+    >>> len(table)
+    3
+    >>> [(p, m) for match, p, m in table.search('BOT: hi')]
+    [('pkg', 'say_hi'), ('pkg', 'hi'), ('pkg', 'greet')]
+    >>> table.candidates('hello')
+    [2]
+    >>> table.candidates('bot: hello')
+    [0, 2]
+    """
+
+    def __init__(self, triggers=(), nickname=None, flags=re.IGNORECASE):
+        self.nickname = nickname
+        self.entries = []
+
+        for trigger, package, method in triggers:
+            try:
+                regex = compile_trigger(trigger, nickname, flags)
+            except Exception:
+                logger.exception('%s is an invalid trigger', trigger)
+                continue
+            self.entries.append((regex, package, method))
+
+        self.setup_scanner()
+
+    def setup_scanner(self):
+        # indexes of the entries keyed by their leading token.
+        self.tokens = {}
+        # indexes of the entries that must always be tried.
+        self.unfiltered = []
+        literals = {}
+        for idx, (regex, package, method) in enumerate(self.entries):
+            token = leading_token(regex.pattern, regex.flags)
+            if token is not None:
+                self.tokens.setdefault(token, []).append(idx)
+                continue
+            literal = required_literal(regex.pattern, regex.flags)
+            if literal is None:
+                self.unfiltered.append(idx)
+                continue
+            literals.setdefault(literal, []).append(idx)
+
+        self.literal_entries = list(literals.values())
+        self.scanner = LiteralScanner(list(literals.keys()))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def candidates(self, body, folded=None):
+        """
+        Return the indexes of the entries that may match the body, in
+        order.  The folded body may be provided if it is already known.
+        """
+
+        result = self.unfiltered
+
+        if self.tokens:
+            if folded is None:
+                folded = fold(body)
+            token = folded.split(None, 1)[:1]
+            indexed = token and self.tokens.get(token[0])
+            if indexed:
+                result = result + indexed
+
+        if self.literal_entries:
+            if folded is None:
+                folded = fold(body)
+            found = self.scanner.scan(folded)
+            if found:
+                result = list(result)
+                for literal_idx in found:
+                    result.extend(self.literal_entries[literal_idx])
+
+        if result is not self.unfiltered:
+            result.sort()
+        return result
+
+    def search(self, body, candidates=None, folded=None):
+        """
+        Generate the `(match, package, method)` for every trigger that
+        matches the body, in order.  The candidates may be provided if
+        they were already determined for the body.
+        """
+
+        if candidates is None:
+            candidates = self.candidates(body, folded)
+
+        entries = self.entries
+        for idx in candidates:
+            regex, package, method = entries[idx]
+            match = regex.search(body)
+            if match:
+                yield match, package, method
@@ -1,8 +1,140 @@
+import os
 import re
+import sys
+import threading
+from collections import OrderedDict
+from collections import deque
+from time import time
+
+try:
+    from html.entities import name2codepoint
+except ImportError:  # pragma: no cover
+    from htmlentitydefs import name2codepoint
+
+try:
+    unichr
+except NameError:  # pragma: no cover
+    unichr = chr
+
+# the elements that will have the text within placed on its own lines.
+_block_tags = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'body', 'dd', 'div',
+    'dl', 'dt', 'fieldset', 'figure', 'footer', 'form', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'header', 'hr', 'html', 'li', 'ol', 'p', 'pre',
+    'section', 'table', 'tr', 'ul',
+])
+# the elements with the text within separated by a tab.
+_cell_tags = frozenset(['td', 'th'])
+
+# the characters that cannot be sent as xml.  The surrogates are the
+# halves of the other characters on the narrow builds of python 2.
+_xml_invalid = (u'\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff' +
+    (u'\ud800-\udfff' if sys.maxunicode > 0xffff else u''))
+
+# each match is a run of text followed by a tag, an entity or one of the
+# characters that are kept as text or dropped (or the end of the html).
+_html_token = re.compile(
+    u'([^<&%s]*)(?:'
+    # elements with content that is never rendered as text.
+    u'<(?:script|style)\\b.*?</(?:script|style)\\s*>|<!--.*?-->|'
+    # any other tags, with the name of the element captured.
+    u'<(/?)([a-zA-Z0-9]*)[^>]*>|'
+    # entities and character references.
+    u'&(#[xX][0-9a-fA-F]+|#[0-9]+|[a-zA-Z][a-zA-Z0-9]*);|'
+    u'([<&])|[%s]|\\Z)' % (_xml_invalid, _xml_invalid),
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def _entity(ref):
+    if ref[:1] != '#':
+        try:
+            return unichr(name2codepoint[ref])
+        except KeyError:
+            return '&%s;' % ref
+    if ref[:2] in ('#x', '#X'):
+        codepoint = int(ref[2:], 16)
+    else:
+        codepoint = int(ref[1:])
+    # like the browsers, the references to characters that cannot be
+    # sent as xml are replaced.
+    if (codepoint < 0x20 and codepoint not in (0x09, 0x0a, 0x0d) or
+            0xd800 <= codepoint <= 0xdfff or
+            codepoint in (0xfffe, 0xffff) or codepoint > 0x10ffff):
+        return u'\ufffd'
+    try:
+        return unichr(codepoint)
+    except ValueError:  # pragma: no cover
+        # beyond the first plane on the narrow builds of python 2.
+        return u'\ufffd'
+
+
+def html_to_text(html):
+    """
+    Convert the html into plain text in a single pass, with the text of
+    the block-level elements placed on their own lines, line breaks for
+    `<br>`, table cells separated by tabs and the entities decoded.  The
+    whitespace within `<pre>` is kept, and the characters that cannot be
+    sent as xml are removed.
+
+    >>> print(html_to_text('<p>Hello <b>there</b></p><p>a &amp; b</p>'))
+    Hello there
+    a & b
+    >>> print(html_to_text('line<br/>break &#x41;&#66; &bogus;'))
+    line
+    break AB &bogus;
+    """
+
+    parts = []
+    append = parts.append
+    # the separator needed before the next piece of text, with the
+    # whitespace up to it not rendered outside of `<pre>`.
+    pending = None
+    pre = 0
+    # a line break right after the start of a pre is not its content.
+    pre_start = False
+
+    for text, close, tag, ref, char in _html_token.findall(html):
+        if text:
+            if pre_start and text[:1] == '\n':
+                text = text[1:]
+            if pending is not None:
+                if not pre:
+                    text = text.lstrip()
+                if text:
+                    if parts and parts[-1][-1:] != '\n':
+                        append(pending)
+                    pending = None
+            if text:
+                append(text)
+        pre_start = False
+
+        if tag:
+            tag = tag.lower()
+            if tag in _block_tags:
+                if tag == 'pre':
+                    pre_start = not close
+                    pre = max(pre + (-1 if close else 1), 0)
+                pending = '\n'
+            elif tag == 'br':
+                append('\n')
+                pending = None
+            elif tag in _cell_tags and pending != '\n':
+                pending = '\t'
+        elif ref or char:
+            if pending is not None:
+                if parts and parts[-1][-1:] != '\n':
+                    append(pending)
+                pending = None
+            append(_entity(ref) if ref else char)
+
+    return ''.join(parts)
+
 
 def strip_tags(html):
     """
-    Lazily strip all tags in a very lazy way.
+    Strip all tags from the html to produce its plain text rendering,
+    using `html_to_text`.
 
     >>> print(strip_tags(None))
     None
@@ -16,8 +148,161 @@ def strip_tags(html):
 
     if html is None:
         return None
-    
-    return re.compile('<[^>]*>').sub('', html)
+
+    return html_to_text(html)
+
+
+def is_html(text):
+    """
+    Check whether the text is an html candidate, which are any strings
+    that starts with `<p>`, `<html>` or `<body>` (case-insensitive).
+
+    >>> is_html('<p>test</p>')
+    True
+    >>> is_html('<BODY>test</BODY>')
+    True
+    >>> is_html('test <b>string</b>')
+    False
+    """
+
+    # just check first-n characters.
+    ss = text[:10].lower()
+    checks = ('<p>', '<html>', '<body>',)
+    return any((ss.startswith(check) for check in checks))
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entries once
+    it holds more than `size` of them, keeping count of the hits and
+    misses of the lookups.
+
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> print(cache.get('b'))
+    None
+    >>> sorted(cache.stats().items())
+    [('hits', 1), ('misses', 1), ('size', 2)]
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+            }
+
+
+class RecentSet(object):
+    """
+    A set of the most recently added items, holding at most `size` of
+    them and (if `window` is not 0) only those added within the last
+    `window` seconds.  The items are kept in a ring for their order and
+    counted in a dict, so the membership test does not depend on the
+    size.  The same item may be added more than once.
+
+    >>> recent = RecentSet(2)
+    >>> for item in ('a', 'b', 'b'):
+    ...     recent.add(item)
+    >>> 'a' in recent, 'b' in recent
+    (False, True)
+    >>> list(recent)
+    ['b', 'b']
+    >>> recent = RecentSet(10, window=60)
+    >>> recent.add('a', now=100)
+    >>> recent.contains('a', now=150), recent.contains('a', now=160)
+    (True, False)
+    """
+
+    def __init__(self, size, window=0):
+        self.size = size
+        self.window = window
+        # (item, time added)
+        self.ring = deque()
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ring)
+
+    def __iter__(self):
+        with self.lock:
+            return iter([item for item, added in self.ring])
+
+    def __contains__(self, item):
+        return self.contains(item)
+
+    def _pop(self):
+        item = self.ring.popleft()[0]
+        count = self.counts[item] - 1
+        if count:
+            self.counts[item] = count
+        else:
+            del self.counts[item]
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        ring = self.ring
+        while ring and ring[0][1] <= cutoff:
+            self._pop()
+
+    def add(self, item, now=None):
+        if now is None:
+            now = time()
+        with self.lock:
+            self.ring.append((item, now))
+            self.counts[item] = self.counts.get(item, 0) + 1
+            while len(self.ring) > self.size:
+                self._pop()
+
+    def contains(self, item, now=None):
+        with self.lock:
+            if self.window:
+                self._expire(time() if now is None else now)
+            return item in self.counts
+
+    def clear(self):
+        with self.lock:
+            self.ring.clear()
+            self.counts.clear()
+
 
 def read_config(config_path):
     try:
@@ -39,3 +324,56 @@ class ConfigFile(object):
             return
         self.consumer(config)
         return config
+
+
+class ConfigWatcher(object):
+    """
+    Watch the file for changes by polling its modification time through
+    `check`, calling the callback once the file has not changed further
+    for `debounce` seconds.  A reload may also be requested directly
+    (such as from a signal handler) through `request`, which is then
+    debounced the same way.
+
+    >>> calls = []
+    >>> watcher = ConfigWatcher(None, lambda: calls.append(1), debounce=2)
+    >>> watcher.request(now=100)
+    >>> watcher.check(now=101), watcher.check(now=102), calls
+    (False, True, [1])
+    """
+
+    def __init__(self, path, callback, debounce=1):
+        self.path = path
+        self.callback = callback
+        self.debounce = debounce
+        self.mtime = self._mtime()
+        self.pending = None
+
+    def _mtime(self):
+        if self.path is None:
+            return None
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def request(self, now=None):
+        self.pending = time() if now is None else now
+
+    def check(self, now=None):
+        """
+        Check the file for changes, and call the callback if a change
+        or a request was made and has settled.  Returns whether the
+        callback was called.
+        """
+
+        if now is None:
+            now = time()
+        mtime = self._mtime()
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.pending = now
+        if self.pending is None or now - self.pending < self.debounce:
+            return False
+        self.pending = None
+        self.callback()
+        return True
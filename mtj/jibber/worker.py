@@ -0,0 +1,720 @@
+import logging
+import threading
+from collections import deque
+from collections import OrderedDict
+from functools import partial
+from time import time
+
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Queue
+
+logger = logging.getLogger('mtj.jibber.worker')
+
+
+def _join(thread, timeout):
+    # the thread may be the current one, such as when the bot is
+    # disconnected by one of the items it is running.
+    if thread is None or thread is threading.current_thread():
+        return True
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+class WorkerPool(object):
+    """
+    A bounded pool of threads for running package methods away from
+    the thread that receives the events from the client.
+
+    size
+        the number of worker threads.
+    queue_size
+        the maximum number of calls submitted but not yet done, across
+        all the lanes; further calls will be rejected.  0 for no limit.
+    timeout
+        the number of seconds since the submission of a call before its
+        result is discarded.  Calls that are still waiting for a worker
+        by then will not be run at all.
+    package_limits
+        a mapping of package (alias) to the maximum number of calls to
+        its methods that may run concurrently.  Calls over the limit
+        are set aside until a call to the package is done, leaving the
+        workers free for the other packages.
+    lane_depth
+        the maximum number of calls submitted to a single lane that may
+        be pending; further calls to that lane will be rejected.  0 for
+        no limit.
+
+    Calls submitted to the same lane are run one after another in the
+    order they were submitted, while separate lanes are run in parallel
+    with each other.
+    """
+
+    def __init__(self, size=4, queue_size=0, timeout=None,
+            package_limits=None, lane_depth=16):
+        if not size > 0:
+            raise ValueError('size must be greater than 0')
+        self.size = size
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.lane_depth = lane_depth
+        self.queue = Queue()
+        self.package_limits = dict(package_limits or {})
+        # the number of calls running for each of the limited packages,
+        # and the calls set aside until one of them is done.
+        self.running = {}
+        self.deferred = {}
+        self.lanes = {}
+        # the number of calls submitted that are not yet done.
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.stopped = False
+        # the number of threads to stop once all pending calls are done.
+        self.stopping = 0
+        self.threads = []
+        # the threads stopped, to be joined.
+        self.stopped_threads = []
+
+    def start(self):
+        for i in range(self.size - len(self.threads)):
+            thread = threading.Thread(target=self.work,
+                name='jibber-worker-%d' % len(self.threads))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the workers once the calls already queued are done.
+        """
+
+        threads, self.threads = self.threads, []
+        self.stopped_threads.extend(threads)
+        with self.lock:
+            self.stopped = True
+            self.stopping += len(threads)
+            if self.pending:
+                return
+            stopping, self.stopping = self.stopping, 0
+        for i in range(stopping):
+            self.queue.put(None)
+
+    def join(self, timeout=None):
+        """
+        Wait for the calls already queued to be done by the workers
+        after `stop`, up to the timeout.  Returns whether they all were.
+        """
+
+        threads = self.stopped_threads
+        if threading.current_thread() in threads:
+            # the worker will not stop until the call running this is
+            # done.
+            return False
+        deadline = None if timeout is None else time() + timeout
+        for thread in threads:
+            if not _join(thread, None if deadline is None else
+                    max(deadline - time(), 0)):
+                return False
+        return True
+
+    def submit(self, package, call, callback, lane=None):
+        """
+        Queue up the call to be run by a worker, with its result passed
+        to the callback.  If the call is timed out, None is passed to
+        the callback instead.  If the call raises an exception it is
+        logged and the callback will not be called.
+
+        If a lane is specified, the call and its callback will only be
+        run after the ones submitted to the same lane before it are
+        done.
+
+        Returns True if the call was queued.
+        """
+
+        item = (package, call, callback, time())
+
+        with self.lock:
+            if self.stopped:
+                logger.warning('workers stopped; call to `%s` dropped',
+                    package)
+                return False
+            if self.queue_size and self.pending >= self.queue_size:
+                logger.warning('worker queue is full; call to `%s` dropped',
+                    package)
+                return False
+
+            if lane is None:
+                idle = False
+            else:
+                pending = self.lanes.get(lane)
+                idle = pending is None
+                if idle:
+                    pending = self.lanes[lane] = deque()
+                elif self.lane_depth and len(pending) >= self.lane_depth:
+                    logger.warning('lane `%s` is full; call to `%s` dropped',
+                        lane, package)
+                    return False
+                pending.append(item)
+            self.pending += 1
+
+        if lane is None:
+            self.queue.put(partial(self.run, *item, done=self._finished))
+        elif idle:
+            self.queue.put(partial(self.drain, lane))
+        return True
+
+    def _finished(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending or not self.stopping:
+                return
+            stopping, self.stopping = self.stopping, 0
+        for i in range(stopping):
+            self.queue.put(None)
+
+    def drain(self, lane):
+        """
+        Run the call at the front of the lane, and queue up the lane
+        again for the next one if there are more, so that the other
+        lanes can have their turn in between.
+        """
+
+        with self.lock:
+            # the running call is kept in the lane until it is done so
+            # that the lane will not be queued up again by submit.
+            item = self.lanes[lane][0]
+
+        self.run(*item, done=partial(self._lane_done, lane))
+
+    def _lane_done(self, lane):
+        with self.lock:
+            pending = self.lanes[lane]
+            pending.popleft()
+            if not pending:
+                del self.lanes[lane]
+            else:
+                self.queue.put(partial(self.drain, lane))
+        self._finished()
+
+    def expired(self, submitted):
+        return self.timeout is not None and (
+            time() - submitted > self.timeout)
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            task()
+
+    def _acquire(self, package, task):
+        # whether the call may run now; otherwise the task is set aside
+        # until one of the calls to the package is done.
+        limit = self.package_limits.get(package)
+        if limit is None:
+            return True
+        with self.lock:
+            running = self.running.get(package, 0)
+            if running < limit:
+                self.running[package] = running + 1
+                return True
+            self.deferred.setdefault(package, deque()).append(task)
+            return False
+
+    def _release(self, package):
+        if package not in self.package_limits:
+            return
+        with self.lock:
+            deferred = self.deferred.get(package)
+            if not deferred:
+                self.running[package] -= 1
+                return
+            task = deferred.popleft()
+            if not deferred:
+                del self.deferred[package]
+        # the slot is handed over to the call set aside.
+        self.queue.put(task)
+
+    def run(self, package, call, callback, submitted, done=None):
+        """
+        Run the call and pass its result to the callback, unless the
+        package is at its limit, in which case it will be run by a
+        worker once a call to the package is done.  The done callable
+        is called after that.
+        """
+
+        task = partial(self._run, package, call, callback, submitted, done)
+        if self._acquire(package, task):
+            task()
+
+    def _run(self, package, call, callback, submitted, done):
+        try:
+            self._call(package, call, callback, submitted)
+        finally:
+            self._release(package)
+            if done is not None:
+                done()
+
+    def _call(self, package, call, callback, submitted):
+        if self.expired(submitted):
+            logger.warning('call to `%s` timed out waiting for a worker',
+                package)
+            result = None
+        else:
+            try:
+                result = call()
+            except Exception:
+                logger.exception('Failed to run call to `%s`', package)
+                return
+
+            if self.expired(submitted):
+                logger.warning(
+                    'call to `%s` took %.2f seconds; result discarded',
+                    package, time() - submitted)
+                result = None
+
+        try:
+            callback(result)
+        except Exception:
+            logger.exception('Failed to process result of call to `%s`',
+                package)
+
+
+class _Entry(object):
+
+    __slots__ = ('seq', 'room', 'item', 'queued')
+
+    def __init__(self, seq, room, item):
+        self.seq = seq
+        self.room = room
+        self.item = item
+        self.queued = True
+
+
+class InboundQueue(object):
+    """
+    A bounded queue of inbound messages, for shedding the load before
+    it reaches the dispatch when the bot is flooded.  Messages are
+    dispatched by a single thread in the order they are received within
+    each room, with the rooms taking turns.
+
+    dispatch
+        the callable that will be called with each item.
+    size
+        the maximum number of items that may be queued.  0 for no
+        limit.
+    room_size
+        the maximum number of items that may be queued for a single
+        room; the oldest one for the room is dropped to make way for a
+        new one.  0 for no limit.
+    policy
+        what to do when the queue is full:
+
+        drop_newest
+            the new item is dropped.
+        drop_oldest
+            the oldest item is dropped.
+        drop_listeners
+            the oldest item that is only of interest to the listeners
+            (i.e. queued with `droppable`) is dropped, otherwise the
+            oldest item.
+
+    The number of items shed is tracked in `shed`, keyed by the reason.
+    """
+
+    policies = ('drop_newest', 'drop_oldest', 'drop_listeners')
+
+    def __init__(self, dispatch, size=1000, room_size=0,
+            policy='drop_oldest'):
+        if policy not in self.policies:
+            raise ValueError('policy must be one of %s' % str(self.policies))
+        self.dispatch = dispatch
+        self.size = size
+        self.room_size = room_size
+        self.policy = policy
+
+        # room: the entries queued for the room, in order, along with
+        # the number of them still queued in sizes.  The entries are
+        # also kept in the order they were received, and the droppable
+        # ones on their own, such that the one to evict can be found at
+        # the front of those; the evicted entries are discarded from the
+        # lines as they reach the front.
+        self.rooms = OrderedDict()
+        self.sizes = {}
+        self.order = deque()
+        self.droppable = deque()
+        self.count = 0
+        self.seq = 0
+        self.shed = {}
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def __len__(self):
+        return self.count
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.work,
+            name='jibber-inbound')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the dispatch once the items already queued are done.
+        """
+
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait for the items queued to be dispatched after `stop`, up to
+        the timeout.  Returns whether they all were.
+        """
+
+        return _join(self.thread, timeout)
+
+    def _shed(self, reason):
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+
+    def _front(self, pending):
+        # the first entry still queued, discarding the ones evicted.
+        while not pending[0].queued:
+            pending.popleft()
+        return pending[0]
+
+    def _remove(self, entry):
+        entry.queued = False
+        self.count -= 1
+        sizes = self.sizes
+        sizes[entry.room] -= 1
+        if not sizes[entry.room]:
+            del sizes[entry.room]
+            del self.rooms[entry.room]
+
+    def _evict(self):
+        reason = 'oldest'
+        fifo = self.order
+        if self.policy == 'drop_listeners':
+            while self.droppable and not self.droppable[0].queued:
+                self.droppable.popleft()
+            if self.droppable:
+                fifo = self.droppable
+                reason = 'listeners'
+
+        self._remove(self._front(fifo))
+        fifo.popleft()
+        self._shed(reason)
+
+    def put(self, room, item, droppable=False):
+        """
+        Queue up the item for the room, shedding items as needed.  The
+        item may be marked as droppable if it is only of interest to
+        the listeners.
+
+        Returns True if the item was queued.
+        """
+
+        with self.cond:
+            if self.room_size and self.sizes.get(room, 0) >= self.room_size:
+                pending = self.rooms[room]
+                entry = self._front(pending)
+                pending.popleft()
+                self._remove(entry)
+                self._shed('room')
+
+            if self.size and self.count >= self.size:
+                if self.policy == 'drop_newest':
+                    self._shed('full')
+                    return False
+                self._evict()
+
+            pending = self.rooms.get(room)
+            if pending is None:
+                pending = self.rooms[room] = deque()
+            self.seq += 1
+            entry = _Entry(self.seq, room, item)
+            pending.append(entry)
+            if self.size and self.policy != 'drop_newest':
+                self.order.append(entry)
+                if droppable and self.policy == 'drop_listeners':
+                    self.droppable.append(entry)
+            self.sizes[room] = self.sizes.get(room, 0) + 1
+            self.count += 1
+            self.cond.notify()
+        return True
+
+    def get(self):
+        """
+        Return the next item, waiting for one if there are none.  None
+        is returned once stopped and all items are done.
+        """
+
+        with self.cond:
+            while not self.count:
+                if self.stopped:
+                    return None
+                self.cond.wait()
+
+            room, pending = next(iter(self.rooms.items()))
+            entry = self._front(pending)
+            pending.popleft()
+            self._remove(entry)
+            # to the back of the line for this room.
+            if room in self.rooms:
+                del self.rooms[room]
+                self.rooms[room] = pending
+            # discard the entries no longer queued from the front of the
+            # lines used for the eviction, to keep them from growing.
+            for fifo in (self.order, self.droppable):
+                while fifo and not fifo[0].queued:
+                    fifo.popleft()
+            return entry.item
+
+    def work(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            try:
+                self.dispatch(item)
+            except Exception:
+                logger.exception('Failed to dispatch inbound item')
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queued': self.count,
+                'shed': dict(self.shed),
+            }
+
+
+class TokenBucket(object):
+    """
+    A token bucket, refilled at `rate` tokens per second up to `burst`
+    tokens.
+
+    >>> bucket = TokenBucket(rate=2, burst=2, now=0)
+    >>> bucket.wait(0)
+    0
+    >>> bucket.take()
+    >>> bucket.take()
+    >>> bucket.wait(0)
+    0.5
+    >>> bucket.wait(0.5)
+    0
+    """
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time() if now is None else now
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+    def wait(self, now):
+        """
+        Return the number of seconds until a token is available.
+        """
+
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / float(self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundQueue(object):
+    """
+    A queue of outbound stanzas, sent by a single thread such that the
+    rate at which stanzas are sent to each destination and to the
+    server as a whole are limited by token buckets.
+
+    rate, burst
+        the rate (per second) and burst for each destination.
+    global_rate, global_burst
+        the rate and burst for all stanzas.  No global limit if rate is
+        not specified.
+
+    Priority items (such as the admin queries) are sent before all the
+    others and are only subjected to the global limit.  The items are
+    callables that do the actual sending.
+    """
+
+    def __init__(self, rate=1, burst=5, global_rate=None, global_burst=None):
+        if not rate > 0 or not burst >= 1:
+            raise ValueError('rate must be greater than 0 and burst at least 1')
+        if global_rate is not None and not global_rate > 0 or (
+                global_burst is not None and not global_burst >= 1):
+            raise ValueError(
+                'global_rate must be greater than 0 and global_burst at '
+                'least 1')
+        self.rate = rate
+        self.burst = burst
+        self.global_bucket = None
+        if global_rate is not None:
+            self.global_bucket = TokenBucket(global_rate,
+                global_burst or global_rate)
+
+        self.buckets = {}
+        self.dests = OrderedDict()
+        self.priority = deque()
+        self.count = 0
+
+        self.sent = 0
+        self.waited = 0
+        self.max_wait = 0
+
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def __len__(self):
+        return self.count
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.work,
+            name='jibber-outbound')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the sending once the items already queued are sent.
+        """
+
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait for the items queued to be sent after `stop`, up to the
+        timeout.  Returns whether they all were.
+        """
+
+        return _join(self.thread, timeout)
+
+    def _prune(self, now):
+        # forget the buckets that are full and not in use as they are
+        # no different to new ones.
+        for dest in [dest for dest, bucket in self.buckets.items()
+                if dest not in self.dests and bucket.full(now)]:
+            del self.buckets[dest]
+
+    def put(self, dest, item, priority=False):
+        now = time()
+        with self.cond:
+            if priority:
+                self.priority.append((item, now))
+            else:
+                pending = self.dests.get(dest)
+                if pending is None:
+                    if dest not in self.buckets:
+                        self._prune(now)
+                        self.buckets[dest] = TokenBucket(
+                            self.rate, self.burst, now)
+                    pending = self.dests[dest] = deque()
+                pending.append((item, now))
+            self.count += 1
+            self.cond.notify()
+
+    def _pop(self, pending, now):
+        item, queued = pending.popleft()
+        self.count -= 1
+        if self.global_bucket is not None:
+            self.global_bucket.take()
+        waited = now - queued
+        self.sent += 1
+        self.waited += waited
+        self.max_wait = max(self.max_wait, waited)
+        return item
+
+    def poll(self, now):
+        """
+        Return a tuple of the next item that may be sent now, and the
+        number of seconds to wait before polling again if there are no
+        items that may be sent now (or None if there are none queued).
+        Must be called with the condition held.
+        """
+
+        if not self.count:
+            return None, None
+
+        wait = 0
+        if self.global_bucket is not None:
+            wait = self.global_bucket.wait(now)
+        if wait:
+            return None, wait
+
+        if self.priority:
+            return self._pop(self.priority, now), 0
+
+        for dest, pending in self.dests.items():
+            bucket = self.buckets[dest]
+            dest_wait = bucket.wait(now)
+            if dest_wait:
+                wait = min(wait, dest_wait) if wait else dest_wait
+                continue
+            bucket.take()
+            item = self._pop(pending, now)
+            # to the back of the line for this destination.
+            del self.dests[dest]
+            if pending:
+                self.dests[dest] = pending
+            return item, 0
+
+        return None, wait
+
+    def get(self):
+        """
+        Return the next item when it may be sent.  None is returned
+        once stopped and all items are sent.
+        """
+
+        with self.cond:
+            while True:
+                item, wait = self.poll(time())
+                if item is not None:
+                    return item
+                if wait is None and self.stopped:
+                    return None
+                self.cond.wait(wait)
+
+    def work(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            try:
+                item()
+            except Exception:
+                logger.exception('Failed to send outbound item')
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queued': self.count,
+                'priority': len(self.priority),
+                'sent': self.sent,
+                'mean_wait': self.waited / self.sent if self.sent else 0,
+                'max_wait': self.max_wait,
+            }
@@ -0,0 +1,186 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import threading
+
+from mtj.jibber.activity import ActivityStore
+from mtj.jibber.activity import SqliteActivityBackend
+
+
+class ActivityStoreTestCase(TestCase):
+
+    def test_basic(self):
+        store = ActivityStore()
+        store[('room', 'alice')] = ('alice@example.com', 100)
+        self.assertEqual(store[('room', 'alice')], ('alice@example.com', 100))
+        self.assertEqual(store.get(('room', 'bob')), None)
+        self.assertEqual(store.get(('elsewhere', 'alice')), None)
+        self.assertIn(('room', 'alice'), store)
+        self.assertNotIn(('room', 'bob'), store)
+        self.assertRaises(KeyError, store.__getitem__, ('room', 'bob'))
+        self.assertEqual(len(store), 1)
+
+    def test_interned(self):
+        store = ActivityStore()
+        jid = ''.join(['alice', '@example.com'])
+        other = ''.join(['alice', '@example.com'])
+        self.assertIsNot(jid, other)
+        store[('room', 'alice')] = (jid, 100)
+        store[('room2', 'alice')] = (other, 100)
+        self.assertIs(store[('room', 'alice')][0],
+            store[('room2', 'alice')][0])
+
+    def test_delete_reuse_slot(self):
+        store = ActivityStore()
+        store[('room', 'alice')] = ('a', 100)
+        store[('room', 'bob')] = ('b', 100)
+        del store[('room', 'alice')]
+        self.assertRaises(KeyError, store.__delitem__, ('room', 'alice'))
+        self.assertEqual(len(store), 1)
+        store[('room2', 'carol')] = ('c', 100)
+        self.assertEqual(len(store.stamps), 2)
+        self.assertEqual(dict(store), {
+            ('room', 'bob'): ('b', 100),
+            ('room2', 'carol'): ('c', 100),
+        })
+        del store[('room', 'bob')]
+        self.assertEqual(list(store.rooms), ['room2'])
+
+    def test_max_entries(self):
+        store = ActivityStore(max_entries=32)
+        for i in range(40):
+            store[('room', 'user%d' % i)] = ('jid', 1000 - i)
+        # only the most recent entries are kept, with a couple evicted
+        # in one go.
+        self.assertEqual(len(store), 32)
+        self.assertEqual(sorted(store)[0], ('room', 'user0'))
+        self.assertNotIn(('room', 'user38'), store)
+        self.assertEqual(len(store.stamps), 33)
+
+    def test_ttl(self):
+        store = ActivityStore(ttl=100)
+        store[('room', 'alice')] = ('a', 1000)
+        store[('room', 'bob')] = ('b', 1050)
+        self.assertEqual(len(store), 2)
+        store[('room', 'carol')] = ('c', 1099)
+        self.assertIn(('room', 'alice'), store)
+        store[('room', 'carol')] = ('c', 1100)
+        self.assertNotIn(('room', 'alice'), store)
+        self.assertEqual(len(store), 2)
+        store[('room', 'carol')] = ('c', 1151)
+        # expired, but only swept once the ttl has passed since the
+        # previous sweep, or when the entries are counted or iterated.
+        self.assertNotIn(('room', 'bob'), store)
+        self.assertIsNone(store.get(('room', 'bob')))
+        self.assertEqual(len(store.rooms['room']), 2)
+        self.assertEqual(store.items(), [(('room', 'carol'), ('c', 1151))])
+        self.assertEqual(len(store), 1)
+        store[('room', 'carol')] = ('c', 1200)
+        self.assertEqual(sorted(store), [('room', 'carol')])
+
+    def test_expire_now(self):
+        store = ActivityStore(ttl=100)
+        store[('room', 'alice')] = ('a', 1000)
+        store.expire(1050)
+        self.assertEqual(len(store), 1)
+        store.expire(1100)
+        self.assertEqual(len(store), 0)
+
+    def test_threaded(self):
+        store = ActivityStore(max_entries=100, ttl=50)
+
+        def record(room):
+            for i in range(1000):
+                store[(room, 'user%d' % (i % 150))] = ('other', i)
+                len(store)
+                dict(store.items())
+
+        threads = [threading.Thread(target=record, args=('room%d' % i,))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertTrue(len(store) <= 100)
+        self.assertEqual(len(store), len(list(store)))
+
+
+class SqliteActivityBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'activity.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_behind(self):
+        backend = SqliteActivityBackend(self.path, batch_size=3)
+        reader = SqliteActivityBackend(self.path)
+        backend.record('nick', 'room', 'alice', 'alice@example.com', 100)
+        backend.record('nick', 'room', 'alice', 'alice@example.com', 110)
+        backend.record('nick', 'room', 'bob', 'bob@example.com', 110)
+        self.assertIsNone(reader.fetch('nick', 'room', 'alice'))
+        self.assertEqual(backend.fetch('nick', 'room', 'alice'),
+            ('alice@example.com', 110))
+
+        backend.record('jid', 'room', 'bob@example.com', 'bob', 120)
+        self.assertEqual(backend.pending, {})
+        self.assertEqual(reader.fetch('nick', 'room', 'alice'),
+            ('alice@example.com', 110))
+        self.assertEqual(reader.fetch('jid', 'room', 'bob@example.com'),
+            ('bob', 120))
+        self.assertIsNone(reader.fetch('jid', 'room', 'alice'))
+
+        backend.record('nick', 'room', 'carol', 'carol@example.com', 130)
+        backend.close()
+        self.assertEqual(reader.fetch('nick', 'room', 'carol'),
+            ('carol@example.com', 130))
+        reader.close()
+        self.assertRaises(ValueError, backend.record,
+            'nick', 'room', 'dave', 'dave@example.com', 140)
+
+    def test_timer(self):
+        backend = SqliteActivityBackend(self.path, flush_interval=0.01)
+        flushed = threading.Event()
+        flush = backend.flush
+
+        def wrapped():
+            flush()
+            flushed.set()
+
+        backend.flush = wrapped
+        backend.start()
+        backend.start()
+        backend.record('nick', 'room', 'alice', 'alice@example.com', 100)
+        self.assertTrue(flushed.wait(5))
+        backend.close()
+        self.assertIsNone(backend.thread)
+
+        reader = SqliteActivityBackend(self.path)
+        self.assertEqual(reader.fetch('nick', 'room', 'alice'),
+            ('alice@example.com', 100))
+        reader.close()
+
+    def test_batch_flushed_by_thread(self):
+        backend = SqliteActivityBackend(self.path, batch_size=2,
+            flush_interval=60)
+        flushed = threading.Event()
+        threads = []
+        flush = backend.flush
+
+        def wrapped():
+            threads.append(threading.current_thread())
+            flush()
+            flushed.set()
+
+        backend.flush = wrapped
+        backend.start()
+        backend.record('nick', 'room', 'alice', 'alice@example.com', 100)
+        self.assertFalse(flushed.is_set())
+        backend.record('nick', 'room', 'bob', 'bob@example.com', 100)
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(threads, [backend.thread])
+        self.assertEqual(backend.pending, {})
+        backend.close()
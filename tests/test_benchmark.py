@@ -0,0 +1,27 @@
+from unittest import TestCase
+
+from mtj.jibber.testing import benchmark
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_bench_commands(self):
+        # just ensure the benchmarks are runnable.
+        results = benchmark.bench_commands(sizes=(1, 2), number=1)
+        self.assertEqual([size for size, t in results], [1, 2])
+
+    def test_bench_pipeline(self):
+        results = benchmark.bench_pipeline(number=1)
+        self.assertEqual(len(results), 2)
+
+    def test_bench_strip_tags(self):
+        results = benchmark.bench_strip_tags(sizes=(10, 100), number=1)
+        self.assertEqual([size for size, l, t in results], [10, 100])
+
+    def test_bench_activity(self):
+        results = benchmark.bench_activity(sizes=(10, 20), number=5)
+        self.assertEqual([r[0] for r in results], [10, 20])
+
+    def test_bench_occupants(self):
+        results = benchmark.bench_occupants(sizes=(10, 20), number=1)
+        self.assertEqual([r[0] for r in results], [10, 20])
@@ -1,12 +1,17 @@
 from unittest import TestCase
 
+import os
 import re
+import shutil
+import tempfile
 from time import time
 
 from sleekxmpp.xmlstream import ET
 
+from mtj.jibber.iq import IqTracker
 from mtj.jibber.jabber import MucChatBot
 import mtj.jibber.bot
+from mtj.jibber.bot import Affilate
 from mtj.jibber.bot import MucAdmin
 from mtj.jibber.bot import RussianRoulette
 from mtj.jibber.bot import RandomPromotion
@@ -127,6 +132,53 @@ class MucAdminTestCase(TestCase):
         self.assertEqual(result,
             'kicker: Okay, I have kicked a_victim for you.')
 
+    def test_kick_many(self):
+        bot = self.mk_default_bot()
+        muc_admin = MucAdmin(chunk_size=2)
+        muc_admin.kick(bot, 'room@example.com', ['a', 'b', 'c'],
+            reason='spam', jids=['spammer@example.com/x'])
+        self.assertEqual(len(bot.client.raw), 2)
+        items = [item for raw in bot.client.raw
+            for item in list(raw.get_payload()[0])]
+        self.assertEqual([item.get('nick') or item.get('jid')
+            for item in items], ['a', 'b', 'c', 'spammer@example.com/x'])
+        self.assertEqual(set(item.get('role') for item in items),
+            set(['none']))
+        self.assertEqual(bot.client.raw[0]['to'], 'room@example.com')
+        self.assertIn('spam', str(bot.client.raw[1]))
+
+    def test_kick_tracked(self):
+        bot = self.mk_default_bot()
+        bot.iq_tracker = IqTracker()
+        futures = MucAdmin(chunk_size=2).kick(bot, 'room@example.com',
+            ['a', 'b', 'c'])
+        self.assertEqual(len(futures), 2)
+        self.assertEqual(len(bot.iq_tracker), 2)
+        self.assertNotEqual(bot.client.raw[0]['id'],
+            bot.client.raw[1]['id'])
+
+
+class TestAffilate(TestCase):
+
+    def test_promote_demote_all(self):
+        bot = mk_default_bot()
+        affilate = Affilate(chunk_size=3)
+        affilate.promote_all(bot, 'room@example.com',
+            ['user%d' % i for i in range(5)])
+        affilate.demote_all(bot, 'room@example.com', ['user0'])
+        self.assertEqual([len(raw.get_payload()[0])
+            for raw in bot.client.raw], [3, 2, 1])
+        self.assertEqual(
+            [item.get('role') for item in bot.client.raw[1].get_payload()[0]],
+            ['moderator', 'moderator'])
+        self.assertEqual(bot.client.raw[2].get_payload()[0][0].get('role'),
+            'participant')
+
+    def test_promote_all_empty(self):
+        bot = mk_default_bot()
+        Affilate().promote_all(bot, 'room@example.com', [])
+        self.assertEqual(bot.client.raw, [])
+
 
 class TestRussianRoulette(TestCase):
 
@@ -255,6 +307,46 @@ class TestLastActivity(TestCase):
     def time(self):
         return self._time
 
+    def test_persist(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        persist = {'path': os.path.join(tmpdir, 'activity.db')}
+        self.cmd = LastActivity(persist=persist)
+        self.test_message_recorder()
+        self.cmd.close()
+        self.assertIsNone(self.cmd.backend)
+
+        self.cmd = LastActivity(persist=persist)
+        self.addCleanup(self.cmd.close)
+        self.bot.muc.rooms['room@example.com'].pop('Rob')
+        self.bot.update_occupants({
+            'from': Jid('room', 'room@example.com', 'Rob'),
+            'type': 'unavailable',
+        })
+        self._time = 1600000300
+        msg = {'from': Jid('room', 'room@example.com', 'A Test User')}
+        match = re.search('(?P<nick>.*)', 'Rob')
+        self.assertEqual(self.cmd.report_nick(msg, match, self.bot),
+            'A Test User: Rob was last seen 300 seconds ago.')
+        # cached in memory.
+        self.assertIn(('room@example.com', 'Rob'), self.cmd.nicks)
+        match = re.search('(?P<jid>.*)', 'nobody@example.com')
+        self.assertEqual(self.cmd.report_jid(msg, match, self.bot),
+            'A Test User: nobody@example.com has never been seen here '
+            'before.')
+
+    def test_bounded(self):
+        cmd = LastActivity(max_entries=16, ttl=3600)
+        for i in range(20):
+            cmd.add_all('room@example.com', 'user%d@example.com' % i,
+                'user%d' % i, 1400000000 + i)
+        self.assertEqual(len(cmd.nicks), 16)
+        self.assertNotIn(('room@example.com', 'user3'), cmd.nicks)
+        self.assertIn(('room@example.com', 'user19@example.com'), cmd.jids)
+        cmd.add_all('room@example.com', 'new@example.com', 'new',
+            1400003610)
+        self.assertEqual(len(cmd.nicks), 10)
+
     def test_add_all(self):
         room = 'room@example.com'
         jid = 'testbot@example.com'
@@ -82,6 +82,8 @@ class BotTestCase(TestCase):
         self.assertEqual(bot.config, {'test': '12345'})
         bot.load_client_config('{"key": ["a", "b"]}')
         self.assertEqual(bot.config, {'test': '12345', 'key': ['a', 'b']})
+        self.assertRaises(ValueError, bot.load_client_config, '[]')
+        self.assertEqual(bot.config, {'test': '12345', 'key': ['a', 'b']})
 
     def test_bot_core_client_config_file(self):
         tf = tempfile.NamedTemporaryFile()
@@ -100,6 +102,28 @@ class BotTestCase(TestCase):
         bot.reload_client_config()
         self.assertEqual(bot.config, {'test_key': ':effort:'})
 
+        # the config is kept if the new one is invalid.
+        tf.truncate(0)
+        tf.seek(0)
+        tf.write(b'{"test_key": ')
+        tf.flush()
+        self.assertRaises(ValueError, bot.reload_client_config)
+        self.assertEqual(bot.config, {'test_key': ':effort:'})
+
+        # or not an object.
+        for value in (b'5', b'null', b'[["a", "b"]]'):
+            tf.truncate(0)
+            tf.seek(0)
+            tf.write(value)
+            tf.flush()
+            self.assertRaises(ValueError, bot.reload_client_config)
+            self.assertEqual(bot.config, {'test_key': ':effort:'})
+
+        # or missing.
+        tf.close()
+        self.assertIsNone(bot.reload_client_config())
+        self.assertEqual(bot.config, {'test_key': ':effort:'})
+
     def test_connect(self):
         class TestClient(object):
             def __init__(self, *a, **kw):
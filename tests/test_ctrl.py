@@ -1,5 +1,7 @@
 from unittest import TestCase
 import json
+import os
+import signal
 import tempfile
 import sys
 from contextlib import contextmanager
@@ -60,6 +62,8 @@ class FakeBot(object):
         return True
     def setup_packages(self):
         return
+    def reload_packages(self):
+        return
 
 class FakeCmd(object):
     def __init__(self, bot):
@@ -248,6 +252,127 @@ class CtrlTestCase(TestCase):
             self.assertTrue('bot is dying in a fire, attempting to abort...'
                 in out.items)
 
+    def test_cmd_reload_config(self):
+        class ReloadBot(FakeBot):
+            reloaded = 0
+            config = None
+            def reload_client_config(self):
+                return self.config
+            def reload_packages(self):
+                self.reloaded += 1
+
+        bot = ReloadBot()
+        cmd = ctrl.JibberCmd(bot)
+        cmd.reload_config()
+        self.assertEqual(bot.reloaded, 0)
+        bot.config = '{}'
+        cmd.reload_config()
+        self.assertEqual(bot.reloaded, 1)
+
+        def broken():
+            raise ValueError('bad json')
+        bot.reload_client_config = broken
+        cmd.reload_config()
+        self.assertEqual(bot.reloaded, 1)
+
+    def test_cmd_reload_config_packages_failure(self):
+        class ReloadBot(FakeBot):
+            def __init__(self):
+                self.config = {'packages': ['good']}
+            def reload_client_config(self):
+                self.config.clear()
+                self.config['packages'] = ['bad']
+                return True
+            def reload_packages(self):
+                raise ImportError('bad')
+
+        bot = ReloadBot()
+        config = bot.config
+        cmd = ctrl.JibberCmd(bot)
+        cmd.reload_config()
+        self.assertIs(bot.config, config)
+        self.assertEqual(bot.config, {'packages': ['good']})
+
+    def test_cmd_watch_config_bad_package(self):
+        package = 'mtj.jibber.testing.command.GreeterCommand'
+        config = {
+            'nickname': 'testbot',
+            'packages': [{
+                'package': package,
+                'commands': [['^%(nickname)s: hi', 'say_hi']],
+                'timers': [{'schedule': [
+                    {'seconds': 60, 'method': 'say_hi'}]}],
+            }],
+        }
+        tf = tempfile.NamedTemporaryFile(mode='w', suffix='.json')
+        json.dump(config, tf)
+        tf.flush()
+        os.utime(tf.name, (1000, 1000))
+
+        bot = MucChatBot()
+        bot.client = TestClient()
+        bot.nickname = 'testbot'
+        bot.load_client_config_from_path(tf.name)
+        bot.setup_packages()
+        dispatch = bot.dispatch
+        obj = bot.objects[package]
+        timers = dict(bot.timers)
+        schedules = dict(bot.client.schedules)
+        client_config = json.loads(json.dumps(config))
+
+        cmd = ctrl.JibberCmd(bot)
+        cmd.reload_debounce = 0
+        previous = signal.getsignal(signal.SIGHUP)
+        watcher, handler = cmd.watch_config()
+        try:
+            config['packages'].insert(0, {'package': 'no.such.Module'})
+            tf.seek(0)
+            tf.truncate()
+            json.dump(config, tf)
+            tf.flush()
+            os.utime(tf.name, (1001, 1001))
+            # the failure is logged, not raised.
+            self.assertTrue(watcher.check())
+        finally:
+            signal.signal(signal.SIGHUP, previous)
+            tf.close()
+
+        # the packages, their timers, the dispatch and the client config
+        # survive.
+        self.assertEqual(bot.config, client_config)
+        self.assertIs(bot.dispatch, dispatch)
+        self.assertIs(bot.objects[package], obj)
+        self.assertEqual(bot.timers, timers)
+        self.assertEqual(bot.client.schedules, schedules)
+        self.assertEqual(bot.previous_objects, {})
+        bot.run_groupchat_message({
+            'mucnick': 'Tester',
+            'mucroom': 'testroom',
+            'body': 'testbot: hi',
+        })
+        self.assertEqual(bot.client.sent, ['hi Tester'])
+
+    def test_cmd_bot_fg_sighup(self):
+        class HupBot(FakeBot):
+            alive = 3
+            reloaded = 0
+            def is_alive(self):
+                if self.alive == 3:
+                    os.kill(os.getpid(), signal.SIGHUP)
+                return FakeBot.is_alive(self)
+            def reload_packages(self):
+                self.reloaded += 1
+
+        previous = signal.getsignal(signal.SIGHUP)
+        bot = HupBot()
+        cmd = ctrl.JibberCmd(bot)
+        cmd.timeout = 0
+        cmd.reload_debounce = 0
+        cmd.do_fg(())
+        self.assertEqual(bot.reloaded, 1)
+        self.assertEqual(bot.disconnected, 1)
+        self.assertEqual(signal.getsignal(signal.SIGHUP), previous)
+
     def test_cmd_bot_fg_kb(self):
         class KbFakeBot(FakeBot):
             def is_alive(self):
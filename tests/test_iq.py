@@ -0,0 +1,130 @@
+from unittest import TestCase
+
+from sleekxmpp.exceptions import IqError
+from sleekxmpp.exceptions import IqTimeout
+from sleekxmpp.stanza import Iq
+
+from mtj.jibber.iq import Histogram
+from mtj.jibber.iq import IqTracker
+
+
+def mk_response(iq_id, iq_type='result', condition=None):
+    iq = Iq()
+    iq['id'] = iq_id
+    iq['type'] = iq_type
+    if condition:
+        iq['error']['condition'] = condition
+    return iq
+
+
+class HistogramTestCase(TestCase):
+
+    def test_bounds(self):
+        hist = Histogram(bounds=(1, 2))
+        hist.add(1)
+        hist.add(1.5)
+        hist.add(2.5)
+        self.assertEqual(hist.counts, [1, 1, 1])
+        self.assertEqual(hist.max, 2.5)
+
+    def test_empty(self):
+        self.assertEqual(Histogram().stats()['mean'], 0)
+
+
+class IqTrackerTestCase(TestCase):
+
+    def test_result(self):
+        tracker = IqTracker()
+        iq = Iq()
+        future = tracker.track(iq, 'kick', now=10)
+        self.assertEqual(iq['id'], 'jibber-1')
+        self.assertFalse(future.done())
+        self.assertEqual(len(tracker), 1)
+
+        tracker.receive(mk_response('unknown'), now=11)
+        self.assertFalse(future.done())
+
+        response = mk_response('jibber-1')
+        tracker.receive(response, now=10.2)
+        self.assertIs(future.result(), response)
+        self.assertEqual(len(tracker), 0)
+
+        stats = tracker.stats()['kick']
+        self.assertEqual(stats['result'], 1)
+        self.assertEqual(stats['error'], 0)
+        self.assertEqual(stats['latency']['count'], 1)
+        self.assertAlmostEqual(stats['latency']['max'], 0.2)
+
+    def test_error(self):
+        tracker = IqTracker()
+        iq = Iq()
+        iq['id'] = 'given'
+        future = tracker.track(iq, 'affiliate', now=10)
+        tracker.receive(mk_response('given', 'error', 'forbidden'), now=11)
+        self.assertIsInstance(future.exception(), IqError)
+        self.assertEqual(future.exception().condition, 'forbidden')
+        self.assertEqual(tracker.stats()['affiliate']['error'], 1)
+
+    def test_timeout(self):
+        tracker = IqTracker(timeout=5)
+        first = tracker.track(Iq(), 'kick', now=10)
+        second = tracker.track(Iq(), 'kick', now=12)
+        tracker.expire(now=14)
+        self.assertFalse(first.done())
+        tracker.expire(now=15)
+        self.assertIsInstance(first.exception(), IqTimeout)
+        self.assertFalse(second.done())
+
+        # expiry also happens when tracking more.
+        third = tracker.track(Iq(), 'kick', now=17)
+        self.assertIsInstance(second.exception(), IqTimeout)
+        self.assertFalse(third.done())
+
+        stats = tracker.stats()['kick']
+        self.assertEqual(stats['timeout'], 2)
+        self.assertIsNone(stats['latency'])
+
+    def test_cancelled(self):
+        tracker = IqTracker(timeout=5)
+        first = tracker.track(Iq(), 'kick', now=10)
+        second = tracker.track(Iq(), 'kick', now=10)
+        third = tracker.track(Iq(), 'kick', now=11)
+        self.assertTrue(first.cancel())
+        self.assertTrue(third.cancel())
+        # the rest of the expired futures are still failed.
+        fourth = tracker.track(Iq(), 'kick', now=20)
+        self.assertTrue(first.cancelled())
+        self.assertIsInstance(second.exception(), IqTimeout)
+        self.assertEqual(len(tracker), 1)
+
+        fourth.cancel()
+        tracker.receive(mk_response('jibber-4'), now=21)
+        self.assertTrue(fourth.cancelled())
+        self.assertEqual(tracker.stats()['kick']['result'], 1)
+
+    def test_mark_sent(self):
+        tracker = IqTracker(timeout=5)
+        first = tracker.track(Iq(), 'kick', now=10)
+        second = tracker.track(Iq(), 'kick', now=11)
+        tracker.mark_sent('jibber-1', now=13)
+        tracker.mark_sent('jibber-404', now=13)
+        tracker.expire(now=16)
+        self.assertTrue(second.done())
+        self.assertFalse(first.done())
+        tracker.receive(mk_response('jibber-1'), now=14)
+        self.assertEqual(tracker.histograms['kick'].max, 1)
+
+    def test_max_pending(self):
+        tracker = IqTracker(max_pending=2)
+        futures = [tracker.track(Iq(), 'kick', now=10) for i in range(3)]
+        self.assertEqual(len(tracker), 2)
+        self.assertTrue(futures[0].cancelled())
+        self.assertFalse(futures[1].done())
+        self.assertEqual(tracker.stats()['kick']['dropped'], 1)
+
+    def test_cancel_all(self):
+        tracker = IqTracker()
+        future = tracker.track(Iq(), 'kick')
+        tracker.cancel_all()
+        self.assertTrue(future.cancelled())
+        self.assertEqual(len(tracker), 0)
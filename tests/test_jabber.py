@@ -1,9 +1,18 @@
 from unittest import TestCase
+import threading
+import time
 
+from sleekxmpp.stanza import Iq
 from sleekxmpp.xmlstream import ET
 
+from mtj.jibber.core import Handler
 from mtj.jibber.jabber import MucChatBot
+from mtj.jibber.loader import LazyPackage
+from mtj.jibber.reply import Reply
+from mtj.jibber.stanza import admin_query
+from mtj.jibber.testing.client import Jid
 from mtj.jibber.testing.client import TestClient
+from mtj.jibber.testing.command import GreeterCommand
 
 
 class DummyClient(object):
@@ -124,6 +133,45 @@ class MucBotTestCase(TestCase):
         self.assertEqual(html.text, 'test')
         self.assertEqual(msg, {'mbody': 'test', 'mto': '',})
 
+    def test_send_message_html_cached(self):
+        bot = self.mk_default_bot()
+        bot.send_message(raw='<p>test x</p>', mto='')
+        first = bot.client.msg[-1]['mhtml']
+        # modifying the sent element does not change the cached one.
+        first.text = 'changed'
+        bot.send_message(raw='<p>test x</p>', mto='')
+        msg = bot.client.msg[-1]
+        html = msg.pop('mhtml')
+        self.assertIsNot(html, first)
+        self.assertEqual(html.text, 'test x')
+        self.assertEqual(msg, {'mbody': 'test x', 'mto': ''})
+        self.assertEqual(bot.html_cache.stats(),
+            {'hits': 1, 'misses': 1, 'size': 1})
+
+        # the plain text is derived from raw if provided separately.
+        bot.send_message(raw='<p>plain</p>', mto='',
+            mhtml='<p>test x</p>')
+        msg = bot.client.msg[-1]
+        self.assertEqual(msg['mbody'], 'plain')
+        self.assertEqual(bot.html_cache.hits, 2)
+
+        # failures are cached too.
+        bot.send_message(raw='<p>test', mto='')
+        bot.send_message(raw='<p>test', mto='')
+        self.assertEqual(bot.client.msg[-1],
+            {'mbody': '<p>test', 'mhtml': None, 'mto': '',})
+        self.assertEqual(bot.html_cache.stats(),
+            {'hits': 3, 'misses': 2, 'size': 2})
+
+    def test_send_message_html_cache_disabled(self):
+        self.config['html_cache_size'] = 0
+        bot = self.mk_default_bot()
+        self.assertIsNone(bot.html_cache)
+        bot.send_message(raw='<p>test</p>', mto='')
+        msg = bot.client.msg[-1]
+        self.assertEqual(msg.pop('mhtml').text, 'test')
+        self.assertEqual(msg, {'mbody': 'test', 'mto': ''})
+
     def test_send_message_malformed_html(self):
         bot = self.mk_default_bot()
         bot.send_message(raw='<p>test', mto='')
@@ -272,6 +320,90 @@ class MucBotTestCase(TestCase):
             {'mto': 'beacon@example.com', 'mbody': 'test123', 'mhtml': None},
         ])
 
+    def test_send_package_method_multiline_spam_coalesced(self):
+        self.config['coalesce_size'] = 100
+        bot = self.mk_default_bot()
+        bot.send_package_method(
+            'mtj.jibber.testing.command.GreeterCommand', 'multiline_spam',
+             mto='test@example.com')
+        self.assertEqual(bot.client.msg, [
+            {'mto': 'test@example.com', 'mbody': 'a set of\nmultiple line\n'
+                'spam', 'mhtml': None},
+            {'mto': 'beacon@example.com', 'mbody': 'test123', 'mhtml': None},
+        ])
+
+    def test_send_package_method_list_trap_coalesced(self):
+        self.config['coalesce_size'] = 100
+        bot = self.mk_default_bot()
+        bot.send_package_method(
+            'mtj.jibber.testing.command.GreeterCommand', 'to_trap',
+             mto='test@chat.example.com')
+        self.assertEqual(bot.client.msg, [
+            {'mto': 'trap@example.com', 'mbody': 'pretrap', 'mhtml': None},
+            {'mto': 'trap@example.com', 'mbody': 'posttrap', 'mhtml': None},
+        ])
+
+    def test_coalesce_replies(self):
+        self.config['coalesce_size'] = 10
+        bot = self.mk_default_bot()
+        kwargs = {'mto': 'room@example.com', 'mtype': 'groupchat'}
+        self.assertEqual(bot.coalesce_replies([
+            'abc',
+            {'raw': 'def', 'mto': 'room@example.com'},
+            'ghijkl',
+            {'raw': 'mno', 'mtype': 'chat'},
+            {'raw': 'pqr', 'mbody': 'pqr'},
+            'stu',
+        ], kwargs), [
+            {'mto': 'room@example.com', 'mtype': 'groupchat',
+                'raw': 'abc\ndef'},
+            {'mto': 'room@example.com', 'mtype': 'groupchat',
+                'raw': 'ghijkl'},
+            {'mto': 'room@example.com', 'mtype': 'chat', 'raw': 'mno'},
+            {'raw': 'pqr', 'mbody': 'pqr'},
+            {'mto': 'room@example.com', 'mtype': 'groupchat', 'raw': 'stu'},
+        ])
+
+    def test_coalesce_replies_html(self):
+        self.config['coalesce_size'] = 100
+        bot = self.mk_default_bot()
+        kwargs = {'mto': 'room@example.com'}
+        self.assertEqual(bot.coalesce_replies([
+            'a < b',
+            '<p>b <b>c</b></p>',
+        ], kwargs), [{
+            'mto': 'room@example.com',
+            'raw': '<body>a &lt; b<br/><p>b <b>c</b></p></body>',
+            'mbody': 'a < b\nb c',
+        }])
+        # the plain text of the html parts is kept in the html cache.
+        bot.coalesce_replies(['x', '<p>b <b>c</b></p>'], kwargs)
+        self.assertEqual(bot.html_cache.stats(),
+            {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_send_package_method_reply(self):
+        bot = self.mk_default_bot()
+        bot.client = TestClient()
+        bot.send_package_method(
+            'mtj.jibber.testing.command.GreeterCommand', 'rich_reply',
+             msg={'mucnick': 'Tester'}, mto='room@example.com',
+             mtype='groupchat')
+        self.assertEqual(bot.client.sent, [])
+        first, second = bot.client.raw
+        self.assertEqual(first['to'], 'room@example.com')
+        self.assertEqual(first['type'], 'groupchat')
+        self.assertEqual(first['body'], 'Hello Tester')
+        html = first.xml.find(
+            '{http://jabber.org/protocol/xhtml-im}html/'
+            '{http://www.w3.org/1999/xhtml}body')
+        self.assertEqual(html.text, 'Hello ')
+        self.assertEqual(html[0].text, 'Tester')
+
+        self.assertEqual(second['to'], 'beacon@example.com')
+        self.assertEqual(second['body'], 'plain')
+        self.assertIsNone(second.xml.find(
+            '{http://jabber.org/protocol/xhtml-im}html'))
+
     def test_send_package_method_error(self):
         class E(object):
             def fail(self):
@@ -393,6 +525,35 @@ class MucBotTestCase(TestCase):
         })
         self.assertEqual(bot.client.msg, [])
 
+    def test_muc_bot_command_nickname_changed(self):
+        bot = self.mk_default_bot()
+        table = bot.command_triggers
+        bot.run_command({
+            'mucnick': 'tester',
+            'mucroom': 'testroom',
+            'body': 'testbot: hi',
+        })
+        # table is reused while the nickname remains unchanged.
+        self.assertIs(bot.command_triggers, table)
+        self.assertEqual(len(bot.client.msg), 1)
+
+        bot.nickname = 'newbot'
+        bot.run_command({
+            'mucnick': 'tester',
+            'mucroom': 'testroom',
+            'body': 'testbot: hi',
+        })
+        self.assertIsNot(bot.command_triggers, table)
+        self.assertEqual(len(bot.client.msg), 1)
+
+        bot.run_command({
+            'mucnick': 'tester',
+            'mucroom': 'testroom',
+            'body': 'newbot: hi',
+        })
+        self.assertEqual(len(bot.client.msg), 2)
+        self.assertEqual(bot.client.msg[1]['mbody'], 'hi tester')
+
     def test_muc_bot_fail_not_command(self):
         bot = MucChatBot()
         bot.client = DummyClient()
@@ -441,6 +602,31 @@ class MucBotTestCase(TestCase):
         })
         self.assertEqual(len(bot.client.msg), 0)
 
+    def test_muc_bot_private_command_table(self):
+        self.private_commands = [
+            ['^!echo (.*)$', 'pm_reply'],
+            ['^dddd$', 'pm_reply'],
+            ['(echo)', 'pm_reply'],
+        ]
+        self.rebuild_config()
+        bot = self.mk_default_bot()
+        self.assertEqual(len(bot.private_command_triggers), 3)
+
+        bot.run_private_command({
+            'type': 'chat',
+            'body': 'nothing to see',
+            'from': 'nobody@example.com',
+        })
+        self.assertEqual(len(bot.client.msg), 0)
+
+        bot.run_private_command({
+            'type': 'chat',
+            'body': '!Echo hi',
+            'from': 'nobody@example.com',
+        })
+        self.assertEqual([m['mbody'] for m in bot.client.msg],
+            ['You said: hi', 'You said: Echo'])
+
     def test_muc_bot_success_private_command_none(self):
         self.private_commands = []
         self.rebuild_config()
@@ -679,6 +865,7 @@ class MucBotTestCase(TestCase):
         bot = self.mk_default_bot()
         bot.objects['error'] = E()
         bot.listeners.append(('error', 'fail'))
+        bot.publish_dispatch()
         kw = {'mucnick': 'tester', 'mucroom': 'testroom', 'body': 'print'}
         bot.run_listener(kw)
         # error should be logged
@@ -742,6 +929,69 @@ class MucBotTestCase(TestCase):
         self.assertEqual(list(bot.commentary), ["bye.", "BOOM"])
         # would have repeated himself but we already tested that.
 
+    def test_muc_bot_commentary_window(self):
+        self.config['commentary_window'] = 60
+        bot = self.mk_default_bot()
+        self.assertEqual(bot.commentary.window, 60)
+        bot.commentary.add('hello', now=0)
+        self.assertNotIn('hello', bot.commentary)
+
+    def test_muc_bot_reply_bodies(self):
+        bot = self.mk_default_bot()
+        self.assertEqual(bot.reply_bodies([
+            'plain',
+            '<p>some <b>html</b></p>',
+            '<p>broken',
+            {'raw': '<p>raw</p>', 'mto': 'someone@example.com'},
+            {'mbody': 'body', 'raw': 'raw'},
+            {'mhtml': '<p>nothing</p>'},
+            Reply('Hello ').strong('tester'),
+            None,
+            '',
+        ]), ['plain', 'some html', '<p>broken', 'raw', 'body',
+            'Hello tester'])
+        self.assertEqual(bot.reply_bodies('hi'), ['hi'])
+        self.assertEqual(bot.reply_bodies(None), [])
+
+    def test_muc_bot_commentator_list(self):
+        self.commentators.append(['^hello', 'rich_reply'])
+        self.config['commentary_qsize'] = 1000
+        bot = self.mk_default_bot()
+        bot.client = TestClient()
+        bot.run_commentator({
+            'mucnick': 'tester',
+            'mucroom': 'testroom',
+            'body': 'hello',
+        })
+        self.assertEqual(list(bot.commentary), ['Hello tester', 'plain'])
+        bot.run_commentator({
+            'mucnick': 'testbot',
+            'mucroom': 'testroom',
+            'body': 'Hello tester',
+        })
+        self.assertEqual(len(bot.client.raw), 2)
+
+    def test_muc_bot_commentator_coalesced(self):
+        self.commentators.append(['spam$', 'multiline_spam'])
+        self.config['coalesce_size'] = 100
+        self.config['commentary_qsize'] = 10
+        bot = self.mk_default_bot()
+        bot.run_commentator({
+            'mucnick': 'tester',
+            'mucroom': 'testroom',
+            'body': 'spam',
+        })
+        self.assertEqual(len(bot.client.msg), 2)
+        # the bodies as sent after coalescing are remembered.
+        self.assertEqual(list(bot.commentary), [
+            'a set of\nmultiple line\nspam', 'test123'])
+        bot.run_commentator({
+            'mucnick': 'testbot',
+            'mucroom': 'testroom',
+            'body': 'a set of\nmultiple line\nspam',
+        })
+        self.assertEqual(len(bot.client.msg), 2)
+
     def test_muc_bot_commentator_explicit(self):
         self.commentators.append(['repeat: ', 'repeat_you'])
         bot = self.mk_default_bot()
@@ -760,10 +1010,466 @@ class MucBotTestCase(TestCase):
         })
         self.assertEqual(len(bot.client.msg), 1)
 
+    def test_muc_bot_groupchat_message(self):
+        self.commentators.append(['hi', 'repeat_you'])
+        bot = self.mk_default_bot()
+        msg = {
+            'mucnick': 'tester',
+            'mucroom': 'testroom',
+            'body': 'testbot: hi',
+        }
+        bot.run_groupchat_message(msg)
+        # commentary first, then the command and the listener.
+        self.assertEqual([m['mbody'] for m in bot.client.msg],
+            ['testbot: hi', 'hi tester'])
+        self.assertEqual(bot.objects[self.test_package].listened, [msg])
+
+        # the bot hearing itself will be ignored.
+        bot.run_groupchat_message({
+            'mucnick': 'testbot',
+            'mucroom': 'testroom',
+            'body': 'testbot: hi',
+        })
+        self.assertEqual(len(bot.client.msg), 2)
+        self.assertEqual(bot.objects[self.test_package].listened, [msg])
+
+    def test_muc_bot_groupchat_message_phase_error(self):
+        bot = self.mk_default_bot()
+        # listener referencing missing object will fail, but only
+        # after the other phases are done.
+        bot.listeners.insert(0, ('missing', 'fail'))
+        bot.publish_dispatch()
+        bot.run_groupchat_message({
+            'mucnick': 'tester',
+            'mucroom': 'testroom',
+            'body': 'testbot: hi',
+        })
+        self.assertEqual(bot.client.msg[0]['mbody'], 'hi tester')
+
     def test_muc_bot_commentary_qsize_fail(self):
         self.config['commentary_qsize'] = 0
         self.assertRaises(ValueError, self.mk_default_bot)
 
+    def test_muc_bot_workers(self):
+        self.config['workers'] = {'size': 1}
+        bot = self.mk_default_bot()
+        self.assertIsNotNone(bot.workers)
+        done = threading.Event()
+        register_timer = bot.register_timer
+        def register_and_signal(*a, **kw):
+            register_timer(*a, **kw)
+            done.set()
+        # as the timer is reset after the reply is sent.
+        bot.register_timer = register_and_signal
+
+        result = bot.send_package_method(
+            'mtj.jibber.testing.command.GreeterCommand', 'say_hello_all',
+             mto='test@chat.example.com')
+        # queued rather than the actual result.
+        self.assertTrue(result)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(bot.client.msg, [
+            {'mbody': 'hello all', 'mto': 'test@chat.example.com',
+            'mhtml': None},
+        ])
+        # the timer was rescheduled by the worker.
+        self.assertEqual(len(bot.client.schedules), 3)
+
+        workers = bot.workers
+        bot.setup_packages()
+        # a new pool of workers replaces the old one.
+        self.assertIsNot(bot.workers, workers)
+        self.assertEqual(workers.threads, [])
+
+        del self.config['workers']
+        bot.setup_packages()
+        self.assertIsNone(bot.workers)
+
+    def test_muc_bot_workers_disconnect(self):
+        self.config['workers'] = {'size': 2}
+        self.config['inbound'] = {'size': 10}
+        bot = self.mk_default_bot()
+        bot.client.disconnect = lambda: None
+        done = []
+        closed = []
+
+        def slow():
+            time.sleep(0.1)
+            return 'slow'
+
+        def dispatch(item):
+            bot.workers.submit('pkg', slow, done.append)
+
+        def close_packages():
+            # the calls must be done by the time the packages are closed.
+            closed.append(len(done))
+
+        bot.inbound.dispatch = dispatch
+        bot.close_packages = close_packages
+        for i in range(2):
+            bot.inbound.put('room', i)
+        bot.disconnect()
+        self.assertEqual(closed, [2])
+        self.assertEqual(done, ['slow', 'slow'])
+
+    def test_muc_bot_inbound(self):
+        self.config['inbound'] = {'size': 2, 'policy': 'drop_listeners'}
+        bot = self.mk_default_bot()
+        # dispatch manually rather than in the thread.
+        bot.inbound.stop()
+        bot.inbound.thread.join(5)
+
+        def msg(body):
+            return {
+                'mucnick': 'tester',
+                'mucroom': 'testroom',
+                'body': body,
+            }
+
+        bot.run_groupchat_message(msg('testbot: hi'))
+        bot.run_groupchat_message(msg('just chatting'))
+        bot.run_groupchat_message(msg('testbot: hello'))
+        self.assertEqual(bot.client.msg, [])
+        # the chatter was only of interest to the listeners.
+        self.assertEqual(bot.inbound.stats(), {
+            'queued': 2, 'shed': {'listeners': 1}})
+
+        bot.inbound.work()
+        self.assertEqual([m['mbody'] for m in bot.client.msg],
+            ['hi tester', 'hello all'])
+        self.assertEqual(
+            [m['body'] for m in bot.objects[self.test_package].listened],
+            ['testbot: hi', 'testbot: hello'])
+
+        inbound = bot.inbound
+        bot.stop_inbound()
+        self.assertIsNone(bot.inbound)
+        self.assertTrue(inbound.stopped)
+
+    def test_muc_bot_outbound(self):
+        self.config['outbound'] = {'rate': 1, 'burst': 1}
+        bot = self.mk_default_bot()
+        bot.outbound.stop()
+        bot.outbound.thread.join(5)
+        bot.client.send = bot.client.msg.append
+
+        bot.send_package_method(
+            'mtj.jibber.testing.command.GreeterCommand', 'multiline_spam',
+             mto='test@example.com')
+        bot.send_stanza({'to': 'test@example.com'}, priority=True)
+        self.assertEqual(bot.client.msg, [])
+        self.assertEqual(len(bot.outbound), 5)
+
+        # only the first message and the priority stanza can be sent
+        # right away.
+        bot.outbound.poll(0)[0]()
+        bot.outbound.poll(0)[0]()
+        bot.outbound.poll(0)[0]()
+        self.assertEqual(bot.client.msg, [
+            {'to': 'test@example.com'},
+            {'mto': 'test@example.com', 'mbody': 'a set of', 'mhtml': None},
+            {'mto': 'beacon@example.com', 'mbody': 'test123', 'mhtml': None},
+        ])
+        self.assertEqual(bot.outbound.poll(0)[0], None)
+
+        bot.stop_outbound()
+        self.assertIsNone(bot.outbound)
+
+    def test_muc_bot_outbound_disconnect(self):
+        self.config['outbound'] = {'rate': 100, 'burst': 1}
+        bot = self.mk_default_bot()
+        client = bot.client
+        disconnected = []
+
+        def disconnect():
+            # the queued messages must be sent by now.
+            disconnected.append(len(client.msg))
+
+        client.disconnect = disconnect
+        bot.send_package_method(
+            'mtj.jibber.testing.command.GreeterCommand', 'multiline_spam',
+             mto='test@example.com')
+        bot.disconnect()
+        self.assertIsNone(bot.outbound)
+        self.assertIsNone(bot.client)
+        self.assertEqual(disconnected, [4])
+
+    def test_muc_bot_occupants(self):
+        bot = MucChatBot()
+        bot.client = TestClient()
+        bot.muc = bot.client.muc
+        bot.config = self.config
+        bot.setup_client()
+        self.assertIn(('groupchat_presence', bot.update_occupants),
+            bot.client.events)
+
+        room = 'testroom@chat.example.com'
+        bot.muc.rooms[room]['Rob'] = {
+            'jid': Jid('rob', 'rob@example.com', 'home')}
+
+        def presence(nick, jid=None, ptype='available', role='participant',
+                affiliation='none'):
+            bot.update_occupants({
+                'from': Jid('testroom', room, nick),
+                'type': ptype,
+                'muc': {'jid': jid, 'role': role, 'affiliation': affiliation},
+            })
+
+        # not indexed until needed.
+        presence('Early', Jid('early', 'early@example.com', 'x'))
+        self.assertEqual(bot.occupants, {})
+
+        index = bot.room_occupants(room)
+        self.assertIs(bot.room_occupants(room), index)
+        self.assertEqual(index.jid_of('Rob'), 'rob@example.com')
+
+        presence('Alice', Jid('alice', 'alice@example.com', 'x'))
+        self.assertEqual(index.jid_of('Alice'), 'alice@example.com')
+        # nick change
+        presence('Alice', ptype='unavailable')
+        presence('Alicia', Jid('alice', 'alice@example.com', 'x'))
+        self.assertNotIn('Alice', index)
+        self.assertEqual(index.nicks_of('alice@example.com'),
+            set(['Alicia']))
+        self.assertEqual(list(index.with_role('participant')), ['Alicia'])
+
+        # role changes
+        presence('Alicia', Jid('alice', 'alice@example.com', 'x'),
+            role='moderator', affiliation='member')
+        self.assertEqual(index.role_of('Alicia'), 'moderator')
+        self.assertEqual(list(index.with_affiliation('member')), ['Alicia'])
+        self.assertEqual(len(index.with_role('participant')), 0)
+
+        # the bot leaving the room drops the index.
+        presence(bot.nickname, ptype='unavailable')
+        self.assertEqual(bot.occupants, {})
+
+    def test_muc_bot_close_packages(self):
+        bot = self.mk_default_bot()
+        bot.client.disconnect = lambda: None
+        closed = []
+        obj = bot.objects[self.test_package]
+        obj.close = lambda: closed.append(obj)
+        bot.setup_packages()
+        self.assertEqual(closed, [obj])
+
+        def broken():
+            raise Exception('broken')
+
+        bot.objects[self.test_package].close = broken
+        bot.disconnect()
+        self.assertIsNone(bot.client)
+
+    def test_muc_bot_setup_packages_loads_once(self):
+        self.config['packages'].append({
+            'package': self.test_package,
+            'alias': 'second',
+        })
+        bot = self.mk_default_bot()
+        cls = type(bot.objects[self.test_package])
+        self.assertIs(type(bot.objects['second']), cls)
+        self.assertEqual(list(bot.loader.times),
+            ['mtj.jibber.testing.command'])
+
+        # the unchanged module is not reloaded.
+        bot.setup_packages()
+        self.assertIs(type(bot.objects[self.test_package]), cls)
+        self.assertFalse(bot.loader.times['mtj.jibber.testing.command'][1])
+
+    def test_muc_bot_reload_packages(self):
+        bot = self.mk_default_bot()
+        obj = bot.objects[self.test_package]
+        obj.listened.append('state')
+        closed = []
+        obj.close = lambda: closed.append(obj)
+        self.assertEqual(len(bot.client.schedules), 2)
+
+        self.config['packages'].append({
+            'package': self.test_package,
+            'alias': 'second',
+            'commands': [['^second$', 'say_hi']],
+            'timers': [{'schedule': [{'seconds': 60, 'method': 'say_hi'}]}],
+        })
+        bot.reload_packages()
+        self.assertIs(bot.objects[self.test_package], obj)
+        self.assertEqual(obj.listened, ['state'])
+        second = bot.objects['second']
+        # only the timer for the new package was scheduled.
+        self.assertEqual(bot.client.schedules[2:], [str(('second', 'say_hi'))])
+        self.assertIn(('^second$', 'second', 'say_hi'), bot.commands)
+        self.assertEqual(closed, [])
+
+        # changing the kwargs creates a new instance.
+        self.config['packages'][0]['kwargs'] = {'a': 1}
+        bot.reload_packages()
+        self.assertIsNot(bot.objects[self.test_package], obj)
+        self.assertEqual(bot.objects[self.test_package].kw, {'a': 1})
+        self.assertIs(bot.objects['second'], second)
+        self.assertEqual(closed, [obj])
+        # the triggers are unchanged, so the tables are kept.
+        triggers = bot.command_triggers
+        bot.reload_packages()
+        self.assertIs(bot.command_triggers, triggers)
+        self.assertEqual(len(bot.client.schedules), 5)
+
+        # removing the entry closes the instance and its timer.
+        second.close = lambda: closed.append(second)
+        self.config['packages'].pop()
+        bot.reload_packages()
+        self.assertEqual(closed, [obj, second])
+        self.assertNotIn('second', bot.objects)
+        self.assertNotIn(('second', 'say_hi'), bot.timers)
+        self.assertNotIn(str(('second', 'say_hi')), bot.client.scheduler)
+        self.assertEqual(len(bot.client.schedules), 5)
+
+    def test_muc_bot_reload_packages_timer_fired(self):
+        bot = self.mk_default_bot()
+        timer = (self.test_package, 'say_hello_all')
+        kwargs = bot.timers[timer][1]
+        setup_package_entries = bot.setup_package_entries
+
+        def fire():
+            # like the scheduler, the timer is removed once it fires.
+            bot.client.scheduler.remove(str(timer))
+            bot.run_timer(bot.send_package_method, timer, kwargs)
+
+        def setup_and_fire():
+            fire()
+            setup_package_entries()
+
+        bot.setup_package_entries = setup_and_fire
+        bot.reload_packages()
+        # the timer is rescheduled and kept as it is unchanged.
+        self.assertIn(str(timer), bot.client.scheduler)
+        self.assertIn(timer, bot.timers)
+
+        self.config['packages'].append({'package': 'no.such.Module'})
+        self.assertRaises(ImportError, bot.reload_packages)
+        self.assertIn(str(timer), bot.client.scheduler)
+        self.assertEqual(len(bot.client.msg), 2)
+
+    def test_muc_bot_reload_packages_failure(self):
+        bot = MucChatBot()
+        bot.client = TestClient()
+        bot.nickname = 'testbot'
+        bot.config = self.config
+        bot.setup_packages()
+        obj = bot.objects[self.test_package]
+        dispatch = bot.dispatch
+        timers = bot.timers
+        schedules = dict(bot.client.schedules)
+        package_keys = dict(bot.package_keys)
+
+        created = []
+        closed = []
+        original = GreeterCommand.__init__
+
+        def init(self, *a, **kw):
+            original(self, *a, **kw)
+            created.append(self)
+            self.close = lambda: closed.append(self)
+
+        self.config['packages'].insert(0, {
+            'package': self.test_package,
+            'alias': 'new',
+            'commands': [['^new$', 'say_hi']],
+            'timers': [{'schedule': [{'seconds': 60, 'method': 'say_hi'}]}],
+            'raw_handlers': {'new_event': ['listener']},
+        })
+        self.config['packages'].append({'package': 'no.such.Module'})
+        GreeterCommand.__init__ = init
+        try:
+            self.assertRaises(ImportError, bot.reload_packages)
+        finally:
+            GreeterCommand.__init__ = original
+
+        # everything is as it was, with the new instance closed.
+        self.assertIs(bot.dispatch, dispatch)
+        self.assertIs(bot.objects, dispatch.objects)
+        self.assertIs(bot.objects[self.test_package], obj)
+        self.assertNotIn('new', bot.objects)
+        self.assertIs(bot.timers, timers)
+        self.assertEqual(bot.client.schedules, schedules)
+        self.assertEqual(bot.package_keys, package_keys)
+        self.assertEqual(bot.previous_objects, {})
+        self.assertEqual(closed, created)
+        self.assertEqual(len(created), 1)
+        self.assertNotIn(('^new$', 'new', 'say_hi'), bot.commands)
+        self.assertEqual(bot.raw_handlers['new_event'], [])
+
+        # and the next reload works from there.
+        self.config['packages'].pop()
+        bot.reload_packages()
+        self.assertIs(bot.objects[self.test_package], obj)
+        self.assertIn('new', bot.objects)
+        self.assertEqual(bot.previous_objects, {})
+
+    def test_muc_bot_dispatch_snapshot(self):
+        bot = self.mk_default_bot()
+        dispatch = bot.dispatch
+        obj = bot.objects[self.test_package]
+        self.assertIs(dispatch.objects, bot.objects)
+        self.assertEqual(dispatch.listeners, ((self.test_package,
+            'listener'),))
+
+        # the state being built is not visible until published.
+        bot.listeners.append(('missing', 'fail'))
+        msg = {'mucnick': 'tester', 'mucroom': 'testroom', 'body': 'hi'}
+        bot.run_listener(msg)
+        self.assertEqual(obj.listened, [msg])
+
+        # messages being dispatched keep using their snapshot.
+        views = []
+        run_listener = MucChatBot._run_listener
+
+        def reload_then_listen(bot, view):
+            views.append(view)
+            bot.setup_packages()
+            run_listener(bot, view)
+
+        bot._groupchat_phases = (reload_then_listen,)
+        bot.run_groupchat_message(msg)
+        self.assertIs(views[0].dispatch, dispatch)
+        self.assertIsNot(bot.dispatch, dispatch)
+        self.assertEqual(obj.listened, [msg, msg])
+        self.assertEqual(bot.objects[self.test_package].listened, [])
+
+    def test_muc_bot_iq_tracker(self):
+        self.config['iq_tracker'] = {'timeout': 10}
+        bot = MucChatBot()
+        bot.client = TestClient()
+        bot.nickname = 'testbot'
+        bot.config = self.config
+        bot.setup_packages()
+        self.assertEqual(len(bot.client.handlers), 2)
+        self.assertIn('jibber iq tracker', bot.client.schedules)
+
+        # untracked without an action
+        self.assertIsNone(bot.send_stanza(admin_query(
+            'room@example.com', nick='a')))
+
+        future = bot.send_stanza(admin_query('room@example.com', nick='b'),
+            priority=True, action='kick')
+        self.assertEqual(len(bot.client.raw), 2)
+        sent = bot.client.raw[1]
+
+        response = Iq()
+        response['id'] = sent['id']
+        response['type'] = 'result'
+        for handler in bot.client.handlers:
+            if handler.match(response):
+                handler.run(response)
+        self.assertIs(future.result(), response)
+        self.assertEqual(bot.iq_tracker.stats()['kick']['result'], 1)
+
+        pending = bot.send_stanza(admin_query('room@example.com', nick='c'),
+            action='kick')
+        bot.stop_iq_tracker()
+        self.assertTrue(pending.cancelled())
+        self.assertIsNone(bot.iq_tracker)
+        # both of the handlers are removed.
+        self.assertEqual(bot.client.handlers, [])
+
     def test_run_timer(self):
         bot = self.mk_default_bot()
         def testfunc(s, c):
@@ -819,6 +1525,105 @@ class MucBotTestCase(TestCase):
 
         self.assertEqual(bot.objects['dummy'].listened, ['msg'])
 
+    def test_muc_bot_lazy_package(self):
+        bot = MucChatBot()
+        bot.client = TestClient()
+        bot.nickname = 'testbot'
+        bot.config = {
+            'nickname': 'testbot',
+            'packages': [
+                {
+                    'package': 'mtj.jibber.testing.command.GreeterCommand',
+                    'alias': 'lazy',
+                    'lazy': True,
+                    'commands': [['^%(nickname)s: hi', 'say_hi']],
+                    'listeners': ['listener'],
+                    'raw_handlers': {'presence': ['listener']},
+                },
+                {
+                    'package': 'mtj.jibber.bot.LastActivity',
+                    'alias': 'broken',
+                    'lazy': True,
+                    'kwargs': {'no_such_argument': 1},
+                    'raw_handlers': {'presence': ['listener']},
+                },
+            ],
+        }
+        bot.setup_packages()
+        lazy = bot.objects['lazy']
+        self.assertIsInstance(lazy, LazyPackage)
+        self.assertIsNone(lazy.obj)
+        # the triggers are registered right away.
+        self.assertEqual(bot.commands, [
+            ('^%(nickname)s: hi', 'lazy', 'say_hi')])
+
+        bot.client.events[0][1]('msg')
+        obj = lazy.obj
+        self.assertIsInstance(obj, GreeterCommand)
+        self.assertEqual(obj.listened, ['msg'])
+        # the broken one will be tried again.
+        self.assertIsNone(bot.objects['broken'].obj)
+
+        bot.run_groupchat_message({
+            'mucnick': 'Tester',
+            'mucroom': 'testroom',
+            'body': 'testbot: hi',
+        })
+        self.assertEqual(bot.client.sent[-1], 'hi Tester')
+        self.assertIs(bot.package_object('lazy'), obj)
+
+        closed = []
+        obj.close = lambda: closed.append(obj)
+        bot.close_packages()
+        self.assertEqual(closed, [obj])
+
+    def test_muc_bot_lazy_package_broken_listener(self):
+        bot = MucChatBot()
+        bot.client = TestClient()
+        bot.nickname = 'testbot'
+        bot.config = {
+            'nickname': 'testbot',
+            'packages': [
+                {
+                    'package': 'mtj.jibber.bot.LastActivity',
+                    'alias': 'broken',
+                    'lazy': True,
+                    'kwargs': {'no_such_argument': 1},
+                    'listeners': ['message_recorder'],
+                },
+                {
+                    'package': 'mtj.jibber.testing.command.GreeterCommand',
+                    'alias': 'greeter',
+                    'listeners': ['listener'],
+                },
+            ],
+        }
+        bot.setup_packages()
+        msg = {
+            'mucnick': 'Tester',
+            'mucroom': 'testroom',
+            'body': 'hello',
+        }
+        bot.run_listener(msg)
+        # the listeners after the one that failed to be set up are run.
+        self.assertEqual(bot.objects['greeter'].listened, [msg])
+
+    def test_muc_bot_lazy_package_concurrent(self):
+        created = []
+
+        class Slow(Handler):
+            def __init__(self):
+                created.append(self)
+                time.sleep(0.05)
+
+        lazy = LazyPackage(Slow, {}, 'slow')
+        threads = [threading.Thread(target=lazy.resolve) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(created, [lazy.obj])
+
     def test_muc_bot_test_raw_handlers_multi(self):
         bot = MucChatBot()
         bot.client = TestClient()
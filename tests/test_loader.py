@@ -0,0 +1,72 @@
+from unittest import TestCase
+import os
+import shutil
+import sys
+import tempfile
+
+from mtj.jibber.loader import ModuleLoader
+from mtj.jibber.loader import source_path
+
+
+class ModuleLoaderTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'jibber_loader_mod.py')
+        self.write('value = 1\n', 1000000000)
+        self.loader = ModuleLoader()
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir)
+        sys.modules.pop('jibber_loader_mod', None)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, source, mtime):
+        with open(self.path, 'w') as fd:
+            fd.write(source)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_load_once_per_pass(self):
+        self.loader.begin()
+        mod = self.loader.load('jibber_loader_mod')
+        self.assertEqual(mod.value, 1)
+        self.assertEqual(source_path(mod), self.path)
+        self.write('value = 2\n', 1000000100)
+        # same pass, not checked again.
+        self.assertEqual(self.loader.load('jibber_loader_mod').value, 1)
+        self.assertFalse(self.loader.times['jibber_loader_mod'][1])
+
+        self.loader.begin()
+        self.assertIs(self.loader.load('jibber_loader_mod'), mod)
+        self.assertEqual(mod.value, 2)
+        self.assertTrue(self.loader.times['jibber_loader_mod'][1])
+
+    def test_unchanged_not_reloaded(self):
+        self.loader.begin()
+        mod = self.loader.load('jibber_loader_mod')
+        mod.value = 'state'
+        self.loader.begin()
+        self.loader.load('jibber_loader_mod')
+        self.assertEqual(mod.value, 'state')
+
+        # touched, but the contents are the same.
+        self.write('value = 1\n', 1000000100)
+        self.loader.begin()
+        self.loader.load('jibber_loader_mod')
+        self.assertEqual(mod.value, 'state')
+        self.assertFalse(self.loader.times['jibber_loader_mod'][1])
+        self.assertEqual(self.loader.signatures['jibber_loader_mod'][0],
+            1000000100)
+
+    def test_log_times(self):
+        self.loader.begin()
+        self.loader.load('jibber_loader_mod')
+        self.loader.log_times()
+
+    def test_no_source(self):
+        self.loader.begin()
+        self.loader.load('sys')
+        self.loader.begin()
+        self.loader.load('sys')
+        self.assertIsNone(self.loader.signatures['sys'])
@@ -0,0 +1,83 @@
+import random
+from unittest import TestCase
+
+from mtj.jibber.occupants import IndexedSet
+from mtj.jibber.occupants import RoomOccupants
+from mtj.jibber.testing.client import Jid
+
+
+class RoomOccupantsTestCase(TestCase):
+
+    def test_from_roster(self):
+        room = RoomOccupants.from_roster({
+            'Rob': {'jid': Jid('rob', 'rob@example.com', 'home')},
+            'The Robot': {'jid': Jid('rob', 'rob@example.com', 'bot')},
+            'Anon': {},
+        })
+        self.assertEqual(room.nicks, {
+            'Rob': 'rob@example.com',
+            'The Robot': 'rob@example.com',
+            'Anon': None,
+        })
+        self.assertEqual(room.jids, {
+            'rob@example.com': set(['Rob', 'The Robot']),
+        })
+
+    def test_nick_reused(self):
+        room = RoomOccupants()
+        room.add('Rob', 'rob@example.com')
+        room.add('Rob', 'rob@example.com')
+        self.assertEqual(room.nicks_of('rob@example.com'), set(['Rob']))
+        room.add('Rob', 'robert@example.com')
+        self.assertFalse(room.has_jid('rob@example.com'))
+        self.assertEqual(room.jid_of('Rob'), 'robert@example.com')
+        room.add('Rob', None)
+        self.assertEqual(room.jids, {})
+        self.assertIsNone(room.jid_of('Rob'))
+        room.remove('Rob')
+        room.remove('Rob')
+        self.assertEqual(len(room), 0)
+        self.assertEqual(room.nicks_of('rob@example.com'), set())
+
+    def test_roles(self):
+        room = RoomOccupants.from_roster({
+            'Rob': {'jid': Jid('rob', 'rob@example.com', 'home'),
+                'role': 'moderator', 'affiliation': 'owner'},
+            'Anon': {'role': 'participant', 'affiliation': 'none'},
+            'Lurker': {'role': 'visitor'},
+        })
+        self.assertEqual(room.role_of('Rob'), 'moderator')
+        self.assertEqual(room.affiliation_of('Lurker'), None)
+        self.assertEqual(list(room.with_role('participant')), ['Anon'])
+        self.assertEqual(list(room.with_affiliation('owner')), ['Rob'])
+
+        # a different occupant taking the nick
+        room.add('Rob', 'robert@example.com', 'participant')
+        self.assertEqual(room.affiliation_of('Rob'), None)
+        self.assertEqual(len(room.with_affiliation('owner')), 0)
+        self.assertEqual(sorted(room.with_role('participant')),
+            ['Anon', 'Rob'])
+
+        room.remove('Anon')
+        room.remove('Rob')
+        self.assertEqual(room.role_nicks, {'visitor': room.with_role('visitor')})
+        self.assertEqual(room.roles, {'Lurker': 'visitor'})
+        self.assertEqual(room.affiliation_nicks, {})
+
+
+class IndexedSetTestCase(TestCase):
+
+    def test_add_remove(self):
+        members = IndexedSet()
+        for i in range(10):
+            members.add(i)
+        members.add(3)
+        self.assertEqual(len(members), 10)
+        for i in (0, 9, 4):
+            members.remove(i)
+        members.discard(4)
+        self.assertRaises(KeyError, members.remove, 4)
+        self.assertEqual(sorted(members), [1, 2, 3, 5, 6, 7, 8])
+        for position, member in enumerate(members.members):
+            self.assertEqual(members.positions[member], position)
+        self.assertIn(random.choice(members), members)
@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from sleekxmpp.xmlstream import ET
+
+from mtj.jibber.reply import Reply
+
+
+class ReplyTestCase(TestCase):
+
+    def test_builder(self):
+        reply = Reply('a ').em('b').text(' c').br().link(
+            'http://example.com', 'd').text(' ').link('http://example.com')
+        self.assertEqual(reply.plain,
+            'a b c\nd <http://example.com> http://example.com')
+        body = reply.html
+        self.assertEqual(body.text, 'a ')
+        self.assertEqual([el.tag.split('}')[1] for el in body],
+            ['em', 'br', 'a', 'a'])
+        self.assertEqual(body[0].tail, ' c')
+        self.assertEqual(body[2].attrib, {'href': 'http://example.com'})
+        self.assertEqual(body[2].tail, ' ')
+
+    def test_provided_html(self):
+        body = ET.Element('{http://www.w3.org/1999/xhtml}body')
+        body.text = 'html'
+        reply = Reply(html=body, plain='text')
+        self.assertIs(reply.html, body)
+        self.assertEqual(reply.plain, 'text')
+
+    def test_message_kwargs(self):
+        reply = Reply('hi', mto='other@example.com')
+        msg = reply.message(mto='room@example.com', mtype='groupchat',
+            unknown='ignored')
+        self.assertEqual(msg['to'], 'other@example.com')
+        self.assertEqual(msg['type'], 'groupchat')
+        self.assertEqual(msg['body'], 'hi')
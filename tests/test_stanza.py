@@ -2,6 +2,7 @@ from unittest import TestCase
 
 import re
 
+from mtj.jibber.stanza import admin_queries
 from mtj.jibber.stanza import admin_query
 
 
@@ -37,3 +38,24 @@ class StanzaTestCase(TestCase):
     def test_admin_bad_role(self):
         self.assertRaises(TypeError, admin_query, 'room@example.com',
             jid='test@example.com', role='bad_role')
+
+    def test_admin_queries(self):
+        result = admin_queries('room@example.com', nicks=['a', 'b', 'c'],
+            jids=['d@example.com'], role='visitor', reason='spam',
+            chunk_size=3)
+        self.assertEqual(len(result), 2)
+        self.assertEqual([len(iq.get_payload()[0]) for iq in result],
+            [3, 1])
+        self.assertEqual(result[1]['to'], 'room@example.com')
+        self.assertEqual(result[1]['type'], 'set')
+        item = result[1].get_payload()[0][0]
+        self.assertEqual(item.attrib, {'jid': 'd@example.com',
+            'role': 'visitor'})
+        self.assertEqual(item[0].text, 'spam')
+
+    def test_admin_queries_empty(self):
+        self.assertEqual(admin_queries('room@example.com'), [])
+
+    def test_admin_queries_bad_chunk_size(self):
+        self.assertRaises(ValueError, admin_queries, 'room@example.com',
+            nicks=['a'], chunk_size=0)
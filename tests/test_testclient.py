@@ -1,5 +1,7 @@
 from unittest import TestCase
 
+from sleekxmpp.xmlstream.handler import Callback
+
 from mtj.jibber.jabber import MucChatBot
 from mtj.jibber.testing.client import TestClient
 
@@ -37,6 +39,16 @@ class TestClientTestCase(TestCase):
 
         self.assertRaises(ValueError, client.schedule, 'name', 'a')
 
+    def test_client_remove_handler(self):
+        client = TestClient()
+        client.register_handler(Callback('a', None, None))
+        client.register_handler(Callback('a', None, None))
+        # only the first match is removed, as the client would.
+        self.assertTrue(client.remove_handler('a'))
+        self.assertEqual(len(client.handlers), 1)
+        self.assertTrue(client.remove_handler('a'))
+        self.assertFalse(client.remove_handler('a'))
+
     def test_muc_bot_success_general(self):
         bot = MucChatBot()
         client = TestClient()
@@ -0,0 +1,142 @@
+from unittest import TestCase
+
+from mtj.jibber import trigger
+from mtj.jibber.trigger import LiteralScanner
+from mtj.jibber.trigger import TriggerTable
+from mtj.jibber.trigger import leading_token
+from mtj.jibber.trigger import required_literal
+
+
+class RequiredLiteralTestCase(TestCase):
+
+    def test_plain(self):
+        self.assertEqual(required_literal('hello'), 'hello')
+        self.assertEqual(required_literal('HeLLo'), 'hello')
+
+    def test_none(self):
+        self.assertIsNone(required_literal('.*'))
+        self.assertIsNone(required_literal('(a|b)'))
+        self.assertIsNone(required_literal('x?'))
+
+    def test_groups(self):
+        self.assertEqual(required_literal('foo(bar)baz'), 'foobarbaz')
+        self.assertEqual(required_literal('(?P<a>foo)+ bar'), ' bar')
+        self.assertEqual(required_literal('(?:longer)+ bar'), 'longer')
+
+    def test_classes(self):
+        self.assertEqual(required_literal('ab[cd]efg'), 'efg')
+        self.assertEqual(required_literal('abcd\\sefg'), 'abcd')
+
+    def test_non_ascii(self):
+        self.assertEqual(required_literal(u'caf\xe9 latte'), ' latte')
+
+
+class LeadingTokenTestCase(TestCase):
+
+    def test_delimited(self):
+        self.assertEqual(leading_token('^!seen\\s+(.*)'), '!seen')
+        self.assertEqual(leading_token('\\A!Seen\\s'), '!seen')
+        self.assertEqual(leading_token('^foo$'), 'foo')
+        self.assertEqual(leading_token('(?i)^foo bar'), 'foo')
+
+    def test_not_delimited(self):
+        self.assertIsNone(leading_token('^foo'))
+        self.assertIsNone(leading_token('^foo.*'))
+        self.assertIsNone(leading_token('^fo+ bar'))
+        self.assertIsNone(leading_token('^ foo'))
+        self.assertIsNone(leading_token('^(foo) bar'))
+
+    def test_multiline(self):
+        import re
+        self.assertIsNone(leading_token('^foo bar', re.MULTILINE))
+
+    def test_parsed_without_state(self):
+        # before python 3.8 the parsed pattern has no `state`.
+        sre_parse = trigger.sre_parse
+
+        class SubPattern(list):
+            pass
+
+        class Parser(object):
+            def __getattr__(self, name):
+                return getattr(sre_parse, name)
+
+            def parse(self, pattern, flags=0):
+                items = SubPattern(sre_parse.parse(pattern, flags))
+                items.pattern = object()
+                return items
+
+        trigger.sre_parse = Parser()
+        try:
+            self.assertEqual(leading_token('^word bar'), 'word')
+            self.assertIsNone(leading_token('(?m)^word bar'))
+            table = TriggerTable([('^word (.*)', 'pkg', 'method')])
+            self.assertEqual(len(list(table.search('word up'))), 1)
+        finally:
+            trigger.sre_parse = sre_parse
+
+
+class LiteralScannerTestCase(TestCase):
+
+    def test_empty(self):
+        scanner = LiteralScanner([])
+        self.assertEqual(scanner.scan('anything'), set())
+
+    def test_overlapping(self):
+        scanner = LiteralScanner(['abcd', 'bc', 'c', 'cde'])
+        self.assertEqual(scanner.scan('abcde'), set([0, 1, 2, 3]))
+        self.assertEqual(scanner.scan('abce'), set([1, 2]))
+        self.assertEqual(scanner.scan('xxx'), set())
+
+
+class TriggerTableTestCase(TestCase):
+
+    def test_order_kept(self):
+        table = TriggerTable([
+            ['world', 'p', 'a'],
+            ['.*', 'p', 'b'],
+            ['hello', 'p', 'c'],
+            ['hello world', 'p', 'd'],
+        ])
+        self.assertEqual(
+            [m for match, p, m in table.search('Hello World')],
+            ['a', 'b', 'c', 'd'])
+        self.assertEqual(
+            [m for match, p, m in table.search('hello there')],
+            ['b', 'c'])
+        self.assertEqual(table.candidates('nothing'), [1])
+
+    def test_ignore_case_folding(self):
+        table = TriggerTable([
+            ['kitty', 'p', 'a'],
+            ['this', 'p', 'b'],
+        ])
+        # the re module matches these when ignoring case.
+        self.assertEqual(
+            [m for match, p, m in table.search(u'Kitty')], ['a'])
+        self.assertEqual(
+            [m for match, p, m in table.search(u'thİſ')], ['b'])
+
+    def test_case_sensitive(self):
+        table = TriggerTable([
+            ['Kitty', 'p', 'a'],
+        ], flags=0)
+        self.assertEqual(len(list(table.search('kitty'))), 0)
+        self.assertEqual(len(list(table.search('Kitty'))), 1)
+
+    def test_leading_token_order_kept(self):
+        table = TriggerTable([
+            ['^!seen (.*)$', 'p', 'a'],
+            ['seen', 'p', 'b'],
+            ['^!seen (?P<nick>.*)$', 'p', 'c'],
+            ['^!other (.*)$', 'p', 'd'],
+            ['.*', 'p', 'e'],
+        ])
+        self.assertEqual(table.tokens, {'!seen': [0, 2], '!other': [3]})
+        self.assertEqual(
+            [m for match, p, m in table.search('!SEEN someone')],
+            ['a', 'b', 'c', 'e'])
+        self.assertEqual(table.candidates('!seensomeone'), [1, 4])
+        self.assertEqual(table.candidates('!other thing'), [3, 4])
+        self.assertEqual(table.candidates(''), [4])
+        self.assertEqual(table.candidates('   '), [4])
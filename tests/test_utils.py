@@ -1,5 +1,8 @@
 from unittest import TestCase
+from collections import OrderedDict
+import os
 import tempfile
+import threading
 
 from mtj.jibber import utils
 
@@ -22,6 +25,154 @@ class UtilsTestCase(TestCase):
         self.assertIsNone(utils.read_config(__file__ + '.not_exist'))
 
 
+class HtmlToTextTestCase(TestCase):
+
+    def test_blocks(self):
+        self.assertEqual(utils.html_to_text(
+            '<html><body><h1>Title</h1><ul><li>one</li><li>two</li></ul>'
+            '<div>after <span>inline</span></div></body></html>'),
+            'Title\none\ntwo\nafter inline')
+
+    def test_existing_newlines(self):
+        self.assertEqual(utils.html_to_text('<p>a</p>\n<p>b</p>'),
+            'a\nb')
+        self.assertEqual(utils.html_to_text('a<br>b<BR/><br />c'),
+            'a\nb\n\nc')
+
+    def test_entities(self):
+        self.assertEqual(utils.html_to_text(
+            '&lt;p&gt; &quot;x&quot; &#39;y&#39; &#x26; &nope; AT&T'),
+            '<p> "x" \'y\' & &nope; AT&T')
+
+    def test_invalid_codepoints(self):
+        # these cannot be sent as xml.
+        self.assertEqual(utils.html_to_text(
+            '<p>a&#0;&#12;&#xd800;&#xffffffff;\x01b</p>'),
+            u'a\ufffd\ufffd\ufffd\ufffdb')
+        self.assertEqual(utils.html_to_text('a\x00b\x0c'), 'ab')
+
+    def test_pre(self):
+        self.assertEqual(utils.html_to_text(
+            '<p>code:</p><pre>\ndef f():\n    return 1\n</pre>\n<p>a</p>'),
+            'code:\ndef f():\n    return 1\na')
+        self.assertEqual(utils.html_to_text(
+            '<pre>  <b>a</b>\n\tb</pre>  c'), '  a\n\tb\nc')
+
+    def test_table(self):
+        self.assertEqual(utils.html_to_text(
+            '<table>\n<tr><th>a</th> <th>b</th></tr>\n'
+            '<tr><td>1</td><td><b>2</b></td></tr>\n</table>'),
+            'a\tb\n1\t2')
+        self.assertEqual(utils.html_to_text('<td>1<td>2'), '1\t2')
+
+    def test_hidden(self):
+        self.assertEqual(utils.html_to_text(
+            '<p>a<!-- <b>comment</b> --></p><script>x < y</script>'
+            '<style>p { }</style><p>b</p>'), 'a\nb')
+
+    def test_whitespace(self):
+        self.assertEqual(utils.html_to_text(
+            '<ul>\n  <li>\tone</li>\n  <LI>two <b>2</b></LI>\n</ul>\n'),
+            'one\ntwo 2')
+        self.assertEqual(utils.html_to_text('<p>a</p><br><br>b'),
+            'a\n\nb')
+        self.assertEqual(utils.html_to_text('a\x00<p>\x01b'), 'a\nb')
+
+    def test_plain(self):
+        self.assertEqual(utils.html_to_text('a < b'), 'a < b')
+        self.assertEqual(utils.html_to_text('a & b'), 'a & b')
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_locked(self):
+        cache = utils.LRUCache(2)
+        locked = []
+
+        class Entries(OrderedDict):
+            def pop(self, *a):
+                locked.append(cache.lock.locked())
+                return OrderedDict.pop(self, *a)
+
+        cache.entries = Entries()
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(locked, [True, True, True])
+
+    def test_threaded(self):
+        cache = utils.LRUCache(4)
+
+        def work(n):
+            for i in range(1000):
+                key = (n + i) % 8
+                if cache.get(key) is None:
+                    cache.put(key, i)
+
+        threads = [threading.Thread(target=work, args=(n,))
+            for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 4000)
+        self.assertEqual(stats['size'], 4)
+
+
+class RecentSetTestCase(TestCase):
+
+    def test_size(self):
+        recent = utils.RecentSet(3)
+        for item in ('a', 'b', 'a', 'c'):
+            recent.add(item, now=0)
+        self.assertEqual(list(recent), ['b', 'a', 'c'])
+        self.assertEqual(recent.counts, {'a': 1, 'b': 1, 'c': 1})
+        recent.add('d', now=0)
+        self.assertNotIn('b', recent)
+        self.assertIn('a', recent)
+        recent.clear()
+        self.assertEqual(len(recent), 0)
+        self.assertEqual(recent.counts, {})
+
+    def test_window(self):
+        recent = utils.RecentSet(100, window=10)
+        recent.add('a', now=100)
+        recent.add('b', now=105)
+        recent.add('a', now=108)
+        self.assertTrue(recent.contains('a', now=112))
+        self.assertFalse(recent.contains('b', now=115))
+        self.assertEqual(list(recent), ['a'])
+        self.assertFalse(recent.contains('a', now=118))
+        self.assertEqual(recent.counts, {})
+
+
+class ConfigWatcherTestCase(TestCase):
+
+    def test_check(self):
+        calls = []
+        tf = tempfile.NamedTemporaryFile()
+        os.utime(tf.name, (1000, 1000))
+        watcher = utils.ConfigWatcher(tf.name, lambda: calls.append(1),
+            debounce=5)
+        self.assertFalse(watcher.check(now=100))
+
+        os.utime(tf.name, (1001, 1001))
+        self.assertFalse(watcher.check(now=101))
+        # changed again before it settled.
+        os.utime(tf.name, (1002, 1002))
+        self.assertFalse(watcher.check(now=104))
+        self.assertFalse(watcher.check(now=108))
+        self.assertTrue(watcher.check(now=109))
+        self.assertFalse(watcher.check(now=120))
+        self.assertEqual(calls, [1])
+
+        # removed files are not an error.
+        tf.close()
+        self.assertFalse(watcher.check(now=121))
+        self.assertIsNone(watcher.mtime)
+
+
 class ConfigFileTestCase(TestCase):
 
     def test_read_config(self):
@@ -0,0 +1,500 @@
+from unittest import TestCase
+import threading
+from functools import partial
+
+import mtj.jibber.worker
+from mtj.jibber.worker import InboundQueue
+from mtj.jibber.worker import OutboundQueue
+from mtj.jibber.worker import WorkerPool
+
+
+class WorkerPoolTestCase(TestCase):
+
+    def setUp(self):
+        self._time = 1000
+        self._orig_time = mtj.jibber.worker.time
+        mtj.jibber.worker.time = self.time
+        self.results = []
+
+    def tearDown(self):
+        mtj.jibber.worker.time = self._orig_time
+
+    def time(self):
+        return self._time
+
+    def callback(self, result):
+        self.results.append(result)
+
+    def test_bad_size(self):
+        self.assertRaises(ValueError, WorkerPool, size=0)
+
+    def test_run(self):
+        pool = WorkerPool(size=1)
+        pool.run('pkg', lambda: 'result', self.callback, 1000)
+        self.assertEqual(self.results, ['result'])
+
+    def test_run_error(self):
+        def fail():
+            raise Exception()
+        pool = WorkerPool(size=1)
+        pool.run('pkg', fail, self.callback, 1000)
+        self.assertEqual(self.results, [])
+
+    def test_run_expired_in_queue(self):
+        called = []
+        pool = WorkerPool(size=1, timeout=5)
+        self._time = 1006
+        pool.run('pkg', lambda: called.append(1), self.callback, 1000)
+        self.assertEqual(called, [])
+        self.assertEqual(self.results, [None])
+
+    def test_run_expired_result(self):
+        def slow():
+            self._time = 1006
+            return 'late'
+        pool = WorkerPool(size=1, timeout=5)
+        pool.run('pkg', slow, self.callback, 1000)
+        self.assertEqual(self.results, [None])
+
+    def test_submit_full(self):
+        pool = WorkerPool(size=1, queue_size=1)
+        self.assertTrue(pool.submit('pkg', lambda: 1, self.callback))
+        self.assertFalse(pool.submit('pkg', lambda: 2, self.callback))
+
+    def test_submit_full_lanes(self):
+        pool = WorkerPool(size=1, queue_size=2)
+        self.assertTrue(pool.submit('pkg', lambda: 1, self.callback, lane=1))
+        self.assertTrue(pool.submit('pkg', lambda: 2, self.callback, lane=2))
+        # the limit applies across the lanes.
+        self.assertFalse(pool.submit('pkg', lambda: 3, self.callback,
+            lane=3))
+        pool.queue.get()()
+        self.assertTrue(pool.submit('pkg', lambda: 3, self.callback,
+            lane=3))
+        self.assertEqual(pool.pending, 2)
+
+    def test_stop_drains_lanes(self):
+        mtj.jibber.worker.time = self._orig_time
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def first():
+            started.set()
+            proceed.wait(5)
+            return 0
+
+        pool = WorkerPool(size=2)
+        pool.start()
+        threads = list(pool.threads)
+        pool.submit('pkg', first, self.callback, lane='a')
+        pool.submit('pkg', lambda: 1, self.callback, lane='a')
+        pool.submit('pkg', lambda: 2, self.callback, lane='a')
+        self.assertTrue(started.wait(5))
+        pool.stop()
+        self.assertFalse(pool.submit('pkg', lambda: 3, self.callback))
+        proceed.set()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(self.results, [0, 1, 2])
+        self.assertEqual(pool.lanes, {})
+
+    def test_threaded(self):
+        mtj.jibber.worker.time = self._orig_time
+        done = threading.Event()
+
+        def callback(result):
+            self.results.append(result)
+            if len(self.results) == 3:
+                done.set()
+
+        pool = WorkerPool(size=2, package_limits={'pkg': 1})
+        pool.start()
+        self.assertEqual(len(pool.threads), 2)
+        for i in range(3):
+            pool.submit('pkg', lambda i=i: i, callback)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(sorted(self.results), [0, 1, 2])
+        pool.stop()
+        self.assertEqual(pool.threads, [])
+
+    def test_join(self):
+        mtj.jibber.worker.time = self._orig_time
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        pool = WorkerPool(size=2)
+        pool.start()
+        pool.submit('pkg', slow, self.results.append)
+        pool.submit('pkg', lambda: 'fast', self.results.append, lane='a')
+        self.assertTrue(started.wait(5))
+        pool.stop()
+        self.assertFalse(pool.join(0.01))
+        release.set()
+        self.assertTrue(pool.join(5))
+        self.assertEqual(sorted(self.results), ['fast', 'slow'])
+
+    def test_join_from_worker(self):
+        mtj.jibber.worker.time = self._orig_time
+        pool = WorkerPool(size=1)
+        pool.start()
+
+        def stop():
+            pool.stop()
+            return pool.join(5)
+
+        done = threading.Event()
+
+        def callback(result):
+            self.results.append(result)
+            done.set()
+
+        # the worker does not wait on itself.
+        pool.submit('pkg', stop, callback)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.results, [False])
+        self.assertTrue(pool.join(5))
+
+    def test_package_limit_deferred(self):
+        pool = WorkerPool(size=1, package_limits={'slow': 1})
+        calls = []
+
+        def slow():
+            # the other calls are run while this one holds the only slot
+            # for slow, which sets aside the second call to slow rather
+            # than blocking the worker on it.
+            pool.queue.get()()
+            pool.queue.get()()
+            self.assertEqual(len(pool.deferred['slow']), 1)
+            calls.append('slow0')
+
+        pool.submit('slow', slow, self.callback)
+        pool.submit('slow', lambda: calls.append('slow1'), self.callback)
+        pool.submit('fast', lambda: calls.append('fast'), self.callback)
+        pool.queue.get()()
+        self.assertEqual(calls, ['fast', 'slow0'])
+
+        # the slot was handed over to the call set aside.
+        self.assertEqual(pool.deferred, {})
+        self.assertEqual(pool.queue.qsize(), 1)
+        pool.queue.get()()
+        self.assertEqual(calls, ['fast', 'slow0', 'slow1'])
+        self.assertEqual(pool.running, {'slow': 0})
+
+    def test_lanes_ordered(self):
+        pool = WorkerPool(size=1, lane_depth=2)
+        self.assertTrue(pool.submit('pkg', lambda: 'a1', self.callback,
+            lane='a'))
+        self.assertTrue(pool.submit('pkg', lambda: 'b1', self.callback,
+            lane='b'))
+        self.assertTrue(pool.submit('pkg', lambda: 'a2', self.callback,
+            lane='a'))
+        # lane a is full.
+        self.assertFalse(pool.submit('pkg', lambda: 'a3', self.callback,
+            lane='a'))
+        # only one task queued per lane.
+        self.assertEqual(pool.queue.qsize(), 2)
+
+        # run the tasks as the worker would.
+        while not pool.queue.empty():
+            pool.queue.get()()
+
+        # lanes interleave, but each lane kept its order.
+        self.assertEqual(self.results, ['a1', 'b1', 'a2'])
+        self.assertEqual(pool.lanes, {})
+
+    def test_lanes_error_continues(self):
+        def fail():
+            raise Exception()
+        pool = WorkerPool(size=1)
+        pool.submit('pkg', fail, self.callback, lane='a')
+        pool.submit('pkg', lambda: 'a2', self.callback, lane='a')
+        while not pool.queue.empty():
+            pool.queue.get()()
+        self.assertEqual(self.results, ['a2'])
+
+    def test_lanes_threaded(self):
+        mtj.jibber.worker.time = self._orig_time
+        done = threading.Event()
+        gate = threading.Event()
+
+        def callback(result):
+            self.results.append(result)
+            if len(self.results) == 40:
+                done.set()
+
+        def slow(value):
+            # the first call of each lane waits so later ones pile up.
+            if value % 10 == 0:
+                gate.wait(5)
+            return value
+
+        pool = WorkerPool(size=4, lane_depth=0)
+        pool.start()
+        for i in range(40):
+            pool.submit('pkg', partial(slow, i), callback, lane=i // 10)
+        gate.set()
+        self.assertTrue(done.wait(5))
+        pool.stop()
+        for lane in range(4):
+            values = [v for v in self.results if v // 10 == lane]
+            self.assertEqual(values, list(range(lane * 10, lane * 10 + 10)))
+
+
+class InboundQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.dispatched = []
+
+    def dispatch(self, item):
+        self.dispatched.append(item)
+
+    def drain(self, queue):
+        queue.stop()
+        queue.work()
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, InboundQueue, self.dispatch,
+            policy='drop_everything')
+
+    def test_rooms_take_turns(self):
+        queue = InboundQueue(self.dispatch)
+        queue.put('a', 'a1')
+        queue.put('a', 'a2')
+        queue.put('a', 'a3')
+        queue.put('b', 'b1')
+        queue.put('c', 'c1')
+        queue.put('b', 'b2')
+        self.assertEqual(len(queue), 6)
+        self.drain(queue)
+        self.assertEqual(self.dispatched,
+            ['a1', 'b1', 'c1', 'a2', 'b2', 'a3'])
+        self.assertEqual(queue.stats(), {'queued': 0, 'shed': {}})
+
+    def test_drop_newest(self):
+        queue = InboundQueue(self.dispatch, size=2, policy='drop_newest')
+        self.assertTrue(queue.put('a', 'a1'))
+        self.assertTrue(queue.put('b', 'b1'))
+        self.assertFalse(queue.put('a', 'a2'))
+        self.drain(queue)
+        self.assertEqual(self.dispatched, ['a1', 'b1'])
+        self.assertEqual(queue.shed, {'full': 1})
+
+    def test_drop_oldest(self):
+        queue = InboundQueue(self.dispatch, size=2, policy='drop_oldest')
+        queue.put('a', 'a1')
+        queue.put('b', 'b1')
+        queue.put('a', 'a2')
+        queue.put('c', 'c1')
+        self.drain(queue)
+        self.assertEqual(self.dispatched, ['a2', 'c1'])
+        self.assertEqual(queue.shed, {'oldest': 2})
+
+    def test_drop_listeners(self):
+        queue = InboundQueue(self.dispatch, size=3,
+            policy='drop_listeners')
+        queue.put('a', 'a1')
+        queue.put('a', 'a2', droppable=True)
+        queue.put('b', 'b1', droppable=True)
+        queue.put('b', 'b2')
+        queue.put('b', 'b3')
+        queue.put('a', 'a3')
+        self.assertEqual(queue.shed, {'listeners': 2, 'oldest': 1})
+        self.drain(queue)
+        self.assertEqual(self.dispatched, ['b2', 'a3', 'b3'])
+
+    def test_drop_listeners_lines(self):
+        queue = InboundQueue(self.dispatch, size=2,
+            policy='drop_listeners')
+        for i in range(100):
+            queue.put('a', 'a%d' % i, droppable=i % 2)
+            queue.put('b', 'b%d' % i)
+            self.dispatch(queue.get())
+        self.assertEqual(queue.shed, {'listeners': 50, 'oldest': 49})
+        # the lines used for the eviction do not keep the entries gone.
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(len(queue.order), 1)
+        self.assertEqual(len(queue.droppable), 0)
+        self.drain(queue)
+        self.assertEqual(len(self.dispatched), 101)
+        self.assertEqual(self.dispatched[-1], 'b99')
+
+    def test_room_size(self):
+        queue = InboundQueue(self.dispatch, room_size=2)
+        queue.put('a', 'a1')
+        queue.put('a', 'a2')
+        queue.put('b', 'b1')
+        queue.put('a', 'a3')
+        self.drain(queue)
+        # room a kept its turn.
+        self.assertEqual(self.dispatched, ['a2', 'b1', 'a3'])
+        self.assertEqual(queue.shed, {'room': 1})
+
+    def test_dispatch_error(self):
+        def dispatch(item):
+            if item == 'bad':
+                raise Exception()
+            self.dispatched.append(item)
+        queue = InboundQueue(dispatch)
+        queue.put('a', 'bad')
+        queue.put('a', 'good')
+        self.drain(queue)
+        self.assertEqual(self.dispatched, ['good'])
+
+    def test_threaded(self):
+        done = threading.Event()
+
+        def dispatch(item):
+            self.dispatched.append(item)
+            if len(self.dispatched) == 3:
+                done.set()
+
+        queue = InboundQueue(dispatch)
+        queue.start()
+        for i in range(3):
+            queue.put('a', i)
+        self.assertTrue(done.wait(5))
+        queue.stop()
+        queue.thread.join(5)
+        self.assertFalse(queue.thread.is_alive())
+        self.assertEqual(self.dispatched, [0, 1, 2])
+
+    def test_join_drains(self):
+        queue = InboundQueue(self.dispatch)
+        self.assertTrue(queue.join(5))
+        for i in range(3):
+            queue.put('a', i)
+        queue.start()
+        queue.stop()
+        self.assertTrue(queue.join(5))
+        self.assertEqual(self.dispatched, [0, 1, 2])
+
+
+class OutboundQueueTestCase(TestCase):
+
+    def setUp(self):
+        self._time = 1000
+        self._orig_time = mtj.jibber.worker.time
+        mtj.jibber.worker.time = self.time
+        self.sent = []
+
+    def tearDown(self):
+        mtj.jibber.worker.time = self._orig_time
+
+    def time(self):
+        return self._time
+
+    def item(self, value):
+        return lambda: self.sent.append(value)
+
+    def poll(self, queue):
+        item, wait = queue.poll(self._time)
+        if item is not None:
+            item()
+        return wait
+
+    def test_per_destination(self):
+        queue = OutboundQueue(rate=1, burst=2)
+        for i in range(4):
+            queue.put('a', self.item('a%d' % i))
+        queue.put('b', self.item('b0'))
+        self.assertEqual(len(queue), 5)
+
+        self.assertEqual(self.poll(queue), 0)
+        self.assertEqual(self.poll(queue), 0)
+        self.assertEqual(self.poll(queue), 0)
+        # a is out of tokens, b is empty.
+        self.assertEqual(self.poll(queue), 1)
+        self.assertEqual(self.sent, ['a0', 'b0', 'a1'])
+
+        self._time = 1001
+        self.assertEqual(self.poll(queue), 0)
+        self.assertEqual(self.poll(queue), 1)
+        self._time = 1002
+        self.assertEqual(self.poll(queue), 0)
+        self.assertIsNone(self.poll(queue))
+        self.assertEqual(self.sent, ['a0', 'b0', 'a1', 'a2', 'a3'])
+
+        stats = queue.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['sent'], 5)
+        self.assertEqual(stats['max_wait'], 2)
+        self.assertEqual(stats['mean_wait'], 3 / 5.0)
+
+    def test_global(self):
+        queue = OutboundQueue(rate=10, burst=10, global_rate=1,
+            global_burst=1)
+        queue.put('a', self.item('a0'))
+        queue.put('b', self.item('b0'))
+        self.assertEqual(self.poll(queue), 0)
+        self.assertEqual(self.poll(queue), 1)
+        self._time = 1001
+        self.assertEqual(self.poll(queue), 0)
+        self.assertEqual(self.sent, ['a0', 'b0'])
+
+    def test_priority(self):
+        queue = OutboundQueue(rate=1, burst=1)
+        queue.put('a', self.item('a0'))
+        queue.put('a', self.item('a1'))
+        queue.put('a', self.item('kick0'), priority=True)
+        queue.put('a', self.item('kick1'), priority=True)
+        self.assertEqual(queue.stats()['priority'], 2)
+        self.poll(queue)
+        self.poll(queue)
+        self.poll(queue)
+        # not subjected to the destination limit.
+        self.assertEqual(self.sent, ['kick0', 'kick1', 'a0'])
+
+    def test_prune(self):
+        queue = OutboundQueue(rate=1, burst=1)
+        queue.put('a', self.item('a0'))
+        self.poll(queue)
+        self.assertEqual(list(queue.buckets.keys()), ['a'])
+        queue.put('b', self.item('b0'))
+        # a is still recovering.
+        self.assertEqual(sorted(queue.buckets.keys()), ['a', 'b'])
+        self.poll(queue)
+        self._time = 1001
+        queue.put('c', self.item('c0'))
+        self.assertEqual(list(queue.buckets.keys()), ['c'])
+
+    def test_threaded(self):
+        mtj.jibber.worker.time = self._orig_time
+        done = threading.Event()
+
+        def send():
+            self.sent.append(1)
+            if len(self.sent) == 3:
+                done.set()
+
+        queue = OutboundQueue(rate=100, burst=1)
+        queue.start()
+        for i in range(3):
+            queue.put('a', send)
+        self.assertTrue(done.wait(5))
+        queue.stop()
+        queue.thread.join(5)
+        self.assertFalse(queue.thread.is_alive())
+
+    def test_bad_rate(self):
+        self.assertRaises(ValueError, OutboundQueue, rate=0)
+        self.assertRaises(ValueError, OutboundQueue, rate=-1)
+        self.assertRaises(ValueError, OutboundQueue, burst=0)
+        self.assertRaises(ValueError, OutboundQueue, global_rate=0)
+        self.assertRaises(ValueError, OutboundQueue, global_rate=1,
+            global_burst=0)
+
+    def test_join_drains(self):
+        mtj.jibber.worker.time = self._orig_time
+        queue = OutboundQueue(rate=100, burst=1)
+        for i in range(3):
+            queue.put('a', self.item(i))
+        queue.start()
+        queue.stop()
+        self.assertTrue(queue.join(5))
+        self.assertEqual(self.sent, [0, 1, 2])